@@ -0,0 +1,273 @@
+# This file handles the storage of the ballots for a poll
+import json
+import logging
+import os
+import time
+import numpy as np
+
+# ranks only go up to the number of choices and scores up to 5, so a byte per candidate is plenty
+# (this is what the ballots are stored as, and what the election code works on directly)
+BALLOT_DTYPE = np.uint8
+
+# every journal starts with a small header so we know how to read the records back:
+#   4 bytes magic, then (version, number of candidates) as little-endian uint32s
+# version 1 journals stored each record as int64s, they can still be read back
+JOURNAL_MAGIC = b'ILDJ'
+JOURNAL_VERSION = 2
+JOURNAL_HEADER = np.dtype([('magic', 'S4'), ('version', '<u4'), ('n_candidates', '<u4')])
+
+# really big polls (like imported paper ballots) can be kept in a ballot file instead: a plain {name}.ballots.npy
+# of shape (voters, candidates), so each chunk of voters sits together on disk, plus {name}.ballots.json saying what
+# the poll was. The file is memory-mapped and the election code reads it a chunk at a time, so it's never all in memory
+BALLOT_FILE_SUFFIX = '.ballots.npy'
+CHUNK_SIZE = 2**18
+
+
+def journal_record(n_candidates):
+    # each record is the voter ID as an int64 followed by a byte for each candidate
+    return np.dtype([('voter', '<i8'), ('ballot', BALLOT_DTYPE, (n_candidates,))])
+
+
+class BallotStore:
+
+    def __init__(self, name, n_candidates, capacity=64):
+        self.name = name                                                    # name of the poll the ballots belong to
+        self.n_candidates = n_candidates                                    # number of candidates on each ballot
+        self.n_votes = 0                                                    # number of ballots actually stored
+        self._ballots = np.zeros((n_candidates, capacity), dtype=BALLOT_DTYPE)  # preallocated ballot columns, only [:, :n_votes] is used
+        self._voters = np.zeros((capacity,), dtype=int)                     # preallocated voter IDs
+        self.index = {}                                                     # maps each voter ID to their ballot column
+        self.archive_path = f'{name}.ballot.npz'                            # the compacted archive, written when the poll closes
+        self.journal_path = f'{name}.ballot.journal'                        # append-only log of every ballot, written as they come in
+        self._journal = None                                                # file handle for the journal, opened on the first ballot
+        self._journal_mode = 'xb'                                           # a fresh store starts a new journal, recovered ones add to theirs
+
+    @property
+    def ballots(self):
+        # first index iterates over candidates, second index iterates over voters (same as the election code expects)
+        return self._ballots[:, :self.n_votes]
+
+    @property
+    def voters(self):
+        return self._voters[:self.n_votes]
+
+    @property
+    def capacity(self):
+        return self._voters.shape[0]
+
+    def _grow(self, n_needed):
+        # double the capacity so that appending N ballots costs O(N) copies overall instead of O(N^2)
+        capacity = max(2*self.capacity, n_needed, 1)
+        ballots = np.zeros((self.n_candidates, capacity), dtype=self._ballots.dtype)
+        ballots[:, :self.n_votes] = self.ballots
+        voters = np.zeros((capacity,), dtype=self._voters.dtype)
+        voters[:self.n_votes] = self.voters
+        self._ballots = ballots
+        self._voters = voters
+
+    def has_voted(self, user_id):
+        return user_id in self.index
+
+    def get_ballot(self, user_id):
+        # the stored ballot for a voter, or None if they haven't voted
+        col = self.index.get(user_id)
+        if col is None:
+            return None
+        return self._ballots[:, col].copy()
+
+    def append(self, ballot, user_id):
+        # add a single ballot to the end of the store and the journal
+        if self.n_votes + 1 > self.capacity:
+            self._grow(self.n_votes + 1)
+        self._ballots[:, self.n_votes] = ballot
+        self._voters[self.n_votes] = user_id
+        self.index[user_id] = self.n_votes
+        self.n_votes += 1
+        self._write_journal(np.asarray(ballot).reshape((1, self.n_candidates)), np.array([user_id]))
+
+    def amend(self, ballot, user_id):
+        # overwrite a voter's ballot in place, the journal just gets another record for them (the last one wins)
+        self._ballots[:, self.index[user_id]] = ballot
+        self._write_journal(np.asarray(ballot).reshape((1, self.n_candidates)), np.array([user_id]))
+
+    def commit(self, ballots, voters):
+        # add a batch of (voters, candidates) ballots at once, voters who already have a ballot get it replaced
+        # (like amend) and everyone else is appended, the whole batch goes into the journal in one write
+        ballots = np.asarray(ballots).reshape((len(voters), self.n_candidates))
+        cols = np.empty(len(voters), dtype=int)
+        n_votes = self.n_votes
+        for i, voter in enumerate(voters):
+            col = self.index.get(voter)
+            if col is None:
+                col = self.index[voter] = n_votes
+                n_votes += 1
+            cols[i] = col
+        if n_votes > self.capacity:
+            self._grow(n_votes)
+        self._ballots[:, cols] = ballots.T
+        self._voters[cols] = voters
+        self.n_votes = n_votes
+        self._write_journal(ballots, np.asarray(voters))
+
+    def _write_journal(self, ballots, voters):
+        # one small record per ballot, so only the new ballots ever get written to disk
+        if self._journal is None:
+            try:
+                self._journal = open(self.journal_path, self._journal_mode)
+            except FileExistsError:
+                # a fresh store never writes over a journal that's already there (say from a poll that couldn't be
+                # restored), those ballots are moved out of the way instead
+                stale_path = f'{self.journal_path}.{time.strftime("%Y%m%d-%H%M%S")}'
+                logging.warning(f'{self.journal_path} already exists, moving it to {stale_path}')
+                os.replace(self.journal_path, stale_path)
+                self._journal = open(self.journal_path, self._journal_mode)
+            if self._journal.tell() == 0:
+                self._journal.write(self._journal_header())
+        self._journal.write(self._journal_records(ballots, voters))
+        self._journal.flush()
+
+    def _journal_header(self):
+        return np.array([(JOURNAL_MAGIC, JOURNAL_VERSION, self.n_candidates)], dtype=JOURNAL_HEADER).tobytes()
+
+    def _journal_records(self, ballots, voters):
+        records = np.empty(len(voters), dtype=journal_record(self.n_candidates))
+        records['voter'] = voters
+        records['ballot'] = ballots
+        return records.tobytes()
+
+    def close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def compact(self, candidates, poll_type=None, n_winners=None, reweight=None):
+        # write everything into the usual npz archive and get rid of the journal
+        # (the poll type, number of winners and STAR counting rule go in too, so the archive can be recounted on its own)
+        extra = {}
+        if poll_type is not None:
+            extra['type'] = poll_type
+        if n_winners is not None:
+            extra['n_winners'] = n_winners
+        if reweight is not None:
+            extra['reweight'] = reweight
+        np.savez(self.archive_path, candidates=candidates, ballots=self.ballots, voters=self.voters, **extra)
+        self.close_journal()
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    @classmethod
+    def from_journal(cls, name, n_candidates):
+        # rebuild a store by replaying the journal of a poll that never got compacted
+        # the journal is memory-mapped (copy-on-write) rather than read in, so this is fast even for big polls
+        store = cls(name, n_candidates)
+        ballots, voters = read_journal(store.journal_path, n_candidates)
+        for i, voter in enumerate(voters.tolist()):
+            store.index.setdefault(voter, i)
+        if len(store.index) == len(voters):
+            # nobody amended their ballot, so the journal records can be used as they are
+            # (the first new ballot will grow the store out into regular memory)
+            store._ballots = ballots
+            store._voters = voters
+        else:
+            # amended ballots show up as repeated voters, they keep their original column but take the latest ballot
+            cols = np.empty(len(voters), dtype=int)
+            store.index = {}
+            for i, voter in enumerate(voters.tolist()):
+                cols[i] = store.index.setdefault(voter, len(store.index))
+            store._grow(len(store.index))
+            store._ballots[:, cols] = ballots
+            store._voters[cols] = voters
+        store.n_votes = len(store.index)
+        store._journal_mode = 'ab'
+        if np.fromfile(store.journal_path, dtype=JOURNAL_HEADER, count=1)[0]['version'] != JOURNAL_VERSION:
+            # new records can't be added on to an old journal, so write it out again in the current format
+            # (to a new file that then takes its place, so a crash halfway through still leaves the old one)
+            tmp_path = store.journal_path + '.tmp'
+            with open(tmp_path, 'wb') as file:
+                file.write(store._journal_header())
+                file.write(store._journal_records(store.ballots.T, store.voters))
+            os.replace(tmp_path, store.journal_path)
+        else:
+            # cut off any partial record a crash left at the end, so the new records start where they should
+            size = JOURNAL_HEADER.itemsize + len(voters) * journal_record(n_candidates).itemsize
+            if os.path.getsize(store.journal_path) > size:
+                os.truncate(store.journal_path, size)
+        return store
+
+    @classmethod
+    def from_archive(cls, name, n_candidates):
+        # rebuild a store from a compacted npz archive (older archives with int64 ballots are converted as they're copied in)
+        store = cls(name, n_candidates)
+        with np.load(store.archive_path) as archive:
+            ballots = archive['ballots']
+            voters = archive['voters']
+        store._grow(len(voters))
+        store._ballots[:, :len(voters)] = ballots
+        store._voters[:len(voters)] = voters
+        store.index = {voter: i for i, voter in enumerate(voters.tolist())}
+        store.n_votes = len(voters)
+        return store
+
+    @classmethod
+    def recover(cls, name, n_candidates):
+        # get back the ballots of a poll after a restart, from whatever is on disk
+        store = cls(name, n_candidates)
+        if os.path.exists(store.journal_path):
+            return cls.from_journal(name, n_candidates)
+        elif os.path.exists(store.archive_path):
+            return cls.from_archive(name, n_candidates)
+        return store
+
+
+def read_journal(path, n_candidates):
+    # returns the (candidates, voters) ballot array and the voter IDs stored in a journal file
+    # these are copy-on-write memory-mapped views of the file, so writing to them never touches the journal
+    header = np.fromfile(path, dtype=JOURNAL_HEADER, count=1)
+    if len(header) == 0 or header[0]['magic'] != JOURNAL_MAGIC or header[0]['version'] not in (1, JOURNAL_VERSION):
+        raise ValueError(f'{path} is not a ballot journal that can be read')
+    if header[0]['n_candidates'] != n_candidates:
+        raise ValueError(f'{path} has ballots for {header[0]["n_candidates"]} candidates, expected {n_candidates}')
+    if header[0]['version'] == 1:
+        record = np.dtype(('<i8', (n_candidates + 1,)))
+    else:
+        record = journal_record(n_candidates)
+    # a crash in the middle of a write can leave a partial record at the end, just drop it
+    n_records = (os.path.getsize(path) - JOURNAL_HEADER.itemsize) // record.itemsize
+    if n_records == 0:
+        return np.zeros((n_candidates, 0), dtype=BALLOT_DTYPE), np.zeros((0,), dtype=int)
+    if header[0]['version'] == 1:
+        # old int64 records get converted, so they're read in rather than mapped
+        records = np.fromfile(path, dtype='<i8', offset=JOURNAL_HEADER.itemsize, count=n_records * (n_candidates + 1))
+        records = records.reshape((n_records, n_candidates + 1))
+        return records[:, 1:].T.astype(BALLOT_DTYPE), records[:, 0]
+    records = np.memmap(path, dtype=record, mode='c', offset=JOURNAL_HEADER.itemsize, shape=(n_records,))
+    return records['ballot'].T, records['voter']
+
+
+def write_ballot_file(name, candidates, chunks, n_voters, poll_type=None, n_winners=None, reweight=None):
+    # write (candidates, voters) chunks of ballots out to a ballot file, one chunk at a time
+    ballots = np.lib.format.open_memmap(name + BALLOT_FILE_SUFFIX, mode='w+', dtype=BALLOT_DTYPE,
+                                        shape=(n_voters, len(candidates)))
+    start = 0
+    for chunk in chunks:
+        ballots[start:start + chunk.shape[1]] = chunk.T
+        start += chunk.shape[1]
+    if start != n_voters:
+        raise ValueError(f'Expected {n_voters} ballots for {name}, got {start}')
+    ballots.flush()
+    del ballots
+    with open(name + '.ballots.json', 'w') as file:
+        json.dump(dict(candidates=list(candidates), type=poll_type, n_winners=n_winners, reweight=reweight), file)
+
+
+def open_ballot_file(name):
+    # returns what the poll was (candidates, type, n_winners and reweight) and a read-only memory map of its (voters, candidates) ballots
+    with open(name + '.ballots.json', 'r') as file:
+        info = json.load(file)
+    return info, np.load(name + BALLOT_FILE_SUFFIX, mmap_mode='r')
+
+
+def iter_chunks(ballots, chunk_size=CHUNK_SIZE):
+    # go through a (voters, candidates) ballot file as (first voter, (candidates, voters) ballots) chunks
+    for start in range(0, ballots.shape[0], chunk_size):
+        yield start, ballots[start:start + chunk_size].T
@@ -0,0 +1,191 @@
+# This file times the election engines and ballot ingestion over a grid of poll sizes
+# run it with `python benchmark.py`, save a baseline with `--save baseline.json`
+# and check a later run against it with `--compare baseline.json` (exits with 1 if anything got slower than the threshold)
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import ballot_store
+import rcv
+import simulate
+import star
+
+# the default grid is small enough to run in a few minutes, --full sweeps the whole range
+DEFAULT_GRID = dict(voters=[1000, 10000, 100000], candidates=[3, 10, 50], winners=[1, 3], depth=[0, 3])
+FULL_GRID = dict(voters=[1000, 10000, 100000, 1000000, 10000000], candidates=[3, 10, 50, 200], winners=[1, 3, 10], depth=[0, 3, 10])
+
+
+def measure(func, repeat):
+    # best wall time out of `repeat` runs, then one more run under tracemalloc for the peak memory
+    # (tracemalloc slows everything down, so it's kept out of the timed runs)
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(seconds=best, peak_bytes=peak)
+
+
+def bench_engines(grid, repeat, max_bytes, seed, model):
+    results = {}
+    for n_voters, n_cands in itertools.product(grid['voters'], grid['candidates']):
+        if np.dtype(ballot_store.BALLOT_DTYPE).itemsize * n_voters * n_cands > max_bytes:
+            logging.warning(f'Skipping {n_voters} voters x {n_cands} candidates, the ballots alone would be over --max-bytes')
+            continue
+        candidates = [f'cand{i}' for i in range(n_cands)]
+
+        rng = np.random.default_rng([seed, n_voters, n_cands])
+        ballots = simulate.make_ballots(rng, model, 'STAR', n_voters, n_cands)
+        for n_winners in grid['winners']:
+            if n_winners >= n_cands:
+                continue
+            key = f'star.run_election model={model} voters={n_voters} candidates={n_cands} winners={n_winners}'
+            results[key] = measure(lambda: star.run_election(candidates, ballots, n_winners), repeat)
+            report(key, results[key])
+        del ballots
+
+        for depth in grid['depth']:
+            if depth >= n_cands:
+                continue
+            rng = np.random.default_rng([seed, n_voters, n_cands, depth])
+            ballots = simulate.make_ballots(rng, model, 'STV', n_voters, n_cands, depth=depth)
+            for n_winners in grid['winners']:
+                if n_winners >= n_cands:
+                    continue
+                key = f'rcv.run_election model={model} voters={n_voters} candidates={n_cands} winners={n_winners} depth={depth}'
+                results[key] = measure(lambda: rcv.run_election(candidates, ballots, n_winners), repeat)
+                report(key, results[key])
+            # worst case for the tiebreaker: every candidate tied, so it has to look all the way down the ballots
+            # (run_election keeps the rank counts it reads from up to date, so they're made outside the timing)
+            weights = np.ones(n_voters, dtype=int)
+            counts = rcv.rank_counts(ballots, weights)
+            key = f'rcv.tiebreaker model={model} voters={n_voters} candidates={n_cands} depth={depth}'
+            results[key] = measure(lambda: rcv.tiebreaker(ballots, np.arange(n_cands), weights, counts), repeat)
+            report(key, results[key])
+            del ballots
+    return results
+
+
+def bench_ingestion(grid, repeat, ingest_max, seed, model):
+    # times Poll.add_new_ballot one ballot at a time, the way the bot gets them
+    # the polls are made inside a scratch directory so their journal files don't end up here
+    results = {}
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            import main
+            main.make_client()
+            logging.getLogger().setLevel(logging.WARNING)
+
+            class FakeChannel:
+                id = 0
+
+            async def run():
+                for n_cands, poll_type in itertools.product(grid['candidates'], ['STV', 'STAR']):
+                    n_voters = min(max(grid['voters']), ingest_max)
+                    rng = np.random.default_rng([seed, n_voters, n_cands])
+                    ballots = simulate.make_ballots(rng, model, poll_type, n_voters, n_cands)
+                    ballot_list = list(ballots.T)
+                    choices = [f'cand{i}' for i in range(n_cands)]
+                    counter = itertools.count()
+
+                    def ingest():
+                        poll = main.Poll(0, FakeChannel(), f'bench{next(counter)}', poll_choices=choices, type=poll_type)
+                        for user_id, ballot in enumerate(ballot_list):
+                            poll.add_new_ballot(ballot, user_id)
+                        # whatever didn't make a full batch is committed here, the same as the ingest queue would
+                        main.client.ingest.flush(poll)
+                        poll.store.close_journal()
+
+                    key = f'Poll.add_new_ballot model={model} type={poll_type} voters={n_voters} candidates={n_cands}'
+                    results[key] = measure(ingest, repeat)
+                    results[key]['ballots_per_second'] = n_voters / results[key]['seconds']
+                    report(key, results[key])
+
+            asyncio.run(run())
+        finally:
+            os.chdir(workdir)
+    return results
+
+
+def report(key, res):
+    print(f'{key:<80} {res["seconds"]*1000:>10.2f} ms {res["peak_bytes"]/2**20:>10.2f} MiB', flush=True)
+
+
+def compare(results, baseline, threshold):
+    # anything that got more than `threshold` (as a fraction) slower than the baseline counts as a regression
+    regressions = []
+    for key, res in results.items():
+        old = baseline['results'].get(key)
+        if old is None:
+            continue
+        ratio = res['seconds'] / old['seconds']
+        if ratio > 1 + threshold:
+            regressions.append((key, old['seconds'], res['seconds'], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the election engines and ballot ingestion')
+    parser.add_argument('--full', action='store_true', help='sweep the full grid (up to 1e7 voters and 200 candidates)')
+    parser.add_argument('--voters', type=int, nargs='+', help='numbers of voters to try')
+    parser.add_argument('--candidates', type=int, nargs='+', help='numbers of candidates to try')
+    parser.add_argument('--winners', type=int, nargs='+', help='numbers of winners to try')
+    parser.add_argument('--depth', type=int, nargs='+', help='how many candidates each STV ballot ranks (0 ranks all of them)')
+    parser.add_argument('--model', choices=simulate.MODELS, default='impartial', help='voter model the ballots are drawn from')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per measurement, the best one is kept')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-bytes', type=float, default=2e9, help='skip grid points whose ballot array would be bigger than this')
+    parser.add_argument('--ingest-max', type=int, default=100000, help='most ballots to push through Poll.add_new_ballot')
+    parser.add_argument('--no-ingest', action='store_true', help="don't benchmark Poll.add_new_ballot")
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON baseline to check the results against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='slowdown (as a fraction) that counts as a regression')
+    args = parser.parse_args()
+
+    grid = dict(FULL_GRID if args.full else DEFAULT_GRID)
+    for name in grid:
+        if getattr(args, name) is not None:
+            grid[name] = getattr(args, name)
+
+    results = bench_engines(grid, args.repeat, args.max_bytes, args.seed, args.model)
+    if not args.no_ingest:
+        results.update(bench_ingestion(grid, args.repeat, args.ingest_max, args.seed, args.model))
+
+    if args.save:
+        meta = dict(created=time.time(), python=sys.version.split()[0], numpy=np.__version__,
+                    machine=platform.machine(), processor=platform.processor(), grid=grid, repeat=args.repeat, seed=args.seed, model=args.model)
+        with open(args.save, 'w') as file:
+            json.dump(dict(meta=meta, results=results), file, indent=1)
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        for key, old, new, ratio in regressions:
+            print(f'REGRESSION {key}: {old*1000:.2f} ms -> {new*1000:.2f} ms ({ratio:.2f}x)')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions beyond {args.threshold:.0%} against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
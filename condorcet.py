@@ -0,0 +1,140 @@
+# This file handles the Condorcet (Schulze method) vote logic
+# everything is worked out from the pairwise preference matrix, which the poll keeps up to date as ballots come in,
+# so counting the result never has to look at the ballots themselves
+import numpy as np
+
+import ballot_store
+import rcv
+import results
+
+# the full pairwise table is only printed for polls with at most this many candidates, otherwise it gets unreadable
+MAX_TABLE_CANDIDATES = 10
+
+
+def ballot_pairwise(ballot):
+    # pairwise[i, j] is 1 if this ballot ranks candidate i above candidate j (ranked candidates beat unranked ones)
+    # takes the same ranking ballots as STV, i.e. [5,3,1,2,4] or [0,0,1,2,0]
+    ballot = np.asarray(ballot)
+    key = np.where(ballot > 0, ballot, np.iinfo(np.int64).max)
+    return (key[:, None] < key[None, :]).astype(int)
+
+
+def pairwise_matrix(ballots, weights=None):
+    # the pairwise preference matrix for a whole (candidates, voters) ballot array,
+    # identical ballots are counted together so this scales with the number of distinct ballots
+    ballots = np.asarray(ballots)
+    if weights is None:
+        ballots, weights = rcv.compress_ballots(ballots)
+    key = np.where(ballots > 0, ballots, np.iinfo(np.int64).max)
+    pairwise = np.zeros((ballots.shape[0], ballots.shape[0]), dtype=np.asarray(weights).dtype)
+    for i in range(ballots.shape[0]):
+        pairwise[i] = (key[i][None, :] < key) @ weights
+    return pairwise
+
+
+def pairwise_matrix_chunked(ballot_file, chunk_size=None):
+    # pairwise_matrix for a (voters, candidates) ballot file, added up a chunk at a time
+    chunk_size = chunk_size or ballot_store.CHUNK_SIZE
+    pairwise = np.zeros((ballot_file.shape[1], ballot_file.shape[1]), dtype=np.int64)
+    for start, chunk in ballot_store.iter_chunks(ballot_file, chunk_size):
+        pairwise += pairwise_matrix(chunk)
+    return pairwise
+
+
+def strongest_paths(pairwise):
+    # strength of the strongest path from each candidate to every other (Floyd-Warshall over the winning margins)
+    n_cands = pairwise.shape[0]
+    paths = np.where(pairwise > pairwise.T, pairwise, 0)
+    for k in range(n_cands):
+        paths = np.maximum(paths, np.minimum(paths[:, k:k+1], paths[k:k+1, :]))
+    np.fill_diagonal(paths, 0)
+    return paths
+
+
+def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1, pairwise: np.ndarray = None):
+    # candidates should be a 1D array labeling each candidate in the vote
+    # ballots should be a 2D array of rankings, the same as for STV (see rcv.run_election)
+    # pairwise is the pairwise preference matrix, if it's given the ballots are only used to count the voters
+    # n_winners is an integer specifying how many winners the poll should have, it defaults to 1
+    #    with more than one the top n_winners of the Schulze ranking win (this isn't a proportional method)
+    if pairwise is None:
+        pairwise = pairwise_matrix(ballots)
+    paths = strongest_paths(pairwise)
+
+    # a candidate is ahead of another if their strongest path to them is stronger than the one coming back,
+    # the Schulze ranking puts whoever is ahead of the most others first
+    # (ties are broken by head-to-head wins, then by total votes over everyone else, then by ballot order)
+    n_ahead = np.sum(paths > paths.T, axis=1)
+    n_head_to_head = np.sum(pairwise > pairwise.T, axis=1)
+    n_preferred = np.sum(pairwise, axis=1)
+    ranking = np.lexsort((np.arange(len(candidates)), -n_preferred, -n_head_to_head, -n_ahead))
+
+    won = np.zeros(len(candidates), dtype=bool)
+    result = results.ElectionResult('CONDORCET', candidates, ballots.shape[1], n_winners)
+    result.pairwise = pairwise
+    rnd = result.add_round(1, n_ahead, len(candidates) - 1, won)
+    for c in ranking[:n_winners]:
+        won[c] = True
+        result.winners.append(c)
+        rnd.add_event('won', c, n_ahead[c])
+    result.set_final(ranking, n_ahead[ranking], len(candidates) - 1, won[ranking])
+    return result
+
+
+def render_result(result):
+    # turn an ElectionResult into the text printout, the pairwise results go first and then the ranking
+    candidates_padded = results.pad_names(result.candidates)
+    pairwise = result.pairwise
+    output = ['BEGINNING ELECTION']
+
+    parts = ['### HEAD-TO-HEAD RESULTS ###\n',
+             print_head_to_head(candidates_padded, pairwise),
+             '####################################\n']
+    if len(result.candidates) <= MAX_TABLE_CANDIDATES:
+        parts += ['### PAIRWISE PREFERENCES (ROW OVER COLUMN) ###\n',
+                  print_pairwise_table(candidates_padded, pairwise),
+                  '####################################\n']
+    output.append(''.join(parts))
+
+    for rnd in result.rounds:
+        parts = []
+        for kind, c, value in rnd.events:
+            if kind == 'won':
+                parts.append(f'RESULTS: {candidates_padded[c]} HAS WON THE ELECTION, AHEAD OF {value} OF THE OTHER CANDIDATES\n')
+        output.append(''.join(parts))
+
+    final = result.final
+    if final is not None:
+        output.append(''.join(['### FINAL RANKING              ###\n',
+                               print_ranking(candidates_padded[final.candidates], final.tallies, final.total, final.won),
+                               '################################\n',
+                               'I LOVE DEMOCRACY']))
+    return output
+
+
+def print_head_to_head(candidates_padded, pairwise):
+    output = []
+    for c in range(len(candidates_padded)):
+        others = np.arange(len(candidates_padded)) != c
+        wins = np.sum(pairwise[c, others] > pairwise[others, c])
+        losses = np.sum(pairwise[c, others] < pairwise[others, c])
+        ties = np.sum(others) - wins - losses
+        output.append(f'{candidates_padded[c]} | {wins} WINS | {losses} LOSSES | {ties} TIES\n')
+    return ''.join(output)
+
+
+def print_pairwise_table(candidates_padded, pairwise):
+    width = max(len(str(int(np.max(pairwise, initial=0)))), 4)
+    output = [' ' * len(candidates_padded[0]) + ' | ' + ' '.join(f'{i+1:>{width}}' for i in range(len(candidates_padded))) + '\n']
+    for c in range(len(candidates_padded)):
+        row = ' '.join(' ' * (width - 1) + '-' if c == j else f'{int(pairwise[c, j]):>{width}}' for j in range(len(candidates_padded)))
+        output.append(f'{candidates_padded[c]} | {row}   ({c+1})\n')
+    return ''.join(output)
+
+
+def print_ranking(candidates_padded, n_ahead, n_others, won):
+    output = []
+    for place, c in enumerate(candidates_padded):
+        status = 'WON       ' if won[place] else 'LOST      '
+        output.append(f'{status} | {c} | AHEAD OF {int(n_ahead[place])}/{n_others}\n')
+    return ''.join(output)
@@ -0,0 +1,137 @@
+# This file runs the election counting off of the event loop, so a big poll closing doesn't hold up everything else.
+# The counting goes to a pool of worker processes (or threads, if processes can't be used here), and the ballots
+# are handed over through shared memory instead of being pickled. Only so many closes are counted at once,
+# and any that take too long are given up on.
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import rcv
+import star
+
+
+def _count(method, candidates, ballots, n_winners, reweight=False):
+    if method == 'STV':
+        return rcv.run_election(candidates, ballots, n_winners)
+    return star.run_election(candidates, ballots, n_winners, reweight=reweight)
+
+
+def _count_shared(method, candidates, shm_name, shape, dtype, n_winners, reweight=False):
+    # runs in a worker process: look at the ballots right where the bot put them, count them and send back the result
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        ballots = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        result = _count(method, candidates, ballots, n_winners, reweight)
+        del ballots
+        return result
+    finally:
+        shm.close()
+
+
+class ElectionTimeout(Exception):
+    pass
+
+
+class ElectionPool:
+
+    def __init__(self, max_workers=None, max_concurrent=2, timeout=600, use_processes=True):
+        self.max_workers = max_workers                  # size of the worker pool (None for one per CPU)
+        self.max_concurrent = max_concurrent            # most elections counted at the same time, the rest wait their turn
+        self.timeout = timeout                          # seconds an election gets before it's given up on
+        self.use_processes = use_processes              # False to always count in threads
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    def start(self):
+        if self._executor is not None:
+            return
+        if self.use_processes:
+            try:
+                # the workers mustn't be forked from the bot itself, which has an event loop and sockets open
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                context = multiprocessing.get_context(method)
+                if method == 'forkserver':
+                    # the fork server only needs the counting code, not the script that started the bot
+                    context.set_forkserver_preload(['election_pool', 'rcv', 'star'])
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+                return
+            except (OSError, NotImplementedError, ImportError) as e:
+                logging.warning(f'Could not start worker processes for counting elections ({e!r}), using threads instead')
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='election')
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, method, candidates, ballots, n_winners=1, reweight=False):
+        # count an STV or STAR election in the pool (reweight picks the STAR rule, see star.run_election),
+        # raises ElectionTimeout if it takes longer than the timeout
+        # the ballots mustn't change until the count is done, the count may have to wait its turn for a while before
+        # they're looked at (so ballots that can still change need to be copied first)
+        self.start()
+        candidates = list(candidates)
+        while True:
+            executor = self._executor
+            try:
+                return await self._run(executor, method, candidates, ballots, n_winners, reweight)
+            except concurrent.futures.BrokenExecutor:
+                if not isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+                    raise
+                # a worker died (probably killed for using too much memory), every count that was in that pool is
+                # counted again in a thread, the first one to get here switches the pool over
+                if executor is self._executor:
+                    logging.exception('The election worker pool broke, falling back to threads')
+                    self.stop()
+                    self.use_processes = False
+                    self.start()
+
+    async def _run(self, executor, method, candidates, ballots, n_winners, reweight):
+        await self._semaphore.acquire()
+        try:
+            future = self._submit(executor, method, candidates, ballots, n_winners, reweight)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        # the slot is only given back once the count has really finished, a count that timed out is still running
+        # in its worker and keeps the slot until it's done (so given up counts can't pile up in the pool)
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda _: self._release(loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise ElectionTimeout(f'Counting the election took longer than {self.timeout}s') from None
+
+    def _release(self, loop):
+        # called from the pool's own thread when a count finishes
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(self._semaphore.release)
+
+    def _submit(self, executor, method, candidates, ballots, n_winners, reweight):
+        # start counting in the pool, returns the concurrent.futures.Future for the result
+        ballots = np.asarray(ballots)
+        if not isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            return executor.submit(_count, method, candidates, ballots, n_winners, reweight)
+
+        # copy the ballots straight into shared memory (in one go, even if they're a slice of a bigger array),
+        # the worker reads them from there
+        shape, dtype = ballots.shape, ballots.dtype
+        shm = shared_memory.SharedMemory(create=True, size=max(ballots.size * dtype.itemsize, 1))
+        try:
+            np.copyto(np.ndarray(shape, dtype=dtype, buffer=shm.buf), ballots)
+            future = executor.submit(_count_shared, method, candidates, shm.name, shape, dtype.str, n_winners, reweight)
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+
+        # the shared memory is only let go of once the worker is done with it (even if the count was given up on)
+        def unlink(_):
+            shm.close()
+            shm.unlink()
+        future.add_done_callback(unlink)
+        return future
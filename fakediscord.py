@@ -0,0 +1,426 @@
+# This file stands in for discord, so the bot can be driven without connecting to anything
+# the fakes cover the bits of discord the bot touches (channels, messages, users and interactions), and the helpers
+# below press the bot's commands and ballot components the way a user would
+# run on its own it checks the shard routing end to end: `python fakediscord.py --shards 4 --processes 2 --guilds 12`
+# starts a process for each group of shards (just like running main.py with --shard-ids), sends every event to the
+# process that owns its guild, and checks that each process only ever holds its own guilds' polls, same-named polls in
+# different guilds are kept apart (even when an event reaches the wrong process), and everything comes back after a
+# restart
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+import registry
+
+
+def make_snowflake(rng):
+    # discord IDs keep their creation time above bit 22, which is what the shard is worked out from
+    return (int(rng.integers(0, 2**41)) << 22) | int(rng.integers(0, 2**22))
+
+
+class FakeUser:
+
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name or f'user{id}'
+
+
+class FakeMessage:
+
+    def __init__(self, channel, id, content=None, embed=None, view=None):
+        self.channel = channel
+        self.id = id
+        self.content = content
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, **kwargs):
+        await self.channel.round_trip()
+        self.channel.edits.append((self.id, kwargs))
+        for name in ('content', 'embed', 'view'):
+            if name in kwargs:
+                setattr(self, name, kwargs[name])
+        return self
+
+
+class FakeChannel:
+
+    _ids = itertools.count(1)
+
+    def __init__(self, id, guild_id=None, latency=0):
+        self.id = id
+        self.guild_id = guild_id
+        self.latency = latency          # seconds every request to discord takes, so requests overlap like they would for real
+        self.messages = {}              # message ID -> FakeMessage
+        self.sent = []                  # content of everything sent to the channel, in order
+        self.edits = []                 # (message ID, edit arguments) for every edit
+
+    async def round_trip(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send(self, content=None, embed=None, view=None, **kwargs):
+        await self.round_trip()
+        self.sent.append(content)
+        return self._post(content, embed, view)
+
+    def _post(self, content=None, embed=None, view=None):
+        message = FakeMessage(self, next(self._ids), content, embed, view)
+        self.messages[message.id] = message
+        return message
+
+    def get_partial_message(self, id):
+        return self.messages.get(id) or FakeMessage(self, id)
+
+
+def held_views(client):
+    # how many views discord.py is holding on to: the ones in its view store, plus any still waiting to time out
+    store = client._connection._view_store
+    waiting = [task for task in asyncio.all_tasks() if '__timeout_task_impl' in task.get_coro().__qualname__]
+    return len(store._synced_message_views) + sum(len(items) for items in store._views.values()) + len(waiting)
+
+
+class FakeResponse:
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    def _respond(self):
+        if self._done:
+            raise RuntimeError('This interaction has already been responded to')
+        self._done = True
+
+    async def send_message(self, content=None, embed=None, view=None, ephemeral=False, **kwargs):
+        self._respond()
+        await self.interaction.channel.round_trip()
+        message = self.interaction.channel._post(content, embed, view)
+        self.interaction.replies.append(message)
+        if not ephemeral:
+            self.interaction.channel.sent.append(content)
+        # discord.py gives an ephemeral view with no timeout a 15 minute one, then keeps it like any other
+        if view is not None and not view.is_finished():
+            if ephemeral and view.timeout is None:
+                view.timeout = 15 * 60.0
+            self.interaction.store_view(view, message.id)
+
+    async def edit_message(self, content=None, embed=None, view=None, **kwargs):
+        self._respond()
+        await self.interaction.channel.round_trip()
+        self.interaction.replies.append(FakeMessage(self.interaction.channel, None, content, embed, view))
+        self.interaction.store_view(view, None)
+
+    async def defer(self, **kwargs):
+        self._respond()
+        await self.interaction.channel.round_trip()
+
+
+class FakeFollowup:
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, embed=None, view=None, ephemeral=False, **kwargs):
+        await self.interaction.channel.round_trip()
+        message = self.interaction.channel._post(content, embed, view)
+        self.interaction.replies.append(message)
+        if not ephemeral:
+            self.interaction.channel.sent.append(content)
+        self.interaction.store_view(view, message.id)
+        return message
+
+
+class FakeInteraction:
+
+    def __init__(self, client, user, channel):
+        self.client = client
+        self.user = user
+        self.channel = channel
+        self.guild_id = channel.guild_id
+        self.replies = []               # every message (or message edit) sent back to the user, in order
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def original_response(self):
+        return self.replies[0]
+
+    def store_view(self, view, message_id):
+        # the views sent back get kept in the client's real view store, under the same rules discord.py uses
+        if view is not None and not view.is_finished() and view.is_dispatchable():
+            self.client._connection.store_view(view, message_id)
+
+    @property
+    def reply_text(self):
+        return '\n'.join(reply.content for reply in self.replies if reply.content)
+
+
+# driving the bot
+
+async def run_command(client, command, user, channel, **kwargs):
+    # run one of the bot's slash commands, returns the interaction so the replies can be looked at
+    interaction = FakeInteraction(client, user, channel)
+    await client.tree.get_command(command).callback(interaction, **kwargs)
+    return interaction
+
+
+async def press(client, user, channel, custom_id, value=None):
+    # press a button (or pick a value from a select menu) on one of the bot's stateless ballots
+    import ui_elements
+    interaction = FakeInteraction(client, user, channel)
+    for cls in (ui_elements.RankSelect, ui_elements.ScoreSelect, ui_elements.DraftSubmit):
+        match = cls.__discord_ui_compiled_template__.fullmatch(custom_id)
+        if match is not None:
+            break
+    else:
+        raise ValueError(f'No component handles the custom_id {custom_id!r}')
+    item = await cls.from_custom_id(interaction, None, match)
+    if value is not None:
+        item.item._values = [value]
+    await item.callback(interaction)
+    return interaction
+
+
+async def fill_in(client, user, channel, views, ballot):
+    # pick everything on a stateless ballot (the views sent back for it), returns the custom_id of its submit button
+    # ballot is a ranking (1 for first choice, 0 for unranked) or STAR scores
+    # everything needed is in the custom_ids: ilvd:<kind>:<poll key>:...
+    submit = next(item.custom_id for item in views[-1].children if item.custom_id.startswith('ilvd:sb:'))
+    _, _, key, mode, _ = submit.split(':')
+    if views[0].children[0].custom_id.startswith('ilvd:rk:'):
+        # the ballots only have menus for the top 4 places
+        picks = ''.join(str(c) for c in np.argsort(ballot, kind='stable') if ballot[c] > 0)[:4]
+        for place in range(len(picks)):
+            await press(client, user, channel, f'ilvd:rk:{key}:{mode}:{picks[:place]}', picks[place])
+        return f'ilvd:sb:{key}:{mode}:{picks}'
+    for ci, score in enumerate(ballot):
+        if score:
+            await press(client, user, channel, f'ilvd:sc:{key}:{ci}', str(int(score)))
+    return submit
+
+
+async def vote(client, user, channel, name, ballot, amend=False):
+    # ask for a ballot with /getballot (or /amendballot), fill it in and submit it, returns the submit interaction
+    interaction = await run_command(client, 'amendballot' if amend else 'getballot', user, channel, name=name)
+    views = [reply.view for reply in interaction.replies if reply.view is not None]
+    if not views:
+        return interaction
+    return await press(client, user, channel, await fill_in(client, user, channel, views, ballot))
+
+
+# one shard process, run by the gateway
+
+def shard_process(shard_ids, shard_count, workdir, conn):
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    main.make_client(shard_ids, shard_count)
+    # the shard processes are daemons, which can't start worker processes of their own, so the elections get counted in threads
+    main.client.elections.use_processes = False
+    asyncio.run(_serve(main, conn))
+
+
+async def _serve(main, conn):
+    client = main.client
+    channels = {}
+
+    def get_channel(id, guild_id=None, **kwargs):
+        if id not in channels:
+            channels[id] = FakeChannel(id, guild_id)
+        # restored polls ask for their channel without saying which guild it's in
+        if guild_id is not None:
+            channels[id].guild_id = guild_id
+        return channels[id]
+
+    # restored polls ask the client for their channel, they get a fake one too
+    client.get_partial_messageable = get_channel
+    client.outbox.start()
+    client.ingest.start()
+    client.elections.start()
+    main.restore_polls()
+
+    loop = asyncio.get_running_loop()
+    while True:
+        event = await loop.run_in_executor(None, conn.recv)
+        kind = event['kind']
+        if kind == 'stop':
+            client.ingest.stop()
+            for poll in client.polls.values():
+                poll.store.close_journal()
+            client.elections.stop()
+            conn.send(dict(ok=True))
+            return
+        if kind == 'dump':
+            conn.send(dict(ok=True, polls=[(poll.guild_id, poll.name, poll.n_votes) for poll in client.polls.values()],
+                           path=client.polls.path))
+            continue
+
+        # events go to the bot as they are, even ones the gateway sent to the wrong process
+        channel = get_channel(event['channel_id'], event['guild_id'])
+        user = FakeUser(event['user_id'])
+        try:
+            if kind == 'vote':
+                interaction = await vote(client, user, channel, event['name'], event['ballot'], event.get('amend', False))
+            else:
+                interaction = await run_command(client, kind, user, channel, **event.get('options', {}))
+            conn.send(dict(ok=True, reply=interaction.reply_text, channel=list(channel.sent)))
+        except KeyError as e:
+            # there's no such poll here
+            conn.send(dict(ok=False, error=repr(e)))
+        except Exception as e:
+            logging.exception(f'Error while handling {event}')
+            conn.send(dict(ok=False, error=repr(e)))
+
+
+class FakeGateway:
+
+    def __init__(self, shard_count, n_processes, workdir):
+        self.shard_count = shard_count
+        # the shards are dealt out to the processes like cards
+        self.splits = [list(range(shard_count))[i::n_processes] for i in range(n_processes)]
+        self.workdir = workdir
+        self.processes = []
+        self.conns = []
+
+    def start(self):
+        # spawned rather than forked, so every process imports the bot fresh like a real separate process would
+        ctx = multiprocessing.get_context('spawn')
+        for shard_ids in self.splits:
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=shard_process, args=(shard_ids, self.shard_count, self.workdir, child), daemon=True)
+            process.start()
+            self.processes.append(process)
+            self.conns.append(parent)
+
+    def stop(self):
+        for conn in self.conns:
+            conn.send(dict(kind='stop'))
+            conn.recv()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.conns = []
+
+    def process_for(self, guild_id):
+        shard = registry.shard_of(guild_id, self.shard_count)
+        return next(i for i, shard_ids in enumerate(self.splits) if shard in shard_ids)
+
+    def send(self, event, process=None):
+        # send an event to the process that owns its guild (or to the one given), and wait for it to be handled
+        if process is None:
+            process = self.process_for(event['guild_id'])
+        self.conns[process].send(event)
+        return self.conns[process].recv()
+
+    def dump(self):
+        return [self.send(dict(kind='dump'), process) for process in range(len(self.conns))]
+
+
+def check_routing(shard_count, n_processes, n_guilds, n_voters, seed=0):
+    # returns a list of everything that went wrong (empty if it all worked)
+    rng = np.random.default_rng(seed)
+    problems = []
+    guilds = [make_snowflake(rng) for _ in range(n_guilds)]
+    channels = {guild: make_snowflake(rng) for guild in guilds}
+    types = ['STV', 'STAR', 'CONDORCET']
+    expected = {}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        gateway = FakeGateway(shard_count, n_processes, workdir)
+        gateway.start()
+        try:
+            # every guild gets a poll with the same name (and some get a second one)
+            for i, guild in enumerate(guilds):
+                names = ['lunch'] if i % 2 else ['lunch', 'dinner']
+                for name in names:
+                    poll_type = types[(i + len(name)) % len(types)]
+                    res = gateway.send(dict(kind='newpoll', guild_id=guild, channel_id=channels[guild], user_id=1,
+                                            options=dict(name=name, choice1='a', choice2='b', choice3='c', poll_type=poll_type)))
+                    if not res['ok']:
+                        problems.append(f'newpoll {name} in guild {guild}: {res["error"]}')
+                    expected[guild, name] = (poll_type, 0)
+
+            # a different number of voters in each poll, so mixed up polls would show
+            for (guild, name), (poll_type, _) in expected.items():
+                n = int(rng.integers(1, n_voters + 1))
+                for user in range(n):
+                    ballot = rng.integers(0, 6, 3) if poll_type == 'STAR' else rng.permutation(3) + 1
+                    res = gateway.send(dict(kind='vote', guild_id=guild, channel_id=channels[guild], user_id=100 + user,
+                                            name=name, ballot=ballot.tolist()))
+                    if not res['ok'] or 'Thanks' not in res['reply']:
+                        problems.append(f'vote in {name} of guild {guild} was not taken: {res}')
+                expected[guild, name] = (poll_type, n)
+
+            # events sent to the wrong process mustn't find that process's own poll of the same name (every guild has
+            # a "lunch" poll), the poll isn't there so they fail and nothing changes (the vote counts are checked below)
+            if n_processes > 1:
+                guild = guilds[0]
+                wrong = (gateway.process_for(guild) + 1) % n_processes
+                if not any(name == 'lunch' for _, name, _ in gateway.dump()[wrong]['polls']):
+                    problems.append(f'process {wrong} has no "lunch" poll to mix up guild {guild}\'s with')
+                for kind, extra in [('pollstatus', dict(options=dict(name='lunch'))),
+                                    ('vote', dict(name='lunch', ballot=[1, 2, 3], amend=True, user_id=100)),
+                                    ('closepoll', dict(options=dict(name='lunch')))]:
+                    event = dict(dict(kind=kind, guild_id=guild, channel_id=channels[guild], user_id=1), **extra)
+                    res = gateway.send(event, process=wrong)
+                    if res['ok']:
+                        problems.append(f'process {wrong} handled a {kind} for guild {guild}, which is not on its shards: {res}')
+
+            for restart in (False, True):
+                if restart:
+                    gateway.stop()
+                    gateway.start()
+                seen = {}
+                for process, dump in enumerate(gateway.dump()):
+                    for guild, name, n_votes in dump['polls']:
+                        if gateway.process_for(guild) != process:
+                            problems.append(f'process {process} holds poll {name} of guild {guild}, which is on another shard')
+                        seen[guild, name] = n_votes
+                for key, (_, n) in expected.items():
+                    if seen.get(key) != n:
+                        problems.append(f'poll {key[1]} of guild {key[0]} has {seen.get(key)} votes, expected {n}'
+                                        + (' after a restart' if restart else ''))
+
+            # close everything, every poll has to post its own results
+            for (guild, name), (poll_type, n) in expected.items():
+                res = gateway.send(dict(kind='closepoll', guild_id=guild, channel_id=channels[guild], user_id=1,
+                                        options=dict(name=name)))
+                if not res['ok'] or not any('I LOVE DEMOCRACY' in (sent or '') for sent in res['channel']):
+                    problems.append(f'closing {name} in guild {guild} did not post the results: {res}')
+            for process, dump in enumerate(gateway.dump()):
+                if dump['polls']:
+                    problems.append(f'process {process} still has polls open after they were all closed: {dump["polls"]}')
+        finally:
+            gateway.stop()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the shard routing against a fake discord gateway')
+    parser.add_argument('--shards', type=int, default=4, help='total number of shards')
+    parser.add_argument('--processes', type=int, default=2, help='processes to split the shards across')
+    parser.add_argument('--guilds', type=int, default=12)
+    parser.add_argument('--voters', type=int, default=20, help='most voters in each poll')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    problems = check_routing(args.shards, args.processes, args.guilds, args.voters, args.seed)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print(f'{args.guilds} guilds across {args.shards} shards in {args.processes} processes: everything went where it should')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# This file batches up the ballots coming in, so a burst of votes (say right after a poll is announced) doesn't mean a
+# journal write and a log line for every single one. Polls take each ballot straight away and keep it pending, and the
+# queue commits every poll's pending ballots together a few milliseconds later (or as soon as a poll has a full batch)
+import asyncio
+import logging
+
+
+class IngestQueue:
+
+    def __init__(self, interval=0.005, batch_size=256):
+        self.interval = interval                        # seconds to let ballots pile up before they're committed
+        self.batch_size = batch_size                    # a poll with this many pending ballots is committed right away
+        self._dirty = {}                                # polls with pending ballots (a dict so they're committed in order)
+        self._wakeup = asyncio.Event()                  # set when a poll gets its first pending ballot
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # nothing pending gets left behind
+        self.flush_all()
+
+    @property
+    def depth(self):
+        # number of ballots waiting to be committed
+        return sum(len(poll.pending) for poll in self._dirty)
+
+    def add(self, poll):
+        # called by a poll after it takes a ballot
+        if len(poll.pending) >= self.batch_size:
+            self.flush(poll)
+            return
+        self._dirty[poll] = None
+        self._wakeup.set()
+
+    def flush(self, poll):
+        self._dirty.pop(poll, None)
+        poll.flush_ballots()
+
+    def flush_all(self):
+        while self._dirty:
+            poll = next(iter(self._dirty))
+            try:
+                self.flush(poll)
+            except Exception:
+                logging.exception(f'Error while committing the ballots for the poll "{poll.name}"')
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            # give everyone else voting right now a moment to get their ballots in, they all go in the same commit
+            await asyncio.sleep(self.interval)
+            self._wakeup.clear()
+            self.flush_all()
@@ -0,0 +1,210 @@
+# This file load-tests the whole bot offline: a poll is made with /newpoll, then thousands of fake users press its
+# "Get your ballot!" button, fill in their ballots and submit them all at once, and finally the poll is closed
+# everything goes through the real command and component callbacks, only discord itself is faked (see fakediscord.py)
+# e.g. `python loadtest.py --voters 5000 --concurrency 500 --type STV --ballots view`
+# it reports ballots/sec, the submit latency, how much memory the bot grew by and how long the close took,
+# and exits with 1 if the poll didn't end up with exactly one ballot per voter (or let anyone vote twice), or if the
+# stateless ballots left views behind in discord.py's view store
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import fakediscord
+import simulate
+
+
+def max_rss():
+    # peak resident memory of this process so far, in bytes (linux reports it in KiB, macOS in bytes)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+async def fill_in_view(client, user, channel, views, ballot):
+    # pick everything on a ballot made of View objects (STATELESS_BALLOTS = False), returns its submit button
+    import ui_elements
+    if isinstance(views[0], ui_elements.STVView):
+        view = views[0]
+        picks = [c for c in np.argsort(ballot, kind='stable') if ballot[c] > 0][:len(view.select_menus)]
+        for place, ci in enumerate(picks):
+            # each pick adds the menu for the next place
+            menu = view.select_menus[place]
+            menu._values = [str(ci)]
+            await menu.callback(fakediscord.FakeInteraction(client, user, channel))
+        return view.submit_btn
+    for view in views:
+        for item in view.children:
+            if isinstance(item, ui_elements.STARScoreSelect) and ballot[item.ci]:
+                item._values = [str(int(ballot[item.ci]))]
+                await item.callback(fakediscord.FakeInteraction(client, user, channel))
+    return views[-1].submit_btn
+
+
+class LoadTest:
+
+    def __init__(self, main, channel, n_cands, poll_type, ballot_kind):
+        self.main = main
+        self.client = main.client
+        self.channel = channel
+        self.n_cands = n_cands
+        self.poll_type = poll_type
+        self.ballot_kind = ballot_kind          # 'stateless' or 'view'
+        self.poll = None
+        self.latencies = []                     # seconds each submit took to be answered
+        self.accepted = 0                       # submits answered with a thank you
+        self.rejected = 0                       # submits turned away (second ballots from the same voter)
+
+    async def new_poll(self, name):
+        choices = {f'choice{i+1}': f'option {i+1}' for i in range(self.n_cands)}
+        creator = fakediscord.FakeUser(1)
+        await fakediscord.run_command(self.client, 'newpoll', creator, self.channel, name=name, poll_type=self.poll_type,
+                                      **choices)
+        self.poll = self.main.polls[self.channel.guild_id, name]
+
+    async def get_ballot(self, user, amend=False):
+        # press the ballot button on the poll (or use /amendballot), returns the ballot's views
+        if amend:
+            interaction = await fakediscord.run_command(self.client, 'amendballot', user, self.channel, name=self.poll.name)
+        else:
+            interaction = fakediscord.FakeInteraction(self.client, user, self.channel)
+            await self.poll.buttons[0].callback(interaction)
+        return [reply.view for reply in interaction.replies if reply.view is not None]
+
+    async def submit(self, user, views, ballot):
+        if self.ballot_kind == 'stateless':
+            custom_id = await fakediscord.fill_in(self.client, user, self.channel, views, ballot)
+            t0 = time.perf_counter()
+            interaction = await fakediscord.press(self.client, user, self.channel, custom_id)
+        else:
+            button = await fill_in_view(self.client, user, self.channel, views, ballot)
+            interaction = fakediscord.FakeInteraction(self.client, user, self.channel)
+            t0 = time.perf_counter()
+            await button.callback(interaction)
+        self.latencies.append(time.perf_counter() - t0)
+        if 'Thanks' in interaction.reply_text:
+            self.accepted += 1
+        else:
+            self.rejected += 1
+
+    async def voter(self, semaphore, user, ballot, amended, double):
+        async with semaphore:
+            # a double voter asks for two ballots before submitting either, only one of them may count
+            ballots = [await self.get_ballot(user) for _ in range(2 if double else 1)]
+            for views in ballots:
+                if views:
+                    await self.submit(user, views, ballot)
+            if amended is not None:
+                views = await self.get_ballot(user, amend=True)
+                await self.submit(user, views, amended)
+
+
+async def run(args):
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    main.STATELESS_BALLOTS = args.ballots == 'stateless'
+    client = main.make_client()
+    client.outbox.start()
+    client.ingest.start()
+    client.elections.start()
+    client.metrics.watch_loop_lag(client.metrics.loop_lag_seconds, interval=0.05)
+
+    rng = np.random.default_rng(args.seed)
+    ballots = simulate.make_ballots(rng, args.model, args.type, args.voters, args.candidates, depth=args.depth).T
+    amends = simulate.make_ballots(rng, args.model, args.type, args.voters, args.candidates, depth=args.depth).T
+    is_amended = rng.random(args.voters) < args.amend
+    is_double = rng.random(args.voters) < args.double
+
+    channel = fakediscord.FakeChannel(fakediscord.make_snowflake(rng), fakediscord.make_snowflake(rng), latency=args.latency)
+    test = LoadTest(main, channel, args.candidates, args.type, args.ballots)
+    await test.new_poll('loadtest')
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss0 = max_rss()
+    views0 = fakediscord.held_views(client)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    t0 = time.perf_counter()
+    await asyncio.gather(*(test.voter(semaphore, fakediscord.FakeUser(1000 + i), ballots[i],
+                                      amends[i] if is_amended[i] else None, is_double[i]) for i in range(args.voters)))
+    # the last batch of ballots goes in when the ingest queue next wakes up
+    client.ingest.flush(test.poll)
+    wall = time.perf_counter() - t0
+    traced = tracemalloc.get_traced_memory() if args.tracemalloc else None
+    rss1 = max_rss()
+    views1 = fakediscord.held_views(client)
+
+    poll = test.poll
+    n_votes = poll.n_votes
+    t1 = time.perf_counter()
+    await fakediscord.run_command(client, 'closepoll', fakediscord.FakeUser(1), channel, name=poll.name)
+    close_seconds = time.perf_counter() - t1
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    latencies = np.array(test.latencies)
+    print(f'{args.voters} voters ({args.type}, {args.candidates} candidates, {args.ballots} ballots), '
+          f'{args.concurrency} at a time, {args.latency*1000:g} ms simulated latency')
+    print(f'submits: {len(latencies)} ({test.accepted} taken, {test.rejected} turned away) in {wall:.2f}s, '
+          f'{test.accepted / wall:.0f} ballots/sec')
+    print(f'submit latency: p50 {np.percentile(latencies, 50)*1000:.2f} ms, p99 {np.percentile(latencies, 99)*1000:.2f} ms, '
+          f'max {latencies.max()*1000:.2f} ms')
+    print(f'memory: peak RSS grew by {(rss1 - rss0)/2**20:.1f} MiB to {rss1/2**20:.1f} MiB'
+          + (f', python allocations now {traced[0]/2**20:.1f} MiB (peak {traced[1]/2**20:.1f} MiB)' if traced else ''))
+    print(f'views held by discord.py: {views0} before voting, {views1} after')
+    print(f'close: {close_seconds:.3f}s')
+    for line in client.metrics.summary():
+        if line.startswith(('ilovedemocracy_event_loop_lag', 'ilovedemocracy_submit_seconds', 'ilovedemocracy_election_seconds')):
+            print(line)
+
+    ok = True
+    if n_votes != args.voters:
+        print(f'The poll has {n_votes} votes, but there were {args.voters} voters')
+        ok = False
+    if test.rejected != np.sum(is_double):
+        print(f'{test.rejected} ballots were turned away, but {np.sum(is_double)} voters tried to vote twice')
+        ok = False
+    if args.ballots == 'stateless' and views1 > views0:
+        # stateless ballots live in their custom_ids, nothing should be kept around for each voter
+        print(f'discord.py is holding on to {views1 - views0} more views after {len(latencies)} ballots')
+        ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the bot against fake discord users')
+    parser.add_argument('--voters', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200, help='voters going through their ballots at the same time')
+    parser.add_argument('--candidates', type=int, default=5, help='up to 9, the most /newpoll takes')
+    parser.add_argument('--type', choices=['STV', 'STAR', 'CONDORCET'], default='STV')
+    parser.add_argument('--ballots', choices=['stateless', 'view'], default='stateless',
+                        help='stateless ballots (the default) or the View-based ones')
+    parser.add_argument('--model', choices=simulate.MODELS, default='spatial', help='voter model the ballots are drawn from')
+    parser.add_argument('--depth', type=int, default=0, help='how many candidates each ranked ballot ranks (0 for all of them)')
+    parser.add_argument('--amend', type=float, default=0.05, help='fraction of voters who amend their ballot afterwards')
+    parser.add_argument('--double', type=float, default=0.02, help='fraction of voters who try to vote twice')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds each (fake) request to discord takes')
+    parser.add_argument('--tracemalloc', action='store_true', help='also track python allocations (slows everything down)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # the bot writes its registry and ballot files to the working directory, so they go somewhere disposable
+    workdir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        os.chdir(tmpdir)
+        try:
+            ok = asyncio.run(run(args))
+        finally:
+            os.chdir(workdir)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,48 +2,123 @@ from typing import Optional
 import datetime
 import time
 import asyncio
+import secrets
 import logging
 import logging.handlers
+import argparse
+import functools
 
 import numpy as np
 import discord
 from discord import app_commands
-from discord.ext import tasks
 
 import ui_elements
 import rcv
 import star
-
-# make a separate 'info.txt' file with your 
-# token on the first line
-with open('info.txt', 'r') as file:
-    TOKEN = file.readline()
-
-# set up basic logging
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logformatter = logging.Formatter('%(asctime)s -- %(levelname)s: (%(threadName)-10s) Module: %(module)s | Function: %(funcName)s | Message: %(message)s',
-                                 datefmt='%Y-%m-%d %H:%M:%S%z')
-
-filehandler = logging.handlers.RotatingFileHandler('iLoveDemocracy.log', maxBytes=10000000, backupCount=3)
-filehandler.setFormatter(logformatter)
-logger.addHandler(filehandler)
-
-streamhandler = logging.StreamHandler()
-streamhandler.setFormatter(logformatter)
-logger.addHandler(streamhandler)
-
-
-
-class Palpy(discord.Client):
-
-    def __init__(self):
+import condorcet
+import ballot_store
+import scheduler
+import outbox
+import registry
+import metrics
+import election_pool
+import ingest
+
+# hand out ballots whose components keep their state in their custom_id (plus a tiny per-voter draft for STAR),
+# instead of keeping a View object alive for every voter
+STATELESS_BALLOTS = True
+
+# set to a port number (e.g. 9108) to serve the bot's metrics on http://127.0.0.1:<port>/metrics for Prometheus,
+# they can always be looked at with /metrics
+METRICS_PORT = None
+
+# elections are counted in worker processes (or threads if those aren't available) so closing a big poll doesn't
+# hold up the bot, at most ELECTION_CONCURRENCY are counted at once and any that take over ELECTION_TIMEOUT seconds are
+# given up on (the ballots are still archived, so they can be counted later with tally.py)
+ELECTION_WORKERS = None
+ELECTION_CONCURRENCY = 2
+ELECTION_TIMEOUT = 600
+
+# /pollstatus recounts an open poll at most this often (in seconds), in between it shows the last count
+PROJECTION_DEBOUNCE = 30
+
+# the bot connects with as many shards as discord recommends, all in this process, unless these are set
+# to split them up, e.g. SHARD_COUNT = 4 with SHARD_IDS = [0, 1] in one process and [2, 3] in another
+# (they can also be given on the command line, see `python main.py --help`)
+SHARD_COUNT = None
+SHARD_IDS = None
+
+def setup_logging():
+    # log to iLoveDemocracy.log and the console, only done by the process running the bot
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logformatter = logging.Formatter('%(asctime)s -- %(levelname)s: (%(threadName)-10s) Module: %(module)s | Function: %(funcName)s | Message: %(message)s',
+                                     datefmt='%Y-%m-%d %H:%M:%S%z')
+
+    filehandler = logging.handlers.RotatingFileHandler('iLoveDemocracy.log', maxBytes=10000000, backupCount=3)
+    filehandler.setFormatter(logformatter)
+    logger.addHandler(filehandler)
+
+    streamhandler = logging.StreamHandler()
+    streamhandler.setFormatter(logformatter)
+    logger.addHandler(streamhandler)
+
+
+def timed(command):
+    # times a slash command with the metrics of whichever client is running it
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(interaction, *args, **kwargs):
+            with interaction.client.metrics.command_seconds.time(command=command):
+                return await func(interaction, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Palpy(discord.AutoShardedClient):
+
+    def __init__(self, shard_ids=None, shard_count=None):
         intents = discord.Intents.default()
         intents.reactions = True
-        super().__init__(intents=intents)
+        super().__init__(intents=intents, shard_ids=shard_ids, shard_count=shard_count)
         self.synced = False
         self.tree = app_commands.CommandTree(self)
         self.tree.clear_commands(guild=None)
+        self.scheduler = scheduler.PollScheduler(refresh_interval=60)   # closes polls and refreshes their embeds
+        self.outbox = outbox.Outbox()                                   # every message send/edit outside of interaction responses
+        self.polls = registry.PollRegistry('polls.json', shard_ids, shard_count)   # every open poll in this process's guilds
+        self.drafts = ui_elements.BallotDrafts(ttl=3600)                # STAR scores picked on stateless ballots, until submitted
+        self.ingest = ingest.IngestQueue()                              # commits incoming ballots in batches
+        self.elections = election_pool.ElectionPool(ELECTION_WORKERS, ELECTION_CONCURRENCY, ELECTION_TIMEOUT)   # counts closed polls
+        self.metrics = metrics.BotMetrics()                             # command latency, ballot rates, event loop lag...
+        self.metrics.outbox_depth.set_function(lambda: self.outbox.depth)
+        self.metrics.ingest_depth.set_function(lambda: self.ingest.depth)
+        self.metrics.open_polls.set_function(lambda: len(self.polls))
+
+    async def setup_hook(self):
+        self.add_dynamic_items(ui_elements.RankSelect, ui_elements.ScoreSelect, ui_elements.DraftSubmit)
+        self.outbox.start()
+        self.ingest.start()
+        self.scheduler.start()
+        self.elections.start()
+        self.metrics.watch_loop_lag(self.metrics.loop_lag_seconds)
+        if METRICS_PORT is not None:
+            await self.metrics.serve(port=METRICS_PORT)
+        restore_polls()
+
+    def set_shards(self, shard_ids, shard_count):
+        # run only these shards in this process (before the bot starts), the other processes run the rest
+        if shard_ids is not None and shard_count is None:
+            raise discord.ClientException('A shard count is needed to run only some of the shards')
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.polls.set_shards(shard_ids, shard_count)
+
+    async def close(self):
+        # ballots still waiting for the next batch get written out before the bot goes down
+        self.ingest.stop()
+        self.elections.stop()
+        await super().close()
 
     async def on_ready(self):
         await self.wait_until_ready()
@@ -53,47 +128,95 @@ class Palpy(discord.Client):
         logging.info(f'Bot has logged in as {self.user}')
 
 
-client = Palpy()
-polls = {}
+# the election worker processes import this file again (as __mp_main__), so the bot itself is only made by make_client,
+# which whatever runs the bot calls
+client = None
+polls = None
+
+
+def make_client(shard_ids=None, shard_count=None):
+    global client, polls
+    client = Palpy()
+    client.set_shards(shard_ids, shard_count)
+    polls = client.polls
+    for command in (newpoll, getballot, amendballot, closepoll, pollstatus, show_metrics):
+        client.tree.add_command(command)
+    return client
 
 
 # I hate this
-@client.tree.command(name='newpoll', description='Set up a new poll')
+@app_commands.command(name='newpoll', description='Set up a new poll')
+@timed('newpoll')
 async def newpoll(interaction, name: str, choice1: str, choice2: Optional[str] = None,
                   choice3: Optional[str] = None, choice4: Optional[str] = None, choice5: Optional[str] = None,
                   choice6: Optional[str] = None, choice7: Optional[str] = None, choice8: Optional[str] = None,
                   choice9: Optional[str] = None, time_limit: Optional[float] = 24., description: Optional[str] = None, 
-                  poll_type: Optional[str] = 'STAR', winners: Optional[int] = 1):
+                  poll_type: Optional[str] = 'STAR', winners: Optional[int] = 1, reweight: Optional[bool] = False):
     global polls
+    # a second poll with the same name would take over the first one's registry entry and ballot files
+    if (interaction.guild_id, name) in polls:
+        await interaction.response.send_message(f'There is already an open poll called "{name}" here! '
+                                                'Please pick another name, or close that one first.', ephemeral=True)
+        return
     c_all = [choice1, choice2, choice3, choice4, choice5, choice6, choice7, choice8, choice9]
     choices = []
     for c in c_all:
         if c is not None:
             choices.append(c)
     newpoll = Poll(interaction.user.id, interaction.channel, name, description, choices, n_winners=winners, type=poll_type, 
-                   timeout=time_limit*3600)
+                   timeout=time_limit*3600, guild_id=interaction.guild_id, reweight=reweight)
     await interaction.response.send_message(embed=newpoll.embed, view=newpoll.view)
     message = await interaction.original_response()
-    newpoll.message = message
-    polls[name] = newpoll
-    newpoll.message_update_loop.start()
+    # hold on to a channel message rather than the interaction one, which expires after 15 mins,
+    # so the embed can be edited without fetching it again
+    newpoll.message = interaction.channel.get_partial_message(message.id)
+    polls.add(newpoll)
+    client.scheduler.add(newpoll)
     
-@client.tree.command(name='getballot', description='Get a ballot for the poll')
+@app_commands.command(name='getballot', description='Get a ballot for the poll')
+@timed('getballot')
 async def getballot(interaction, name: str):
 
     # Get the poll we want a ballot for
-    poll = polls[name]
+    poll = polls[interaction.guild_id, name]
     logging.info(f'{interaction.user.id} has requested a ballot for the poll "{name}"')
 
     # Keep track of the user who requested a ballot - only one per user!
-    if interaction.user.id in poll.voters:
-        await interaction.response.send_message("Sorry, you've already voted in this poll. Only one ballot per person!", ephemeral=True)
+    if poll.has_voted(interaction.user.id):
+        await interaction.response.send_message("Sorry, you've already voted in this poll. Only one ballot per person! " + \
+                                                f"If you want to change your vote, use `/amendballot {name}`.", ephemeral=True)
         return
-    
-    # check what type of poll we're dealing with
-    if poll.type == 'STV':
 
-        ballot_view = ui_elements.STVView(n=len(poll.choices), poll=poll, choices=poll.choices)
+    await send_ballot(interaction, poll)
+
+
+@app_commands.command(name='amendballot', description='Get a new ballot to replace the one you already cast')
+@timed('amendballot')
+async def amendballot(interaction, name: str):
+
+    poll = polls[interaction.guild_id, name]
+    logging.info(f'{interaction.user.id} has requested to amend their ballot for the poll "{name}"')
+
+    if not poll.has_voted(interaction.user.id):
+        await interaction.response.send_message("You haven't voted in this poll yet, so here's a regular ballot.", ephemeral=True)
+        await send_ballot(interaction, poll, followup=True)
+        return
+
+    await send_ballot(interaction, poll, amend=True)
+
+
+async def send_ballot(interaction, poll, amend=False, followup=False):
+
+    # the first message either answers the interaction or (if it has already been answered) is a followup
+    send = interaction.followup.send if followup else interaction.response.send_message
+
+    # check what type of poll we're dealing with (Condorcet polls use the same ranked ballots as STV)
+    if poll.ranked:
+
+        if STATELESS_BALLOTS:
+            ballot_view = ui_elements.make_stv_ballot_view(poll, amend=amend)
+        else:
+            ballot_view = ui_elements.STVView(n=len(poll.choices), poll=poll, choices=poll.choices, amend=amend)
 
         description = f"""
         **{poll.name}**:
@@ -111,20 +234,23 @@ async def getballot(interaction, name: str):
         the poll results will be announced in a separate message.\n
         """
 
-        await interaction.response.send_message(description, view=ballot_view, ephemeral=True)
+        await send(description, view=ballot_view, ephemeral=True)
         return
     
     elif poll.type == 'STAR':
 
-        container = ui_elements.STAR(n=len(poll.choices), poll=poll, choices=poll.choices)
+        if STATELESS_BALLOTS:
+            views = ui_elements.make_star_ballot_views(poll, amend=amend)
+        else:
+            views = ui_elements.STARBallot(n=len(poll.choices), poll=poll, choices=poll.choices, amend=amend).views
 
         description = f"""
         **{poll.name}**
 
         Please rate your choices on a scale of 0-5 stars using the
-        following buttons. A score of 5 stars is the best and 0 stars
-        is the worst (to give a candidate 0 stars, simply don't press
-        any buttons for them). You are allowed to give multiple
+        following drop-down menus. A score of 5 stars is the best and 
+        0 stars is the worst (to give a candidate 0 stars, simply leave
+        their menu alone). You are allowed to give multiple
         candidates the same score, if you support them equally.
 
         When finished, please submit using the submit button.
@@ -133,25 +259,19 @@ async def getballot(interaction, name: str):
         the poll results will be announced in a separate message.\n
         """
 
-        # description
-        await interaction.response.send_message(description, ephemeral=True)
-        # messages for each candidate
-        choice_messages = []
-        for i in range(container.n):
-            msg = await interaction.followup.send(container.choices[i], view=container.choice_views[i], ephemeral=True, wait=True)
-            choice_messages.append(msg)
-        # submit message
-        await interaction.followup.send(view=container.submit_view, ephemeral=True)
-        # need to set these so the submit button can disable them later
-        container.submit_view.choice_messages = choice_messages
+        # the whole ballot fits in one message, or two if there are more than 4 choices
+        await send(description, view=views[0], ephemeral=True)
+        if len(views) > 1:
+            await interaction.followup.send(view=views[1], ephemeral=True)
 
         return
 
 
-@client.tree.command(name='closepoll', description='Manually close a poll')
+@app_commands.command(name='closepoll', description='Manually close a poll')
+@timed('closepoll')
 async def closepoll(interaction, name: str):
 
-    poll = polls[name]
+    poll = polls[interaction.guild_id, name]
     if interaction.user.id != poll.creator:
         await interaction.response.send_message('Only the creator of the poll can close it!', ephemeral=True)
         return
@@ -161,26 +281,94 @@ async def closepoll(interaction, name: str):
     await poll.cleanup()
 
 
+@app_commands.command(name='pollstatus', description='See who would win a poll if it closed right now')
+@timed('pollstatus')
+async def pollstatus(interaction, name: str):
+
+    poll = polls[interaction.guild_id, name]
+    if poll.n_votes == 0:
+        await interaction.response.send_message(f'Nobody has voted in "{name}" yet!', ephemeral=True)
+        return
+
+    # counting a big poll can take a little while
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    try:
+        version, result = await poll.project()
+    except election_pool.ElectionTimeout:
+        await interaction.followup.send(f'Counting "{name}" is taking too long right now, sorry!', ephemeral=True)
+        return
+    except Exception:
+        # the reply was deferred, so it has to be answered either way
+        logging.exception(f'Could not count the projection for the poll "{name}"')
+        await interaction.followup.send(f'Something went wrong while counting "{name}", sorry!', ephemeral=True)
+        return
+
+    lines = [f'Projected winners of "{name}": {", ".join(result.winner_names)}',
+             f'Counted from {result.n_votes} votes']
+    if version != poll.version:
+        lines[-1] += f' ({poll.version - version} new or amended ballots since then will be in the next count)'
+    lines += result.summary()
+    for content in outbox.pack_code_blocks(['\n'.join(lines)]):
+        await interaction.followup.send(content, ephemeral=True)
+
+
+@app_commands.command(name='metrics', description='Show what the bot has been up to')
+@app_commands.guild_only()
+@app_commands.default_permissions(administrator=True)
+async def show_metrics(interaction):
+    # server admins only, and they only get to see their own server's polls
+    lines = client.metrics.summary(guild=interaction.guild_id)
+    # the first message answers the interaction, anything that doesn't fit goes in followups
+    messages = outbox.pack_code_blocks(['\n'.join(lines)]) if lines else ['Nothing to show yet!']
+    await interaction.response.send_message(messages[0], ephemeral=True)
+    for content in messages[1:]:
+        await interaction.followup.send(content, ephemeral=True)
+
+
 class Poll:
 
     def __init__(self, creator, channel, poll_name='Generic Poll', description=None, 
-                 poll_choices=None, n_winners=1, type='STAR', timeout=24*3600):
+                 poll_choices=None, n_winners=1, type='STAR', timeout=24*3600, created=None, store=None, key=None, guild_id=None,
+                 reweight=False):
         self.creator = creator                                      # the user ID of whoever made the poll
         self.channel = channel                                      # channel the poll is in
+        self.guild_id = guild_id                                    # server the poll is in (None for DMs), polls are named per server
         self.name = poll_name                                       # name of the poll
+        self.key = secrets.token_hex(4) if key is None else key     # short ID for the poll in component custom_ids
         self.choices = poll_choices                                 # initialize the choices/candidates
-        self.ballots = np.zeros((len(poll_choices),0), dtype=int)   # initialize an array for the ballots
-        self.voters = np.zeros((0,), dtype=int)                     # store user IDs for each voter
-        self.n_votes = 0
+        if store is None:
+            # the ballot files are named after the server too, so same-named polls in different servers don't share them
+            store_name = poll_name if guild_id is None else f'{guild_id}-{poll_name}'
+            store = ballot_store.BallotStore(store_name, len(poll_choices))
+        self.store = store                                          # holds the ballots and voter IDs
+        self.pending = {}                                           # ballots taken but not yet committed to the store, by voter ID
+        self._n_pending_new = 0                                     # how many of those are from voters not in the store yet
+        self.version = 0                                            # goes up with every ballot cast or amended
+        self._projection = None                                     # (version, result) of the last /pollstatus count
+        self._projection_task = None                                # the /pollstatus count running right now, if there is one
+        self._projected_at = None                                   # when the last /pollstatus count that worked was started
         self.n_winners = n_winners                                  # how many winners the poll will have (has no effect on STAR polls)
+        self.reweight = reweight                                    # if a multi-winner STAR poll reweights ballots instead of removing them
         self.timeout = timeout                                      # poll time limit in seconds
-        self.time0 = time.monotonic()                               # starting time of the poll
+        self.created = time.time() if created is None else created  # wall-clock creation time, so the deadline survives restarts
+        self.time0 = time.monotonic() - (time.time() - self.created)   # starting time of the poll
+        self.deadline = self.time0 + timeout                        # when the poll closes
         self.closed = False                                         # if the poll is closed
         self.embed = None                                           # will hold the embed
         self.view = None                                            # will hold the view 
         self.message = None                                         # will hold the message
         self.buttons = []                                           # will hold the buttons
+        self._embed_state = None                                    # what the embed last showed, so unchanged embeds aren't re-sent
         self.type = type
+        self.ranked = type in ('STV', 'CONDORCET')                  # if the ballots are rankings (rather than STAR scores)
+        # running count of how many voters gave each candidate each rank (or number of stars), updated as ballots come in
+        n_levels = len(poll_choices) + 1 if self.ranked else star.MAX_STARS + 1
+        self.tallies = np.zeros((len(poll_choices), n_levels), dtype=int)
+        # for Condorcet polls, pairwise[i, j] is how many voters ranked choice i above choice j, also kept up to date
+        self.pairwise = np.zeros((len(poll_choices), len(poll_choices)), dtype=int) if type == 'CONDORCET' else None
+        if self.n_votes > 0:
+            self.rebuild_tallies()
+        self.given_description = description                        # the description as the creator gave it
 
         notice = f'''\n
         To obtain your voting ballot for this poll, use the button at the bottom 
@@ -194,6 +382,12 @@ class Poll:
                 each of the options in the poll from your 1st most preferred choice to your least
                 preferred choice, and the end result will be calculated in a way that (hopefully)
                 makes the most people happy as possible.''' 
+            elif self.type == 'CONDORCET':
+                description = f'''
+                This is a Condorcet voting poll! You will be able to rank each of the options in the
+                poll from your 1st most preferred choice to your least preferred choice. Every option
+                is then compared head-to-head with every other one, and the option that beats the
+                others (by the Schulze method) wins.'''
             elif self.type == 'STAR':
                 description = f'''
                 This is a score voting poll! You will be able to rank each of the options in the
@@ -207,139 +401,306 @@ class Poll:
         self.make_button_view()
     
         logging.info(f'A new poll "{self.name}" has been created with the options {self.choices}')
+
+    def to_record(self):
+        # everything needed to bring the poll back after a restart (the ballots themselves are in the journal)
+        return dict(name=self.name, key=self.key, guild_id=self.guild_id, store=self.store.name, creator=self.creator, channel_id=self.channel.id,
+                    message_id=None if self.message is None else self.message.id,
+                    choices=list(self.choices), description=self.given_description, type=self.type,
+                    n_winners=self.n_winners, reweight=self.reweight, timeout=self.timeout, created=self.created)
+
+    @classmethod
+    def from_record(cls, record, channel):
+        # (polls saved before polls were kept per server have no guild, and their ballot files are just named after the poll)
+        store = ballot_store.BallotStore.recover(record.get('store', record['name']), len(record['choices']))
+        poll = cls(record['creator'], channel, record['name'], record['description'], record['choices'],
+                   n_winners=record['n_winners'], type=record['type'], timeout=record['timeout'],
+                   created=record['created'], store=store, key=record.get('key'), guild_id=record.get('guild_id'),
+                   reweight=record.get('reweight', False))
+        poll.message = channel.get_partial_message(record['message_id'])
+        return poll
+
+    @property
+    def ballots(self):
+        return self.store.ballots
+
+    @property
+    def voters(self):
+        return self.store.voters
+
+    @property
+    def n_votes(self):
+        return self.store.n_votes + self._n_pending_new
+
+    def has_voted(self, user_id):
+        return user_id in self.pending or self.store.has_voted(user_id)
+
+    def get_ballot(self, user_id):
+        ballot = self.pending.get(user_id)
+        return self.store.get_ballot(user_id) if ballot is None else ballot
+
+    def flush_ballots(self):
+        # commit the pending ballots to the store (and its journal) in one go, the ingest queue calls this every few ms
+        if not self.pending:
+            return
+        voters = list(self.pending)
+        ballots = np.array(list(self.pending.values()))
+        n_new = self._n_pending_new
+        self.pending = {}
+        self._n_pending_new = 0
+        self.store.commit(ballots, voters)
+        logging.info(f'Committed {n_new} new and {len(voters) - n_new} amended ballots for the poll "{self.name}"')
     
     def make_pretty_embed(self):
         embed = discord.Embed(title=self.name, description=self.description, color=discord.Color.from_str('#663399'),
                               timestamp=datetime.datetime.now())   # rebeccapurple
-        places = ''
-        # if self.type == 'STV':
-        #     for i in range(len(self.choices)):
-        #         places += f'**0**   *{ui_elements.get_place_str(i+1)}-choice votes*\n'
-        # elif self.type == 'STAR':
-        #     for i in range(5,-1,-1):
-        #         places += f'**0**   *{i} ⭐ votes*\n'
+        places = self.get_places()
         for i, choice in enumerate(self.choices):
-            embed.add_field(name=choice, value=places, inline=True)
+            embed.add_field(name=choice, value=places[i], inline=True)
         embed.set_footer(text=f'{self.n_votes} voter(s)\nThis poll closes in {ui_elements.time_formatter(self.timeout)}')
         self.embed = embed
     
-    @tasks.loop(seconds=60)
-    async def message_update_loop(self):
+    async def refresh_embed(self):
+        # called periodically by the scheduler, only edits the message if something visible has changed
+        # the edit is just queued on the outbox, the scheduler doesn't wait for it to go out
         assert self.message is not None                                     # make sure message is set
-        self.message = await self.channel.fetch_message(self.message.id)    # fetch the message from its ID, otherwise expires after 15 mins
-        time1 = time.monotonic()
-        dt = time1 - self.time0
-        time_remaining = self.timeout - dt
-        if time_remaining > 0:
-            logging.info('Updating poll embed')
-            places = ['' for _ in range(len(self.choices))]
-            # if self.type == 'STV':
-            #     for i in range(len(self.choices)):
-            #         for j in range(len(self.choices)):
-            #             current_votes = np.sum(self.ballots[j,:] == i+1)
-            #             places[j] += f'**{current_votes}**   *{ui_elements.get_place_str(i+1)}-choice votes*\n'
-            # elif self.type == 'STAR':
-            #     for i in range(5,-1,-1):
-            #         for j in range(len(self.choices)):
-            #             current_votes = np.sum(self.ballots[j,:] == i)
-            #             places[j] += f'**{current_votes}**   *{i} ⭐ votes*\n'
-            # update items
-            for i, choice in enumerate(self.choices):
-                self.embed.set_field_at(i, name=choice, value=places[i])
-            # update footer
-            self.embed = self.embed.set_footer(text=f'{self.n_votes} votes\nThis poll closes in {ui_elements.time_formatter(time_remaining)}')
-            self.embed.timestamp = datetime.datetime.now()
-            await self.message.edit(embed=self.embed)
-        else:
-            await self.channel.send(f'The poll "{self.name}" is now closed! The results will now be shown.')
-            await self.cleanup()
+        time_remaining = self.deadline - time.monotonic()
+        if time_remaining <= 0:
+            return False
+        places = self.get_places()
+        footer = f'{self.n_votes} votes\nThis poll closes in {ui_elements.time_formatter(time_remaining)}'
+        state = (tuple(places), footer)
+        if state == self._embed_state:
+            return False
+        logging.info(f'Updating poll embed for "{self.name}"')
+        # update items
+        for i, choice in enumerate(self.choices):
+            self.embed.set_field_at(i, name=choice, value=places[i])
+        # update footer
+        self.embed = self.embed.set_footer(text=footer)
+        self.embed.timestamp = datetime.datetime.now()
+        client.metrics.embed_edits.inc(reason='refresh')
+        client.outbox.edit(self.message, embed=self.embed).add_done_callback(self._refresh_done)
+        self._embed_state = state
+        return True
+
+    def _refresh_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f'Failed to refresh the embed for the poll "{self.name}": {future.exception()!r}')
+            # try again on the next refresh
+            self._embed_state = None
+
+    async def close(self):
+        # called by the scheduler once the time limit is up
+        client.outbox.send(self.channel, f'The poll "{self.name}" is now closed! The results will now be shown.')
+        await self.cleanup()
     
     async def cleanup(self):
+        # the poll can be closed by hand while the scheduler is closing it (or the other way around), only the first counts
+        if self.closed:
+            return
+        # no more ballots from here on, the election is counted from what's in the store now
+        self.closed = True
+        client.ingest.flush(self)
+        # nothing else needs to be scheduled for this poll
+        client.scheduler.remove(self)
+
         # do a final update to the embed
         logging.info('Updating poll embed')
-        self.message = await self.channel.fetch_message(self.message.id)
-        places = ['' for _ in range(len(self.choices))]
-        if self.type == 'STV':
-            for i in range(len(self.choices)):
-                for j in range(len(self.choices)):
-                    current_votes = np.sum(self.ballots[j,:] == i+1)
-                    places[j] += f'**{current_votes}**   *{ui_elements.get_place_str(i+1)}-choice votes*\n'
-        elif self.type == 'STAR':
-            for i in range(5,-1,-1):
-                for j in range(len(self.choices)):
-                    current_votes = np.sum(self.ballots[j,:] == i)
-                    places[j] += f'**{current_votes}**   *{i} ⭐ votes*\n'
+        places = self.get_places()
         # update items
         for i, choice in enumerate(self.choices):
             self.embed.set_field_at(i, name=choice, value=places[i])
         # update footer
         self.embed.set_footer(text=f'{self.n_votes} votes\nThis poll is now closed!')
-        await self.message.edit(embed=self.embed)
+        client.metrics.embed_edits.inc(reason='close')
+        embed_edit = client.outbox.edit(self.message, embed=self.embed)
+        client.metrics.ballot_rate.forget(guild=self.guild_id, poll=self.name)
 
         global polls
 
+        # write the ballots out to the archive before the election code gets its hands on them
+        self.store.compact(self.choices, self.type, self.n_winners, self.reweight)
+
         # run the results
         logging.info(f'Poll {self.name} has closed. Printing results.')
-        output = self.run_election()
-        for i,oi in enumerate(output):
-            await self.channel.send('```' + oi + '```', silent=False if i == 0 else True)
-            await asyncio.sleep(0.5)
+        try:
+            result = await self.run_election_async(quiet=True)
+        except election_pool.ElectionTimeout:
+            logging.exception(f'Gave up counting the poll {self.name}')
+            sends = [client.outbox.send(self.channel, f'Counting the results of "{self.name}" took too long, sorry! '
+                                                      'The ballots have been saved so they can still be counted.')]
+        except Exception:
+            # the poll is already closed and off the scheduler, so it still has to be wrapped up below
+            logging.exception(f'Could not count the poll {self.name}')
+            sends = [client.outbox.send(self.channel, f'Something went wrong while counting the results of "{self.name}", '
+                                                      'sorry! The ballots have been saved so they can still be counted.')]
+        else:
+            # the printout is made once and goes to both the log and the channel
+            blocks = result.render()
+            logging.info(''.join(blocks))
+            # the rounds get packed into as few messages as possible, the outbox takes care of pacing them
+            sends = client.outbox.send_code_blocks(self.channel, blocks)
 
-        self.closed = True
-        await self.disable_buttons()
+        # if the embed edit hasn't gone out yet, this gets merged into it
+        button_edit = self.disable_buttons()
 
-        polls.pop(self.name)
-        self.message_update_loop.cancel()
+        await asyncio.gather(embed_edit, button_edit, *sends)
+
+        polls.pop((self.guild_id, self.name))
         del self
     
+    def get_places(self):
+        # the per-rank (or per-star) vote counts for each candidate, read straight from the running tallies
+        places = []
+        for j in range(len(self.choices)):
+            if self.ranked:
+                lines = [f'**{self.tallies[j,i]}**   *{ui_elements.get_place_str(i)}-choice votes*\n' for i in range(1, len(self.choices)+1)]
+            else:
+                lines = [f'**{self.tallies[j,i]}**   *{i} ⭐ votes*\n' for i in range(star.MAX_STARS, -1, -1)]
+            places.append(''.join(lines))
+        return places
+
+    def rebuild_tallies(self):
+        # recount the running tallies from scratch, only needed when the ballots come back from disk
+        n_levels = self.tallies.shape[1]
+        ballots = np.clip(self.ballots, 0, n_levels-1)
+        for j in range(len(self.choices)):
+            self.tallies[j] = np.bincount(ballots[j], minlength=n_levels)
+        if self.pairwise is not None:
+            self.pairwise[:] = condorcet.pairwise_matrix(self.ballots)
+
+    def count_ballot(self, ballot, sign=1):
+        # add (or with sign=-1, take away) a ballot from the running tallies, O(number of choices)
+        # (and from the pairwise matrix of a Condorcet poll, O(number of choices squared))
+        self.tallies[np.arange(len(self.choices)), ballot] += sign
+        if self.pairwise is not None:
+            self.pairwise += sign * condorcet.ballot_pairwise(ballot)
+
     def make_button_view(self):
-        self.view = discord.ui.View(timeout=self.timeout)
+        # no timeout, the scheduler takes care of closing the poll (and persistent views can't have one)
+        self.view = discord.ui.View(timeout=None)
         ballot_btn = BallotButton(self.name)
         close_btn = CloseButton(self.name)
         self.buttons = [ballot_btn, close_btn]
         self.view.add_item(ballot_btn)
         self.view.add_item(close_btn)
     
-    async def disable_buttons(self):
+    def disable_buttons(self):
         for btn in self.buttons:
             btn.disabled = True
-        await self.message.edit(view=self.view)
+        client.metrics.embed_edits.inc(reason='buttons')
+        return client.outbox.edit(self.message, view=self.view)
 
-    def add_new_ballot(self, ballot, user_id):
+    def add_new_ballot(self, ballot, user_id, amend=False):
         # check if the poll is still going
+        if self.closed:
+            return False
         time1 = time.monotonic()
         if time1 - self.time0 > self.timeout:
-            self.closed = True
-            return False
-        if user_id in self.voters:
             return False
-        logging.info(f'A user has cast their vote for the poll "{self.name}": {ballot}')
-        ballot = ballot.reshape((len(ballot),1))
-        self.ballots = np.concatenate((self.ballots, ballot), axis=1)
-        self.voters = np.append(self.voters, user_id)
-        self.n_votes += 1
-        logging.debug(ballot)
-        np.savez(f'{self.name}.ballot.npz', candidates=self.choices, ballots=self.ballots, voters=self.voters)
+        ballot = np.array(ballot, dtype=ballot_store.BALLOT_DTYPE)
+        if ballot.shape != (len(self.choices),):
+            raise ValueError(f'A ballot for the poll "{self.name}" should have {len(self.choices)} entries, got {ballot.shape}')
+        # the ballot counts (and the tallies are updated) right away, but it only goes into the store and the journal
+        # with the next batch, the full archive is written when the poll closes
+        # (pending ballots are checked too, so nobody gets to vote twice by submitting two ballots in the same batch)
+        if self.has_voted(user_id):
+            if not amend:
+                return False
+            self.count_ballot(self.get_ballot(user_id), sign=-1)
+            client.metrics.ballots.inc(kind='amended')
+        else:
+            self._n_pending_new += 1
+            client.metrics.ballots.inc(kind='cast')
+        self.pending[user_id] = ballot
+        self.version += 1
+        client.metrics.ballot_rate.mark(guild=self.guild_id, poll=self.name)
+        self.count_ballot(ballot)
+        client.ingest.add(self)
         return True
     
     def run_election(self, quiet=False):
-        # get the results of the poll
-        if self.type == 'STV':
-            output = rcv.run_election(self.choices, self.ballots, self.n_winners)
-            if not quiet:
-                logging.info(''.join(output))
-        else:
-            # output = star.run_election(self.choices, self.ballots)
-            output = star.run_election(self.choices, self.ballots, self.n_winners)
-            if not quiet:
-                logging.info(''.join(output))
-        return output
+        # get the results of the poll, the text printout is only made if something wants to show it
+        with client.metrics.election_seconds.time(type=self.type):
+            if self.type == 'STV':
+                result = rcv.run_election(self.choices, self.ballots, self.n_winners)
+            elif self.type == 'CONDORCET':
+                # the pairwise matrix is already up to date, so this doesn't depend on how many people voted
+                result = condorcet.run_election(self.choices, self.ballots, self.n_winners, pairwise=self.pairwise)
+            else:
+                # result = star.run_election(self.choices, self.ballots)
+                result = star.run_election(self.choices, self.ballots, self.n_winners, reweight=self.reweight)
+        if not quiet:
+            logging.info(''.join(result.render()))
+        return result
+
+    async def project(self):
+        # the election as it would come out right now, returned as (version, result)
+        # the count is kept until a new ballot comes in, and even then it's only redone once every PROJECTION_DEBOUNCE
+        # seconds (anyone asking in between gets the last one), and everyone asking during a count waits on the same one
+        if self._projection_task is None:
+            stale = self._projection is None or self._projection[0] != self.version
+            if stale and (self._projected_at is None or time.monotonic() - self._projected_at >= PROJECTION_DEBOUNCE):
+                self._projection_task = asyncio.create_task(self._count_projection())
+        if self._projection_task is not None:
+            return await asyncio.shield(self._projection_task)
+        return self._projection
+
+    async def _count_projection(self):
+        try:
+            # the pending ballots go in first so the count matches the version
+            client.ingest.flush(self)
+            version = self.version
+            started = time.monotonic()
+            # the ballots keep coming in (and being amended in place) while this waits for the election pool,
+            # so it counts a copy of them as they are at this version
+            with client.metrics.election_seconds.time(type=self.type):
+                if self.type == 'CONDORCET':
+                    result = condorcet.run_election(self.choices, self.ballots, self.n_winners, pairwise=self.pairwise.copy())
+                else:
+                    result = await client.elections.run(self.type, self.choices, self.ballots.copy(), self.n_winners,
+                                                        self.reweight)
+            # the debounce only starts once there's a count to show, a count that failed can be tried again straight away
+            self._projection = (version, result)
+            self._projected_at = started
+            return self._projection
+        finally:
+            self._projection_task = None
+
+    async def run_election_async(self, quiet=False):
+        # the same as run_election, but STV and STAR are counted in the election pool so the event loop keeps going
+        if self.type == 'CONDORCET':
+            return self.run_election(quiet)
+        with client.metrics.election_seconds.time(type=self.type):
+            result = await client.elections.run(self.type, self.choices, self.ballots, self.n_winners, self.reweight)
+        if not quiet:
+            logging.info(''.join(result.render()))
+        return result
+
+
+def restore_polls():
+    # bring back every poll that was still open when the bot last stopped, polls that ran out
+    # in the meantime get closed by the scheduler straight away
+    time0 = time.monotonic()
+    for record in polls.load_records():
+        try:
+            poll = Poll.from_record(record, client.get_partial_messageable(record['channel_id']))
+        except Exception:
+            logging.exception(f'Could not restore the poll "{record.get("name")}"')
+            continue
+        polls.add(poll, save=False, legacy=record.get('legacy', False))
+        # the buttons on the poll message need a view listening for them again
+        client.add_view(poll.view, message_id=poll.message.id)
+        client.scheduler.add(poll)
+    polls.save()
+    logging.info(f'Restored {len(polls)} poll(s) in {time.monotonic()-time0:.3f} seconds')
 
 
 class BallotButton(discord.ui.Button):
 
     def __init__(self, poll_name):
-        super().__init__(style=discord.ButtonStyle.blurple, label=f'Get your ballot!')
+        super().__init__(style=discord.ButtonStyle.blurple, label=f'Get your ballot!', custom_id=f'ballot:{poll_name}'[:100])
         self.poll_name = poll_name
     
     # simple callback function that calls get_ballot for the poll the button is associated with
@@ -350,7 +711,7 @@ class BallotButton(discord.ui.Button):
 class CloseButton(discord.ui.Button):
 
     def __init__(self, poll_name):
-        super().__init__(style=discord.ButtonStyle.red, label=f'Close poll')
+        super().__init__(style=discord.ButtonStyle.red, label=f'Close poll', custom_id=f'close:{poll_name}'[:100])
         self.poll_name = poll_name
     
     # simple callback that closes the poll if the user is the one who set up the poll
@@ -358,4 +719,17 @@ class CloseButton(discord.ui.Button):
         await closepoll.callback(interaction, self.poll_name)
 
 
-client.run(TOKEN)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the bot')
+    parser.add_argument('--shard-count', type=int, default=SHARD_COUNT, help='total number of shards across every process')
+    parser.add_argument('--shard-ids', type=int, nargs='+', default=SHARD_IDS, help='the shards to run in this process (needs --shard-count)')
+    args = parser.parse_args()
+    setup_logging()
+    make_client(args.shard_ids, args.shard_count)
+
+    # make a separate 'info.txt' file with your 
+    # token on the first line
+    with open('info.txt', 'r') as file:
+        TOKEN = file.readline()
+
+    client.run(TOKEN)
@@ -0,0 +1,288 @@
+# This file keeps counters and timing histograms for the bot, so we can see where the time goes under load.
+# Everything can be dumped in the Prometheus text format, either from a small local HTTP endpoint or with /metrics
+import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import logging
+import time
+
+# upper bounds (in seconds) of the histogram buckets used for timings
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _shown(key, only):
+    # if a series should be in a summary that's limited to the labels in only (a series without one of those labels
+    # at all is still shown, e.g. a summary for one guild leaves out other guilds' series but keeps the global ones)
+    labels = dict(key)
+    return all(labels.get(name, value) == value for name, value in only.items())
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}                # label tuple -> count
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def summary(self, only={}):
+        for key, value in self.values.items():
+            if _shown(key, only):
+                yield f'{self.name}{_format_labels(key)}: {value}'
+
+
+class Gauge:
+
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}                # label tuple -> current value
+        self.function = None            # if set, called for the (unlabelled) value whenever it's read
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            yield self.name, (), self.function()
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+    def summary(self, only={}):
+        for name, key, value in self.samples():
+            if _shown(key, only):
+                yield f'{name}{_format_labels(key)}: {value:.4g}'
+
+
+class RateMeter:
+
+    # events per second over a sliding window, shown as a gauge (one per label set, e.g. one per poll)
+    kind = 'gauge'
+
+    def __init__(self, name, help, window=60):
+        self.name = name
+        self.help = help
+        self.window = window            # seconds the rate is averaged over
+        self.events = {}                # label tuple -> deque of [whole second, events in that second]
+
+    def mark(self, n=1, **labels):
+        now = int(time.monotonic())
+        events = self.events.setdefault(_label_key(labels), collections.deque())
+        if events and events[-1][0] == now:
+            events[-1][1] += n
+        else:
+            events.append([now, n])
+        while events[0][0] <= now - self.window:
+            events.popleft()
+
+    def forget(self, **labels):
+        self.events.pop(_label_key(labels), None)
+
+    def rate(self, key):
+        cutoff = time.monotonic() - self.window
+        return sum(n for second, n in self.events.get(key, ()) if second > cutoff) / self.window
+
+    def samples(self):
+        for key in self.events:
+            yield self.name, key, self.rate(key)
+
+    def summary(self, only={}):
+        for key in self.events:
+            if _shown(key, only):
+                yield f'{self.name}{_format_labels(key)}: {self.rate(key):.2f}/s'
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (float('inf'),)     # upper bound of each bucket
+        self.values = {}                                    # label tuple -> [count in each bucket, sum, count]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0]*len(self.buckets), 0., 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def timed(self, **labels):
+        # decorator for coroutine functions, the signature is kept so it works under app_commands decorators too
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def quantile(self, key, q):
+        # rough quantile, the upper bound of the bucket it falls in
+        counts, _, count = self.values[key]
+        target = q * count
+        running = 0
+        for bound, n in zip(self.buckets, counts):
+            running += n
+            if running >= target:
+                return bound
+        return self.buckets[-1]
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                yield self.name + '_bucket', key + (('le', _format_value(bound)),), running
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, count
+
+    def summary(self, only={}):
+        for key, (_, total, count) in self.values.items():
+            if not _shown(key, only):
+                continue
+            yield (f'{self.name}{_format_labels(key)}: n={count} mean={1000*total/count:.2f}ms '
+                   f'p50<={1000*self.quantile(key, 0.5):g}ms p99<={1000*self.quantile(key, 0.99):g}ms')
+
+
+class Metrics:
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix            # put in front of every metric name
+        self.families = {}              # metric name -> metric
+        self._server = None
+        self._lag_task = None
+
+    def _add(self, cls, name, help, **kwargs):
+        metric = cls(self.prefix + name, help, **kwargs)
+        self.families[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._add(Counter, name, help)
+
+    def gauge(self, name, help):
+        return self._add(Gauge, name, help)
+
+    def rate(self, name, help, window=60):
+        return self._add(RateMeter, name, help, window=window)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._add(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        # everything in the Prometheus text exposition format
+        lines = []
+        for metric in self.families.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, key, value in metric.samples():
+                lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, **only):
+        # a shorter human-readable version, for dumping into discord
+        # label values given in only limit it to the matching series (plus the ones without those labels)
+        return [line for metric in self.families.values() for line in metric.summary(only)]
+
+    async def serve(self, host='127.0.0.1', port=9108):
+        # a tiny HTTP server that answers every GET with the metrics, enough for Prometheus to scrape
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            path = request.split(b' ', 2)[1] if request.count(b' ') >= 2 else b''
+            if path.split(b'?')[0] in (b'/', b'/metrics'):
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def watch_loop_lag(self, histogram, interval=0.5):
+        # sleep for `interval` over and over, anything past that is time the event loop was stuck on something else
+        async def watch():
+            while True:
+                t0 = time.perf_counter()
+                await asyncio.sleep(interval)
+                histogram.observe(max(time.perf_counter() - t0 - interval, 0))
+        if self._lag_task is None:
+            self._lag_task = asyncio.create_task(watch())
+
+    def stop(self):
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+
+class BotMetrics(Metrics):
+
+    # everything the bot keeps track of
+    def __init__(self):
+        super().__init__(prefix='ilovedemocracy_')
+        self.command_seconds = self.histogram('command_seconds', 'Time spent handling each slash command')
+        self.submit_seconds = self.histogram('submit_seconds', 'Time spent handling a ballot submit button')
+        self.election_seconds = self.histogram('election_seconds', 'Time spent computing an election result')
+        self.loop_lag_seconds = self.histogram('event_loop_lag_seconds', 'How late the event loop woke up from a short sleep')
+        self.ballots = self.counter('ballots_total', 'Ballots cast or amended')
+        self.ballot_rate = self.rate('ballots_per_second', 'Ballots cast or amended per second, over the last minute')
+        self.embed_edits = self.counter('embed_edits_total', 'Edits queued for poll embeds and their buttons')
+        self.outbox_depth = self.gauge('outbox_depth', 'Sends and edits waiting in the outbox')
+        self.ingest_depth = self.gauge('ingest_depth', 'Ballots taken but not yet committed to disk')
+        self.open_polls = self.gauge('open_polls', 'Polls that are currently open')
@@ -0,0 +1,199 @@
+# This file handles every message the bot sends or edits outside of interaction responses.
+# Everything goes through one queue so that sends can be paced per rate-limit bucket,
+# repeated edits to the same message are collapsed, and long results are packed into as few messages as possible
+import asyncio
+import collections
+import itertools
+import logging
+import time
+
+import discord
+
+# discord won't take messages longer than this
+MESSAGE_LIMIT = 2000
+
+
+class _Job:
+
+    def __init__(self, seq, bucket, kind, target, kwargs):
+        self.seq = seq                                                  # position in the global order
+        self.bucket = bucket                                            # rate-limit bucket the request falls in
+        self.kind = kind                                                # 'send' or 'edit'
+        self.target = target                                            # channel to send to, or message to edit
+        self.kwargs = kwargs                                            # arguments for the request
+        self.future = asyncio.get_running_loop().create_future()       # resolves with whatever discord returns
+
+
+class _Bucket:
+
+    # simple token bucket: `rate` requests are allowed every `per` seconds
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def ready_at(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return max(now, self.blocked_until)
+        return max(now + (1 - self.tokens) * self.per / self.rate, self.blocked_until)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class Outbox:
+
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate                                        # requests allowed per bucket...
+        self.per = per                                          # ...every this many seconds
+        self._queues = {}                                       # bucket -> deque of jobs waiting to go out
+        self._buckets = {}                                      # bucket -> _Bucket tracking its rate limit
+        self._busy = set()                                      # buckets with a request currently in flight
+        self._edits = {}                                        # message ID -> the edit job still waiting for it
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    @property
+    def depth(self):
+        # number of requests waiting to go out
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _enqueue(self, bucket, kind, target, kwargs):
+        job = _Job(next(self._counter), bucket, kind, target, kwargs)
+        self._queues.setdefault(bucket, collections.deque()).append(job)
+        if bucket not in self._buckets:
+            self._buckets[bucket] = _Bucket(self.rate, self.per)
+        self._wakeup.set()
+        return job
+
+    def send(self, channel, content=None, **kwargs):
+        # queue a new message, returns a future for the sent message
+        return self._enqueue(('send', channel.id), 'send', channel, dict(content=content, **kwargs)).future
+
+    def edit(self, message, **kwargs):
+        # queue an edit, if an edit to the same message is still waiting the two are merged and only the latest values are sent
+        job = self._edits.get(message.id)
+        if job is not None:
+            job.kwargs.update(kwargs)
+            return job.future
+        job = self._enqueue(('edit', message.channel.id), 'edit', message, kwargs)
+        self._edits[message.id] = job
+        return job.future
+
+    def send_code_blocks(self, channel, blocks, silent_after_first=True):
+        # send each block as a code block, packing as many as fit into each message
+        futures = []
+        for i, content in enumerate(pack_code_blocks(blocks)):
+            futures.append(self.send(channel, content, silent=silent_after_first and i > 0))
+        return futures
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+
+            # pick the oldest job out of the buckets that are free to go right now
+            job = None
+            wake = None
+            for bucket, queue in self._queues.items():
+                if not queue or bucket in self._busy:
+                    continue
+                ready_at = self._buckets[bucket].ready_at(now)
+                if ready_at <= now:
+                    if job is None or queue[0].seq < job.seq:
+                        job = queue[0]
+                elif wake is None or ready_at < wake:
+                    wake = ready_at
+
+            if job is None:
+                self._wakeup.clear()
+                timeout = None if wake is None else max(wake - now, 0)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            queue = self._queues[job.bucket]
+            queue.popleft()
+            if not queue:
+                del self._queues[job.bucket]
+            if job.kind == 'edit':
+                self._edits.pop(job.target.id, None)
+            self._buckets[job.bucket].take(now)
+            self._busy.add(job.bucket)
+            asyncio.create_task(self._perform(job))
+
+    async def _perform(self, job):
+        try:
+            if job.kind == 'send':
+                res = await job.target.send(**job.kwargs)
+            else:
+                res = await job.target.edit(**job.kwargs)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                # we got rate limited anyway, hold the bucket back and try again
+                retry_after = getattr(e, 'retry_after', None) or self.per
+                logging.warning(f'Rate limited on {job.bucket}, retrying in {retry_after:.1f}s')
+                self._buckets[job.bucket].blocked_until = time.monotonic() + retry_after
+                self._queues.setdefault(job.bucket, collections.deque()).appendleft(job)
+            elif not job.future.done():
+                job.future.set_exception(e)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(res)
+        finally:
+            self._busy.discard(job.bucket)
+            self._wakeup.set()
+
+
+def pack_code_blocks(blocks, limit=MESSAGE_LIMIT):
+    # wrap each block in ``` and pack them into as few messages as possible without going over the limit
+    # (a block that is too long on its own gets split up between lines)
+    pieces = []
+    for block in blocks:
+        wrapped = '```' + block + '```'
+        if len(wrapped) <= limit:
+            pieces.append(wrapped)
+            continue
+        chunk = ''
+        for line in block.splitlines(keepends=True):
+            if chunk and len(chunk) + len(line) + 6 > limit:
+                pieces.append('```' + chunk + '```')
+                chunk = ''
+            chunk += line[:limit-6]
+        if chunk:
+            pieces.append('```' + chunk + '```')
+
+    messages = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) <= limit:
+            current += '\n' + piece
+        else:
+            if current:
+                messages.append(current)
+            current = piece
+    if current:
+        messages.append(current)
+    return messages
@@ -1,47 +1,54 @@
 # This file handles the ranked choice vote logic
+import tempfile
+
 import numpy as np
 
-def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1):
+import ballot_store
+import results
+
+def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1, weights: np.ndarray = None,
+                 columns: np.ndarray = None):
     # candidates should be a 1D array labeling each candidate in the vote
     # ballots should be a 2D array: first index iterates over candidates, second index iterates over voters
     #    for example, if there are 5 candidates index [:,2] should look like [5,3,1,2,4] giving the rankings of each candidate
     #    anything 0 or lower means no vote, i.e. [0,0,1,2,0] would indicate that no vote should be counted for the 1st, 2nd, or 5th candidate
     # n_winners is an integer specifying how many winners the poll should have, it defaults to 1
     # if n_winners is > 1, the voting uses the Single Transferable Vote (STV)
-    output = np.array([''], dtype=object)
-
-    # pad candidate names with spaces so printing looks uniform
-    candidates_padded = np.copy(candidates)
-    maxcharlen = np.max([len(cand) for cand in candidates])
-    for c in range(len(candidates_padded)):
-        diff = maxcharlen - len(candidates_padded[c])
-        if diff > 0:
-            candidates_padded[c] += ' '*diff
-
-    msg = 'BEGINNING ELECTION'
-    output[0] = msg
-    j = 1
+    # weights is an optional 1D array giving how many voters cast each ballot column, if it isn't given
+    #    the identical ballots are collapsed together first so the counting scales with the number of distinct ballots
+    # columns is an optional 1D array giving the ballot column of each voter, in the order they voted, it's what decides
+    #    which voters' surplus gets transferred (and it's updated in place as columns get split), if weights are given
+    #    without it the ballot columns are taken to be in voting order
+    if weights is None:
+        if n_winners > 1:
+            ballots, weights, columns = compress_ballots(ballots, return_columns=True)
+        else:
+            ballots, weights = compress_ballots(ballots)
+    else:
+        ballots = np.array(ballots)
+        weights = np.array(weights)
+        if columns is None and n_winners > 1:
+            columns = np.repeat(np.arange(len(weights)), weights)
+    # how many voters gave each candidate each rank, kept up to date as ballots move so that
+    # the 1st choice tallies and the tiebreaks never have to scan the ballots themselves
+    counts = rank_counts(ballots, weights)
     eliminated = np.zeros(len(candidates), dtype=bool)
     won = np.zeros(len(candidates), dtype=bool)
     # use Droop's quota for votes
-    n_votes = ballots.shape[1]
+    n_votes = int(np.sum(weights))
     n_to_win = int((n_votes / (n_winners + 1)) + 1)
+    result = results.ElectionResult('STV', candidates, n_votes, n_winners)
+    j = 1
     # increment until we have enough winners
     current_winners = 0
 
     while True:
         
-        output = np.append(output, np.array(['']))
-        
         # tally up the 1st choice votes
-        votes = np.sum(ballots == 1, axis=1)
+        votes = counts[:, 1].copy()
         n_cands = len(candidates) - np.sum(eliminated) - np.sum(won)
 
-        msg = f'### VOTE TALLIES FOR ROUND {j} ###'
-        output[j] = msg + '\n'
-        output[j] += print_vote_tallies(candidates_padded, votes, n_votes, won, eliminated)
-        msg = f'####################################'
-        output[j] += msg + '\n'
+        rnd = result.add_round(j, votes, n_votes, won, eliminated)
 
         # first, check if any candidate has more than the threshold of the vote as their 1st choice
         if np.any(votes[~won] >= n_to_win):
@@ -57,40 +64,30 @@ def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1
         
             # the "tiebreaker" function handles cases where multiple candidates are tied for first
             # by looking at lower-ranked votes
-            wh = tiebreaker(ballots, wh)
+            wh = tiebreaker(ballots, wh, weights, counts)
 
-            msg = f'RESULTS: {candidates_padded[wh]} HAS WON THE ELECTION WITH {str(int(votes[wh])).zfill(4)} VOTES ({votes[wh]/n_votes*100:.1f}%)'
+            rnd.add_event('won', wh, votes[wh])
+            result.winners.append(wh)
             current_winners += 1 
             won[wh] = True
-            output[j] += msg + '\n'
 
             # if we've reached the target number of winners, stop the counting
             if current_winners >= n_winners:
-
-                # do a final print-out
-                msg = f'### FINAL VOTE TALLIES       ###'
-                output[j] += msg + '\n'
-                output[j] += print_vote_tallies(candidates_padded, votes, n_votes, won, eliminated, final=True)
-                msg = f'################################'
-                output[j] += msg + '\n'
-
-                msg = f'I LOVE DEMOCRACY'
-                output[j] += msg
-                return output
+                result.set_final(np.arange(len(candidates)), votes, n_votes, won, eliminated)
+                return result
 
             # if we have allowed for multiple winners, we want to take the overflowing votes for the candidate that just won and give them to
             # the voters' next choices
             if n_winners > 1:
-                msg = f'THE OVERFLOWING VOTES WILL BE REDISTRIBUTED TO THE OTHER CANDIDATES'
-                output[j] += msg + '\n'
+                rnd.add_event('surplus')
 
                 # all ballots after this are shifted to their next choice
-                whn = np.where(ballots[wh,:] == 1)[0][int(n_to_win):]
-                ballots = shift_ballots(whn, ballots, eliminated, won)
+                whn = np.where(ballots[wh,:] == 1)[0]
+                ballots, weights, whn = split_surplus(ballots, weights, columns, whn, n_to_win)
+                ballots = shift_ballots(whn, ballots, eliminated, won, weights, counts)
 
                 # restart the loop so that we recount all the votes before deciding to eliminate anyone
-                msg = f'THE ELECTION WILL CONTINUE'
-                output[j] += msg + '\n'
+                rnd.add_event('continue')
                 j += 1
 
                 continue
@@ -108,24 +105,13 @@ def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1
             votes[eliminated] = 0
 
             for whi in wh:
-                msg = f'RESULTS: {candidates_padded[whi]} HAS WON THE ELECTION WITH {str(int(votes[whi])).zfill(4)} VOTES ({votes[whi]/n_votes*100:.1f}%)\n'
-                msg += f'DUE TO THE ELIMINATION OF ALL OTHER CANDIDATES\n'
+                rnd.add_event('won_remaining', whi, votes[whi])
+                result.winners.append(whi)
                 current_winners += 1
                 won[whi] = True
-                output[j] += msg
 
-            # do a final print-out
-            msg = f'### FINAL VOTE TALLIES       ###'
-            output[j] += msg + '\n'
-            output[j] += print_vote_tallies(candidates_padded, votes, n_votes, won, eliminated, final=True)
-            msg = f'################################'
-            output[j] += msg + '\n'
-
-
-            msg = f'I LOVE DEMOCRACY'
-            output[j] += msg
-
-            return output
+            result.set_final(np.arange(len(candidates)), votes, n_votes, won, eliminated)
+            return result
 
         # nobody got a majority of the vote, but there are more candidates remaining
         # eliminate the worst candidate and redistribute their votes to their next choice
@@ -140,50 +126,251 @@ def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1
 
         # the "tiebreaker" function handles cases where multiple candidates are tied for last place
         # by considering their lower ranked votes
-        last = tiebreaker(ballots, last)
+        last = tiebreaker(ballots, last, weights, counts)
         eliminated[last] = True
 
         wh = np.where(ballots[last,:] == 1)[0]
         # iterate through each voters' next choice until it's someone who hasn't already been eliminated
-        ballots = shift_ballots(wh, ballots, eliminated, won)
+        ballots = shift_ballots(wh, ballots, eliminated, won, weights, counts)
 
-        msg = f'RESULTS: {candidates_padded[last]} HAS BEEN ELIMINATED FROM THE RACE WITH {str(int(votes[last])).zfill(4)} VOTES ({votes[last]/n_votes*100:.1f}%)\n'
-        msg += f'THEIR VOTES WILL BE REDISTRIBUTED TO THE OTHER CANDIDATES\n'
-        msg += f'THE ELECTION WILL CONTINUE'
-        output[j] += msg + '\n'
+        rnd.add_event('eliminated', last, votes[last])
 
         if j > 100:
-            msg = f'CRITICAL: SOMETHING HAS GONE WRONG, THE VOTING HAS GONE ON FOR 1000 ROUNDS. STOPPING ELECTION.'
-            output[j] += msg
-            return output
+            result.aborted = True
+            return result
 
         j += 1
 
 
-def shift_ballots(wh, ballots, eliminated, won):
-    for whi in wh:
-        ballots[:,whi] -= 1
-        nextcand = np.where(ballots[:,whi] == 1)[0]
-        while len(nextcand) > 0 and (eliminated[nextcand] or won[nextcand]):
-            ballots[:,whi] -= 1
-            nextcand = np.where(ballots[:,whi] == 1)[0]
+def compress_ballots(ballots, return_columns=False):
+    # collapse identical ballot columns into a table of unique ballots and how many voters cast each one
+    # (the unique ballots are kept in the order they were first cast)
+    # with return_columns the ballot column of each voter is returned too, which is what run_election needs to know
+    # whose votes to transfer
+    ballots = np.asarray(ballots)
+    if ballots.shape[1] == 0:
+        empty = (np.array(ballots), np.zeros(0, dtype=int))
+        return empty + (np.zeros(0, dtype=int),) if return_columns else empty
+    # ranks are small, so each column can usually be packed into a single integer key which is much faster to sort
+    low = int(np.min(ballots))
+    base = int(np.max(ballots)) - low + 1
+    if base ** ballots.shape[0] < 2**62:
+        keys = np.zeros(ballots.shape[1], dtype=np.int64)
+        for row in ballots:
+            keys = keys * base + (row - low)
+        _, first, inverse, weights = np.unique(keys, return_index=True, return_inverse=True, return_counts=True)
+    else:
+        _, first, inverse, weights = np.unique(ballots, axis=1, return_index=True, return_inverse=True,
+                                               return_counts=True)
+    order = np.argsort(first)
+    if not return_columns:
+        return ballots[:, first[order]], weights[order]
+    position = np.empty_like(order)
+    position[order] = np.arange(len(order))
+    return ballots[:, first[order]], weights[order], position[inverse.ravel()]
+
+
+def run_election_chunked(candidates, ballot_file, n_winners=1, chunk_size=ballot_store.CHUNK_SIZE):
+    # the same as run_election, for a (voters, candidates) ballot file that's too big to load
+    # only a chunk of voters and the table of distinct ballots are ever in memory, so memory use depends on how many
+    # different ballots were cast rather than on how many voters there were
+    # (with more than one winner the surplus transfers need each voter's ballot column, those go in a temporary file)
+    ballots, weights = compress_ballot_chunks(ballot_store.iter_chunks(ballot_file, chunk_size), ballot_file.shape[1])
+    if n_winners == 1:
+        return run_election(candidates, ballots, n_winners, weights)
+    with tempfile.TemporaryFile() as file:
+        columns = np.memmap(file, dtype=np.int64, mode='w+', shape=(max(ballot_file.shape[0], 1),))[:ballot_file.shape[0]]
+        ballot_columns(ballot_store.iter_chunks(ballot_file, chunk_size), ballots, columns)
+        result = run_election(candidates, ballots, n_winners, weights, columns)
+        del columns
+    return result
+
+
+def compress_ballot_chunks(chunks, n_cands):
+    # compress_ballots over (first voter, ballots) chunks, the distinct ballots of each chunk are merged into
+    # a running table (keeping the position each one was first cast at, so the order matches compress_ballots)
+    # each ballot's bytes are used as its sort key, which works for any number of candidates
+    row = ballot_key(n_cands)
+    keys = np.zeros(0, dtype=row)
+    first = np.zeros(0, dtype=np.int64)
+    weights = np.zeros(0, dtype=np.int64)
+    for start, chunk in chunks:
+        rows = np.ascontiguousarray(chunk.T, dtype=ballot_store.BALLOT_DTYPE).view(row).ravel()
+        chunk_keys, chunk_first, chunk_weights = np.unique(rows, return_index=True, return_counts=True)
+        keys, inverse = np.unique(np.concatenate((keys, chunk_keys)), return_inverse=True)
+        merged_first = np.full(len(keys), np.iinfo(np.int64).max)
+        np.minimum.at(merged_first, inverse, np.concatenate((first, chunk_first + start)))
+        merged_weights = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(merged_weights, inverse, np.concatenate((weights, chunk_weights)))
+        first, weights = merged_first, merged_weights
+    order = np.argsort(first)
+    ballots = keys[order].view(ballot_store.BALLOT_DTYPE).reshape((len(keys), n_cands)).T
+    return np.ascontiguousarray(ballots), weights[order]
+
+
+def ballot_columns(chunks, ballots, columns):
+    # fill in the column of a compress_ballot_chunks table that each voter in the chunks cast
+    row = ballot_key(ballots.shape[0])
+    keys = np.ascontiguousarray(ballots.T, dtype=ballot_store.BALLOT_DTYPE).view(row).ravel()
+    sorter = np.argsort(keys)
+    for start, chunk in chunks:
+        rows = np.ascontiguousarray(chunk.T, dtype=ballot_store.BALLOT_DTYPE).view(row).ravel()
+        columns[start:start + len(rows)] = sorter[np.searchsorted(keys, rows, sorter=sorter)]
+
+
+def ballot_key(n_cands):
+    # a ballot's bytes as a single sortable value
+    return np.dtype((np.void, n_cands * np.dtype(ballot_store.BALLOT_DTYPE).itemsize))
+
+
+def split_surplus(ballots, weights, columns, wh, n_keep, chunk_size=ballot_store.CHUNK_SIZE):
+    # the first n_keep voters (in the order they voted) with their ballot in one of the columns wh stay with their
+    # candidate and the rest are transferred, the same voters the per-voter count would have picked
+    # a column with voters on both sides of the cut gets split in two: the transferred voters move to a new column
+    # at the end (columns is updated to match), so it can move on its own
+    # columns is gone through a chunk at a time, so it can be a memory-mapped file
+    # returns the (possibly extended) ballots and weights, and the columns to transfer
+    if np.sum(weights[wh]) <= n_keep:
+        return ballots, weights, wh[:0]
+    n_cols = len(weights)
+    in_wh = np.zeros(n_cols, dtype=bool)
+    in_wh[wh] = True
+    # how many voters from each column come before the cut
+    kept = np.zeros(n_cols, dtype=weights.dtype)
+    seen = 0
+    for start in range(0, len(columns), chunk_size):
+        chunk = np.asarray(columns[start:start + chunk_size])
+        voters = np.nonzero(in_wh[chunk])[0]
+        if seen + len(voters) >= n_keep:
+            voters = voters[:n_keep - seen]
+            kept += np.bincount(chunk[voters], minlength=n_cols).astype(kept.dtype)
+            cut = start + (voters[-1] + 1 if len(voters) > 0 else 0)
+            break
+        kept += np.bincount(chunk[voters], minlength=n_cols).astype(kept.dtype)
+        seen += len(voters)
+    split = np.nonzero(in_wh & (kept > 0) & (kept < weights))[0]
+    new_cols = np.arange(n_cols, n_cols + len(split))
+    if len(split) > 0:
+        # everyone in a split column after the cut goes to its new column
+        moved = np.full(n_cols, -1)
+        moved[split] = new_cols
+        for start in range(cut, len(columns), chunk_size):
+            chunk = columns[start:start + chunk_size]
+            new = moved[chunk]
+            chunk[new >= 0] = new[new >= 0]
+        ballots = np.concatenate((ballots, ballots[:, split]), axis=1)
+        weights = np.concatenate((weights, weights[split] - kept[split]))
+        weights[split] = kept[split]
+    return ballots, weights, np.concatenate((wh[kept[wh] == 0], new_cols))
+
+
+def rank_counts(ballots, weights, n_ranks=None):
+    # counts[c, r] is how many voters gave candidate c rank r (anything 0 or lower is counted as rank 0)
+    n_cands = ballots.shape[0]
+    if n_ranks is None:
+        n_ranks = max(n_cands, int(np.max(ballots, initial=0))) + 1
+    counts = np.zeros((n_cands, n_ranks), dtype=weights.dtype)
+    _add_rank_counts(counts, ballots, weights)
+    return counts
+
+
+def _add_rank_counts(counts, ballots, weights, sign=1):
+    # add (or with sign=-1, take away) the ranks on some ballot columns to a rank_counts table
+    n_cands, n_ranks = counts.shape
+    index = np.arange(n_cands)[:, None] * n_ranks + np.clip(ballots, 0, n_ranks - 1)
+    added = np.bincount(index.ravel(), weights=np.broadcast_to(weights, ballots.shape).ravel(), minlength=counts.size)
+    if np.issubdtype(counts.dtype, np.integer):
+        added = np.rint(added)
+    counts += sign * added.astype(counts.dtype).reshape(counts.shape)
+
+
+def shift_ballots(wh, ballots, eliminated, won, weights=None, counts=None):
+    # move each ballot in wh down to its next choice that is still in the running, all at once
+    # (equivalent to decrementing each ballot column until its 1st choice is a continuing candidate,
+    #  or until there is no 1st choice left at all)
+    # if a rank_counts table is given it's updated to match, which only costs as much as the shift itself
+    if len(wh) == 0:
+        return ballots
+    sub = ballots[:, wh]
+    max_rank = max(int(np.max(sub)), 1)
+
+    # preference-order matrix: order[r, i] is the candidate ranked r on ballot i, or -1 if nobody has that rank
+    # (row max_rank+1 is always empty, so every ballot stops somewhere)
+    order = np.full((max_rank + 2, len(wh)), -1, dtype=int)
+    cands, cols = np.nonzero(sub >= 1)
+    order[sub[cands, cols], cols] = cands
+
+    # a shift of d stops at rank d+1 if that rank is empty or belongs to a continuing candidate
+    continuing = ~(eliminated | won)
+    next_order = order[2:, :]
+    stop = (next_order < 0) | continuing[np.maximum(next_order, 0)]
+    shift = np.argmax(stop, axis=0) + 1
+
+    # ranks that would drop to 0 or below all mean 'no vote', so the subtraction just stops at 0
+    # (that way it works on unsigned ballots too, without making a wider copy of them)
+    shift = shift.astype(sub.dtype)
+    shifted = np.where(sub > shift, sub - shift, 0)
+    if counts is not None:
+        _add_rank_counts(counts, sub, weights[wh], sign=-1)
+        _add_rank_counts(counts, shifted, weights[wh])
+    ballots[:, wh] = shifted
     return ballots
 
 
+def render_result(result):
+    # turn an ElectionResult into the text printout, one string for each round
+    candidates_padded = results.pad_names(result.candidates)
+    n_votes = result.n_votes
+    output = ['BEGINNING ELECTION']
+    for rnd in result.rounds:
+        parts = [f'### VOTE TALLIES FOR ROUND {rnd.number} ###\n',
+                 print_vote_tallies(candidates_padded, rnd.tallies, n_votes, rnd.won, rnd.eliminated),
+                 '####################################\n']
+        for kind, c, votes in rnd.events:
+            if kind == 'won':
+                parts.append(f'RESULTS: {candidates_padded[c]} HAS WON THE ELECTION WITH {str(int(votes)).zfill(4)} VOTES ({votes/n_votes*100:.1f}%)\n')
+            elif kind == 'won_remaining':
+                parts.append(f'RESULTS: {candidates_padded[c]} HAS WON THE ELECTION WITH {str(int(votes)).zfill(4)} VOTES ({votes/n_votes*100:.1f}%)\n')
+                parts.append('DUE TO THE ELIMINATION OF ALL OTHER CANDIDATES\n')
+            elif kind == 'surplus':
+                parts.append('THE OVERFLOWING VOTES WILL BE REDISTRIBUTED TO THE OTHER CANDIDATES\n')
+            elif kind == 'continue':
+                parts.append('THE ELECTION WILL CONTINUE\n')
+            elif kind == 'eliminated':
+                parts.append(f'RESULTS: {candidates_padded[c]} HAS BEEN ELIMINATED FROM THE RACE WITH {str(int(votes)).zfill(4)} VOTES ({votes/n_votes*100:.1f}%)\n')
+                parts.append('THEIR VOTES WILL BE REDISTRIBUTED TO THE OTHER CANDIDATES\n')
+                parts.append('THE ELECTION WILL CONTINUE\n')
+        output.append(''.join(parts))
+
+    # the final print-out goes with the last round
+    final = result.final
+    if final is not None:
+        output[-1] += ''.join(['### FINAL VOTE TALLIES       ###\n',
+                               print_vote_tallies(candidates_padded, final.tallies, n_votes, final.won, final.eliminated, final=True),
+                               '################################\n',
+                               'I LOVE DEMOCRACY'])
+    elif result.aborted:
+        output[-1] += 'CRITICAL: SOMETHING HAS GONE WRONG, THE VOTING HAS GONE ON FOR 1000 ROUNDS. STOPPING ELECTION.'
+    return output
+
+
 def print_vote_tallies(candidates_padded, votes, n_votes, won, eliminated, final=False):
-    output = ''
+    output = []
     for c in range(len(candidates_padded)):
         status = 'WON       ' if won[c] else 'ELIMINATED' if eliminated[c] else 'RUNNING   '
-        msg = f'{status} | {candidates_padded[c]} | {str(int(votes[c])).zfill(4)} | {votes[c]/n_votes*100:.1f}%'
-        output += msg + '\n'
-    return output
+        output.append(f'{status} | {candidates_padded[c]} | {str(int(votes[c])).zfill(4)} | {votes[c]/n_votes*100:.1f}%\n')
+    return ''.join(output)
 
 
-def tiebreaker(ballots, wh):
+def tiebreaker(ballots, wh, weights=None, counts=None):
 
     # Handle ties more smartly!!
+    # the lower-ranked votes are read from the rank_counts table, which gets made here if it isn't passed in
+    if counts is None:
+        if weights is None:
+            weights = np.ones(ballots.shape[1], dtype=int)
+        counts = rank_counts(ballots, weights)
     place_check = 2
-    ballots_wh = ballots[wh, :]
     while len(wh) > 1:
 
         if place_check > ballots.shape[0]:
@@ -192,12 +379,10 @@ def tiebreaker(ballots, wh):
 
         # multiple candidates have tied - who should we let win and/or eliminate?
         # check their lower-ranked votes, starting with 2nd place
-        place_votes = np.sum(ballots_wh == place_check, axis=1)
+        place_votes = counts[wh, place_check]
 
         minvote = np.min(place_votes)
-        wh_new = np.where(place_votes == minvote)[0]
-        wh = wh[wh_new]
-        ballots_wh = ballots_wh[wh_new, :]
+        wh = wh[place_votes == minvote]
     
         place_check += 1
     
@@ -210,10 +395,8 @@ def simulate_election(n_winners=1):
 
     candidates = ['Joe', 'Mary', 'Humpty Dumpty', 'SpongeBob SquarePants', 'NGC 4609']
 
+    import simulate
     n_voters = 1000
-    ballots = np.zeros((len(candidates), n_voters), dtype=int)
-    for i in range(n_voters):
-        ballots[:,i] = np.arange(1,len(candidates)+1)
-        np.random.shuffle(ballots[:,i])
-    
+    ballots = simulate.make_ballots(np.random.default_rng(), 'impartial', 'STV', n_voters, len(candidates))
+
     return run_election(candidates, ballots, n_winners)
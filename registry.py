@@ -0,0 +1,114 @@
+# This file keeps track of the open polls, and saves what's needed to bring them back after a restart
+# polls are looked up by (guild ID, poll name), so two servers can both have a poll called "lunch",
+# and when the bot's shards are split across processes each one only holds the polls of its own guilds
+import json
+import logging
+import os
+
+
+def shard_of(guild_id, shard_count):
+    # the shard discord sends a guild's events to (DMs always go to shard 0)
+    if guild_id is None or not shard_count:
+        return 0
+    return (guild_id >> 22) % shard_count
+
+
+class PollRegistry:
+
+    def __init__(self, path='polls.json', shard_ids=None, shard_count=None):
+        self.path = path                # where the poll metadata is saved
+        self.polls = {}                 # (guild ID, poll name) -> Poll
+        self.keys = {}                  # short poll key (used in component custom_ids) -> Poll
+        self.legacy = set()             # names of polls saved before polls were kept per guild, found from any guild
+        self.shard_ids = None           # shards whose polls are kept here (None for all of them)
+        self.shard_count = None         # total number of shards the bot runs as
+        self._others = []               # saved records of polls on shards run by other processes, kept as they are
+        self._base_path = path
+        self.set_shards(shard_ids, shard_count)
+
+    def set_shards(self, shard_ids, shard_count):
+        # with only some of the shards in this process, the polls are saved to a file of their own (e.g. polls.shards-0-1.json)
+        # so the processes don't write over each other, each process has to be given the same shards every time it starts
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.path = self._base_path
+        if shard_ids is not None:
+            base, ext = os.path.splitext(self._base_path)
+            self.path = f'{base}.shards-{"-".join(str(i) for i in sorted(shard_ids))}{ext}'
+
+    def owns(self, guild_id):
+        return self.shard_ids is None or shard_of(guild_id, self.shard_count) in self.shard_ids
+
+    def __getitem__(self, key):
+        poll = self.get(key)
+        if poll is None:
+            raise KeyError(key)
+        return poll
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.polls)
+
+    def get(self, key, default=None):
+        # key is (guild ID, poll name), polls saved before they were kept per guild have no guild and are found from anywhere
+        # (polls made in DMs have no guild either, but they're only found from DMs)
+        poll = self.polls.get(key)
+        if poll is None and key[1] in self.legacy:
+            poll = self.polls.get((None, key[1]))
+        return default if poll is None else poll
+
+    def values(self):
+        return self.polls.values()
+
+    def by_key(self, key):
+        return self.keys.get(key)
+
+    def add(self, poll, save=True, legacy=False):
+        self.polls[poll.guild_id, poll.name] = poll
+        self.keys[poll.key] = poll
+        if legacy:
+            self.legacy.add(poll.name)
+        if save:
+            self.save()
+
+    def pop(self, key):
+        poll = self.polls.pop(key)
+        self.keys.pop(poll.key, None)
+        if poll.guild_id is None:
+            self.legacy.discard(poll.name)
+        self.save()
+        return poll
+
+    def save(self):
+        # write to a temporary file first so a crash halfway through can't leave a broken registry behind
+        records = [poll.to_record() for poll in self.polls.values()]
+        for record in records:
+            if record['guild_id'] is None and record['name'] in self.legacy:
+                record['legacy'] = True
+        records += self._others
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(records, file, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def load_records(self):
+        # the saved metadata for every poll on this process's shards that was open when the bot last stopped
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'r') as file:
+                records = json.load(file)
+        except (OSError, ValueError):
+            logging.exception(f'Could not read the poll registry {self.path}, no polls will be restored')
+            return []
+        # polls saved before they were kept per guild have no guild_id at all, they stay flagged as such from here on
+        # (unlike polls made in DMs, which have a guild_id of None)
+        for record in records:
+            if 'guild_id' not in record:
+                record['legacy'] = True
+        self._others = [record for record in records if not self.owns(record.get('guild_id'))]
+        if self._others:
+            logging.warning(f'{len(self._others)} poll(s) in {self.path} belong to shards this process does not run, leaving them be')
+        return [record for record in records if self.owns(record.get('guild_id'))]
@@ -0,0 +1,84 @@
+# This file holds the results of an election in a compact form, the text printout is only made when somebody asks for it
+import numpy as np
+
+
+class ElectionRound:
+
+    def __init__(self, number, tallies, total, won, eliminated=None):
+        self.number = number                                                    # round number, starting from 1
+        self.tallies = np.array(tallies)                                        # votes (or stars) for each candidate this round
+        self.total = total                                                      # total votes (or stars) cast this round
+        self.won = np.array(won)                                                # which candidates had won when the tallies were made
+        self.eliminated = None if eliminated is None else np.array(eliminated)  # which candidates had been eliminated (STV only)
+        self.events = []                                                        # what happened this round, as (kind, candidate, value)
+
+    def add_event(self, kind, candidate=None, value=None):
+        self.events.append((kind, candidate, value))
+
+
+class FinalTally:
+
+    def __init__(self, candidates, tallies, total, won, eliminated=None):
+        self.candidates = np.array(candidates)                                  # indices of the candidates in the final tally
+        self.tallies = None if tallies is None else np.array(tallies)           # their final votes, if there are any to show
+        self.total = total
+        self.won = np.array(won)
+        self.eliminated = None if eliminated is None else np.array(eliminated)
+
+
+class ElectionResult:
+
+    def __init__(self, method, candidates, n_votes, n_winners=1):
+        self.method = method                        # 'STV', 'STAR' or 'CONDORCET'
+        self.candidates = list(candidates)          # names of the candidates
+        self.n_votes = n_votes                      # number of ballots that were counted
+        self.n_winners = n_winners                  # number of winners the election was looking for
+        self.rounds = []                            # ElectionRound for each round of counting
+        self.winners = []                           # indices of the winning candidates, in the order they won
+        self.final = None                           # FinalTally once the election is done
+        self.aborted = False                        # set if the counting had to be stopped early
+        self.pairwise = None                        # pairwise preference matrix (CONDORCET only)
+
+    def add_round(self, number, tallies, total, won, eliminated=None):
+        rnd = ElectionRound(number, tallies, total, won, eliminated)
+        self.rounds.append(rnd)
+        return rnd
+
+    def set_final(self, candidates, tallies, total, won, eliminated=None):
+        self.final = FinalTally(candidates, tallies, total, won, eliminated)
+
+    @property
+    def winner_names(self):
+        return [self.candidates[w] for w in self.winners]
+
+    def summary(self):
+        # one short line per round saying who won or got knocked out, for previews (render() has the full printout)
+        lines = []
+        for rnd in self.rounds:
+            won = [self.candidates[c] for kind, c, _ in rnd.events if kind in ('won', 'won_remaining')]
+            eliminated = [self.candidates[c] for kind, c, _ in rnd.events if kind == 'eliminated']
+            parts = []
+            if won:
+                parts.append('won: ' + ', '.join(won))
+            if eliminated:
+                parts.append('eliminated: ' + ', '.join(eliminated))
+            lines.append(f'Round {rnd.number}: ' + ('; '.join(parts) or 'no change'))
+        return lines
+
+    def render(self):
+        # the text printout of the election, one string for each message that should be sent
+        if self.method == 'STV':
+            import rcv
+            return rcv.render_result(self)
+        elif self.method == 'CONDORCET':
+            import condorcet
+            return condorcet.render_result(self)
+        else:
+            import star
+            return star.render_result(self)
+
+
+def pad_names(candidates):
+    # pad candidate names with spaces so printing looks uniform
+    maxcharlen = max(len(cand) for cand in candidates)
+    return np.array([cand + ' '*(maxcharlen - len(cand)) for cand in candidates])
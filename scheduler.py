@@ -0,0 +1,84 @@
+# This file handles the timing for every open poll: closing them right on their deadline
+# and refreshing all of their embeds together, instead of every poll running its own loop
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+
+class PollScheduler:
+
+    def __init__(self, refresh_interval=60):
+        self.refresh_interval = refresh_interval        # seconds between embed refreshes
+        self.polls = set()                              # the open polls being tracked
+        self._deadlines = []                            # heap of (deadline, tiebreak counter, poll)
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()                  # set whenever the next wakeup time might have changed
+        self._task = None
+        self._refresh_task = None                       # the embed refresh going on right now, if any
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def add(self, poll):
+        self.polls.add(poll)
+        heapq.heappush(self._deadlines, (poll.deadline, next(self._counter), poll))
+        self._wakeup.set()
+
+    def remove(self, poll):
+        # the heap entry is left behind and skipped once it comes up
+        self.polls.discard(poll)
+
+    async def run(self):
+        next_refresh = time.monotonic() + self.refresh_interval
+        while True:
+            now = time.monotonic()
+
+            # close every poll that has reached its deadline
+            while self._deadlines and self._deadlines[0][0] <= now:
+                _, _, poll = heapq.heappop(self._deadlines)
+                if poll in self.polls:
+                    self.polls.discard(poll)
+                    asyncio.create_task(self._run_logged(poll.close(), f'closing the poll "{poll.name}"'))
+
+            # refresh all the embeds in one go, in the background so deadlines never wait on it
+            # (if the last refresh still hasn't finished, this one is skipped)
+            if now >= next_refresh:
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._refresh_task = asyncio.create_task(self._run_logged(self.refresh_all(), 'refreshing the embeds'))
+                next_refresh = now + self.refresh_interval
+
+            # sleep until the next deadline or refresh, or until a new poll shows up
+            wake = next_refresh
+            if self._deadlines:
+                wake = min(wake, self._deadlines[0][0])
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(wake - time.monotonic(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def refresh_all(self):
+        polls = list(self.polls)
+        results = await asyncio.gather(*(poll.refresh_embed() for poll in polls), return_exceptions=True)
+        n_edited = 0
+        for poll, res in zip(polls, results):
+            if isinstance(res, Exception):
+                logging.error(f'Failed to refresh the embed for the poll "{poll.name}": {res!r}')
+            elif res:
+                n_edited += 1
+        if polls:
+            logging.info(f'Refreshed poll embeds: {n_edited} of {len(polls)} changed')
+
+    async def _run_logged(self, coro, what):
+        try:
+            await coro
+        except Exception:
+            logging.exception(f'Something went wrong while {what}')
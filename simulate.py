@@ -0,0 +1,175 @@
+# This file makes up ballots for fake elections, for stress-testing the election code and planning poll sizes
+# every model draws a utility for each (candidate, voter) pair in one go, and the ballots are read off of those:
+#   impartial  - every voter's preferences are independent and uniformly random
+#   spatial    - voters and candidates sit in an issue space, and voters prefer the candidates closest to them
+#   polarized  - like spatial, but the voters are clumped into a few blocs
+#   truncated  - spatial, but each voter only ranks (or scores) a random number of their favourites
+# e.g. `python simulate.py --model polarized --voters 1000000 --candidates 10 --elections 16` runs a batch across processes
+import argparse
+import concurrent.futures
+import time
+
+import numpy as np
+
+import ballot_store
+import condorcet
+import rcv
+import star
+
+MODELS = ('impartial', 'spatial', 'polarized', 'truncated')
+
+# ballots are generated this many voters at a time so the float utilities never get too big
+CHUNK_SIZE = 2**20
+
+
+def draw_utilities(rng, model, n_voters, n_cands, dims=2, n_blocs=2, spread=0.3, cand_pos=None):
+    # (candidates, voters) array of how much each voter likes each candidate, bigger is better
+    if model == 'impartial':
+        return rng.random((n_cands, n_voters))
+    if cand_pos is None:
+        cand_pos = rng.normal(size=(n_cands, dims))
+    if model == 'polarized':
+        # the bloc centres are spaced out evenly along the first issue, then voters scatter around them
+        centres = np.zeros((n_blocs, cand_pos.shape[1]))
+        centres[:, 0] = np.linspace(-1.5, 1.5, n_blocs)
+        voter_pos = centres[rng.integers(0, n_blocs, size=n_voters)] + spread * rng.normal(size=(n_voters, cand_pos.shape[1]))
+    elif model in ('spatial', 'truncated'):
+        voter_pos = rng.normal(size=(n_voters, cand_pos.shape[1]))
+    else:
+        raise ValueError(f'Unknown voter model "{model}", should be one of {MODELS}')
+    # -distance, the squares are expanded out so no (candidates, voters, dims) array has to be made
+    sq = (cand_pos**2).sum(1)[:, None] - 2 * cand_pos @ voter_pos.T + (voter_pos**2).sum(1)[None, :]
+    return -np.sqrt(np.maximum(sq, 0))
+
+
+def utilities_to_ranks(utilities):
+    # rank 1 for each voter's favourite, then 2, ...
+    n_cands, n_voters = utilities.shape
+    order = np.argsort(-utilities, axis=0)
+    ranks = np.empty(utilities.shape, dtype=int)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(1, n_cands + 1)[:, None], utilities.shape), axis=0)
+    return ranks
+
+
+def utilities_to_scores(utilities):
+    # each voter gives their favourite MAX_STARS stars and their least favourite 0, everyone else in between
+    lo = utilities.min(axis=0)
+    span = utilities.max(axis=0) - lo
+    span[span == 0] = 1
+    return np.rint(star.MAX_STARS * (utilities - lo) / span).astype(int)
+
+
+def draw_depths(rng, n_voters, n_cands, mean_depth):
+    # how many candidates each voter bothers to rank, at least 1 and on average about mean_depth
+    return np.minimum(1 + rng.poisson(max(mean_depth - 1, 0), size=n_voters), n_cands)
+
+
+def make_ballots(rng, model, poll_type, n_voters, n_cands, depth=0, mean_depth=None, chunk_size=CHUNK_SIZE, **params):
+    # (candidates, voters) ballots for a poll of the given type ('STV', 'STAR' or 'CONDORCET')
+    # depth cuts every ballot off after that many candidates (0 means no cut-off), the truncated model
+    # instead draws a depth for each voter, averaging mean_depth (a third of the candidates if it isn't given)
+    if model == 'truncated' and mean_depth is None:
+        mean_depth = max(n_cands / 3, 1)
+    # the candidates stay put between chunks, only the voters are drawn again
+    if model != 'impartial' and params.get('cand_pos') is None:
+        params['cand_pos'] = rng.normal(size=(n_cands, params.get('dims', 2)))
+    ballots = np.empty((n_cands, n_voters), dtype=ballot_store.BALLOT_DTYPE)
+    for start in range(0, n_voters, chunk_size):
+        n = min(chunk_size, n_voters - start)
+        utilities = draw_utilities(rng, model, n, n_cands, **params)
+        ranks = utilities_to_ranks(utilities)
+        if poll_type != 'STAR':
+            chunk = ranks
+        else:
+            chunk = utilities_to_scores(utilities)
+        # anything past a voter's cut-off is left off their ballot
+        cutoff = None
+        if mean_depth is not None:
+            cutoff = draw_depths(rng, n, n_cands, mean_depth)[None, :]
+        elif 0 < depth < n_cands:
+            cutoff = depth
+        if cutoff is not None:
+            chunk[ranks > cutoff] = 0
+        ballots[:, start:start+n] = chunk
+    return ballots
+
+
+def write_ballot_file(name, rng, model, poll_type, n_voters, n_cands, n_winners=1, depth=0, reweight=False, **params):
+    # make up the ballots for one poll straight into a ballot file (see ballot_store), a chunk at a time,
+    # so polls much bigger than memory can be made for the out-of-core election code
+    if model != 'impartial' and params.get('cand_pos') is None:
+        params['cand_pos'] = rng.normal(size=(n_cands, params.get('dims', 2)))
+    chunks = (make_ballots(rng, model, poll_type, min(CHUNK_SIZE, n_voters - start), n_cands, depth=depth, **params)
+              for start in range(0, n_voters, CHUNK_SIZE))
+    ballot_store.write_ballot_file(name, [f'cand{i}' for i in range(n_cands)], chunks, n_voters, poll_type, n_winners,
+                                   reweight)
+
+
+def run_one(seed, model, poll_type, n_voters, n_cands, n_winners=1, depth=0, params=None, reweight=False):
+    # one simulated election, run in a worker process, so only plain data goes back
+    rng = np.random.default_rng(seed)
+    t0 = time.perf_counter()
+    ballots = make_ballots(rng, model, poll_type, n_voters, n_cands, depth=depth, **(params or {}))
+    t1 = time.perf_counter()
+    if poll_type == 'STV':
+        result = rcv.run_election([f'cand{i}' for i in range(n_cands)], ballots, n_winners)
+    elif poll_type == 'CONDORCET':
+        result = condorcet.run_election([f'cand{i}' for i in range(n_cands)], ballots, n_winners)
+    else:
+        result = star.run_election([f'cand{i}' for i in range(n_cands)], ballots, n_winners, reweight=reweight)
+    t2 = time.perf_counter()
+    return dict(winners=[int(w) for w in result.winners], rounds=len(result.rounds), n_votes=result.n_votes,
+                generate_seconds=t1 - t0, election_seconds=t2 - t1)
+
+
+def run_batch(n_elections, model, poll_type, n_voters, n_cands, n_winners=1, depth=0, seed=0, jobs=None, params=None,
+              reweight=False):
+    # a batch of independent elections, each gets its own child of the seed so the batch gives the same results
+    # no matter how many processes it's split across (or in what order they finish)
+    seeds = np.random.SeedSequence(seed).spawn(n_elections)
+    args = (model, poll_type, n_voters, n_cands, n_winners, depth, params, reweight)
+    if jobs == 1:
+        return [run_one(s, *args) for s in seeds]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(run_one, seeds, *([a] * n_elections for a in args)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a batch of simulated elections')
+    parser.add_argument('--model', choices=MODELS, default='spatial')
+    parser.add_argument('--type', choices=['STV', 'STAR', 'CONDORCET'], default='STV')
+    parser.add_argument('--voters', type=int, default=100000)
+    parser.add_argument('--candidates', type=int, default=5)
+    parser.add_argument('--winners', type=int, default=1)
+    parser.add_argument('--reweight', action='store_true', help='count multi-winner STAR elections by reweighting ballots')
+    parser.add_argument('--depth', type=int, default=0, help='cut every ballot off after this many candidates (0 for no cut-off)')
+    parser.add_argument('--elections', type=int, default=8, help='number of elections in the batch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', '-j', type=int, help='worker processes (defaults to one per CPU)')
+    parser.add_argument('--dims', type=int, default=2, help='dimensions of the issue space')
+    parser.add_argument('--blocs', type=int, default=2, help='number of voter blocs for the polarized model')
+    parser.add_argument('--write', metavar='NAME', help="write one poll's ballots to the ballot file NAME.ballots.npy instead of running a batch")
+    args = parser.parse_args()
+
+    params = dict(dims=args.dims)
+    if args.model == 'polarized':
+        params['n_blocs'] = args.blocs
+    if args.write:
+        write_ballot_file(args.write, np.random.default_rng(args.seed), args.model, args.type, args.voters, args.candidates,
+                          args.winners, args.depth, args.reweight, **params)
+        print(f'Wrote {args.voters} ballots to {args.write}{ballot_store.BALLOT_FILE_SUFFIX}')
+        return
+    t0 = time.perf_counter()
+    batch = run_batch(args.elections, args.model, args.type, args.voters, args.candidates, args.winners,
+                      args.depth, args.seed, args.jobs, params, args.reweight)
+    wall = time.perf_counter() - t0
+    for i, res in enumerate(batch):
+        print(f'election {i}: winners {res["winners"]} after {res["rounds"]} rounds '
+              f'(generated in {res["generate_seconds"]:.3f}s, counted in {res["election_seconds"]:.3f}s)')
+    election_times = np.array([res['election_seconds'] for res in batch])
+    print(f'{args.elections} elections of {args.voters} voters in {wall:.2f}s, count time '
+          f'mean {election_times.mean():.3f}s, max {election_times.max():.3f}s')
+
+
+if __name__ == '__main__':
+    main()
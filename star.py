@@ -1,40 +1,41 @@
 import numpy as np
 
+import ballot_store
+import results
 
-def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1):
+# the most stars a ballot can give a candidate
+MAX_STARS = 5
+
+
+def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1, reweight: bool = False):
     # candidates should be a 1D array labeling each candidate in the vote
     # ballots should be a 2D array: first index iterates over candidates, second index iterates over voters
     #    for example, if there are 5 candidates index [:,2] should look like [5,3,1,2,4] giving the rankings of each candidate
     #    anything 0 or lower means no vote, i.e. [0,0,1,2,0] would indicate that no vote should be counted for the 1st, 2nd, or 5th candidate
     # n_winners is an integer specifying how many winners the poll should have, it defaults to 1
     # if n_winners is > 1, the voting uses the Single Transferable Vote (STV)
-    output = np.array([''], dtype=object)
-
-    # pad candidate names with spaces so printing looks uniform
-    candidates_padded = np.copy(candidates)
-    maxcharlen = np.max([len(cand) for cand in candidates])
-    for c in range(len(candidates_padded)):
-        diff = maxcharlen - len(candidates_padded[c])
-        if diff > 0:
-            candidates_padded[c] += ' '*diff
-
-    msg = 'BEGINNING ELECTION'
-    output[0] = msg
-    j = 1
-
+    # reweight switches the multi-winner rounds from removing 1/n of the winner's supporters to reweighting every ballot
+    #    by 1/(1 + stars given to the winners so far / MAX_STARS), so support is used up proportionally
     won = np.zeros(len(candidates), dtype=bool)
+    result = results.ElectionResult('STAR', candidates, ballots.shape[1], n_winners)
+    j = 1
 
     if n_winners > 1:
 
+        # work on a copy since the ballots get modified between rounds
+        ballots = np.array(ballots)
+        weights = np.ones(ballots.shape[1])
+
         # Loop until we've chosen enough winners
 
         while np.sum(won) < n_winners:
 
-            output = np.append(output, np.array(['']))
-
             # count up all the stars 
-            stars = np.sum(ballots, axis=1)
-            n_stars = np.sum(ballots)
+            if reweight:
+                stars = ballots @ weights
+            else:
+                stars = np.sum(ballots, axis=1, dtype=np.int64)
+            n_stars = np.sum(stars)
 
             # pick the highest count as the winner
             won_stars = stars[won] 
@@ -43,128 +44,229 @@ def run_election(candidates: np.ndarray, ballots: np.ndarray, n_winners: int = 1
             stars[won] = won_stars
             won[win] = True
 
-            msg = f'### STAR TALLIES FOR ROUND {j} ###'
-            output[j] = msg + '\n'
-            output[j] += print_star_tallies(candidates_padded, stars, n_stars, won)
-            msg = f'####################################'
-            output[j] += msg + '\n'
-
-            msg = f'RESULTS: {candidates_padded[win]} HAS WON THE ELECTION' 
-            output[j] += msg + '\n'
+            rnd = result.add_round(j, stars, n_stars, won)
+            rnd.add_event('won', win)
+            result.winners.append(win)
 
             if np.sum(won) < n_winners:
-                # remove 1/n voters that voted for the winner for the next round
-                win_voters = []
-                for k in range(ballots.shape[1]): 
-                    if ballots[win,k] == np.max(ballots[:,k]):
-                        win_voters.append(k)
-                n_win_voters = len(win_voters)
-                n_to_remove = int(n_win_voters/n_winners)
-
-                msg = f'{n_to_remove} OF THEIR VOTES WILL BE CONSIDERED "COUNTED" AND REMOVED FOR THE NEXT ROUND'
-                output[j] += msg + '\n'
-
-                ballots[:,win_voters[:n_to_remove]] = 0
+                if reweight:
+                    # every ballot keeps counting, but less the more it has already helped elect
+                    weights = 1 / (1 + np.sum(ballots[won,:], axis=0) / MAX_STARS)
+                    rnd.add_event('reweighted', win)
+                else:
+                    # remove 1/n voters that voted for the winner for the next round
+                    win_voters = np.where(ballots[win,:] == np.max(ballots, axis=0))[0]
+                    n_win_voters = len(win_voters)
+                    n_to_remove = int(n_win_voters/n_winners)
+
+                    rnd.add_event('removed', win, n_to_remove)
+
+                    ballots[:,win_voters[:n_to_remove]] = 0
             
             j += 1
-        
 
-        output = np.append(output, np.array(['']))
-        
-        # do a final print-out
-        msg = f'### FINAL RESULTS            ###'
-        output[j] += msg + '\n'
-        output[j] += print_final_results(candidates_padded, None, 0, won)
-        msg = f'################################'
-        output[j] += msg + '\n'
-        msg = f'I LOVE DEMOCRACY'
-        output[j] += msg
+        result.set_final(np.arange(len(candidates)), None, 0, won)
     
     else:
 
         # count up all the stars 
-        stars = np.sum(ballots, axis=1)
-        n_stars = np.sum(ballots)
+        # (the sums are kept signed, adding up unsigned ballots would give unsigned totals)
+        stars = np.sum(ballots, axis=1, dtype=np.int64)
+        n_stars = np.sum(stars)
 
         # Pick the TWO highest candidates 
         ss = np.argsort(stars)
         won[ss[-2:]] = True
     
-        output = np.append(output, np.array(['']))
-
-        msg = f'### STAR TALLIES FOR ROUND 1 ###'
-        output[1] = msg + '\n'
-        output[1] += print_star_tallies(candidates_padded, stars, n_stars, won)
-        msg = f'####################################'
-        output[1] += msg + '\n'
-
-        msg = f'RESULTS: {candidates_padded[won][0]} AND {candidates_padded[won][1]} HAVE PASSED ROUND ONE'  
-        output[1] += msg + '\n'
-        msg = f'THEY WILL NOW FACE OFF IN A HEAD-TO-HEAD MATCH'  
-        output[1] += msg + '\n'
+        rnd = result.add_round(1, stars, n_stars, won)
+        rnd.add_event('runoff', np.where(won)[0])
 
         # only consider ballots from the 2 highest performers
-        ballots2 = ballots[won,:]
-        candidates2 = candidates_padded[won]
-        # give each candidate ONE vote based on whoever was ranked higher
-        for j in range(ballots2.shape[1]):
-            if ballots2[0,j] > ballots2[1,j]:
-                ballots2[0,j] = 1
-                ballots2[1,j] = 0
-            elif ballots2[0,j] < ballots2[1,j]:
-                ballots2[0,j] = 0
-                ballots2[1,j] = 1
-            else:
-                ballots2[0,j] = 0
-                ballots2[1,j] = 0
+        # give each candidate ONE vote based on whoever was ranked higher (ties give nobody a vote)
+        finalists = np.where(won)[0]
+        stars0 = ballots[finalists[0],:]
+        stars1 = ballots[finalists[1],:]
+        votes = np.array([np.sum(stars0 > stars1), np.sum(stars1 > stars0)])
         
         # count the final round
-        won = np.zeros(len(candidates2), dtype=bool)
-        votes = np.sum(ballots2, axis=1)
-        n_votes = np.sum(ballots2)
+        won = np.zeros(len(finalists), dtype=bool)
+        n_votes = np.sum(votes)
         win = np.argmax(votes)
         won[win] = True
+        result.winners.append(finalists[win])
 
-        output = np.append(output, np.array(['']))
-
-        # do a final print-out
-        msg = f'### FINAL RESULTS            ###'
-        output[2] += msg + '\n'
-        output[2] += print_final_results(candidates2, votes, n_votes, won)
-        msg = f'################################'
-        output[2] += msg + '\n'
-        msg = f'I LOVE DEMOCRACY'
-        output[2] += msg
+        result.set_final(finalists, votes, n_votes, won)
     
+    return result
+
+
+def run_election_chunked(candidates, ballot_file, n_winners=1, reweight=False, chunk_size=ballot_store.CHUNK_SIZE):
+    # the same as run_election, for a (voters, candidates) ballot file that's too big to load, read a chunk at a time
+    # a single winner takes two passes over the file (the star totals, then the runoff between the top two)
+    # with more winners, each round takes a pass to count the stars, and (without reweighting) two more to find
+    # and remove the winner's supporters, who are tracked with one bit per voter instead of by zeroing their ballots
+    # (with reweighting the totals are added up chunk by chunk, so they can differ from run_election by rounding)
+    n_voters = ballot_file.shape[0]
+    won = np.zeros(len(candidates), dtype=bool)
+    result = results.ElectionResult('STAR', candidates, n_voters, n_winners)
+
+    def chunks():
+        return ballot_store.iter_chunks(ballot_file, chunk_size)
+
+    if n_winners > 1:
+
+        if chunk_size % 8 != 0:
+            raise ValueError('chunk_size has to be a multiple of 8 to keep track of removed voters')
+        removed = np.zeros((n_voters + 7) // 8, dtype=np.uint8)
+
+        def current(start, chunk):
+            # the chunk as it would look in run_election, with removed voters' ballots zeroed
+            mask = np.unpackbits(removed[start//8:(start + chunk.shape[1] + 7)//8], count=chunk.shape[1]).astype(bool)
+            return np.where(mask, 0, chunk), mask
+
+        j = 1
+        while np.sum(won) < n_winners:
+
+            # count up all the stars
+            if reweight:
+                stars = np.zeros(len(candidates))
+                for start, chunk in chunks():
+                    weights = 1 / (1 + np.sum(chunk[won, :], axis=0) / MAX_STARS)
+                    stars += chunk @ weights
+            else:
+                stars = np.zeros(len(candidates), dtype=np.int64)
+                for start, chunk in chunks():
+                    stars += np.sum(current(start, chunk)[0], axis=1, dtype=np.int64)
+            n_stars = np.sum(stars)
+
+            # pick the highest count as the winner
+            won_stars = stars[won]
+            stars[won] = -999
+            win = np.argmax(stars)
+            stars[won] = won_stars
+            won[win] = True
+
+            rnd = result.add_round(j, stars, n_stars, won)
+            rnd.add_event('won', win)
+            result.winners.append(win)
+
+            if np.sum(won) < n_winners:
+                if reweight:
+                    rnd.add_event('reweighted', win)
+                else:
+                    # remove 1/n voters that voted for the winner for the next round, the first ones in voting order
+                    n_win_voters = 0
+                    for start, chunk in chunks():
+                        ballots = current(start, chunk)[0]
+                        n_win_voters += np.sum(ballots[win, :] == np.max(ballots, axis=0))
+                    n_to_remove = int(n_win_voters/n_winners)
+
+                    rnd.add_event('removed', win, n_to_remove)
+
+                    left = n_to_remove
+                    for start, chunk in chunks():
+                        if left <= 0:
+                            break
+                        ballots, mask = current(start, chunk)
+                        win_voters = np.where(ballots[win, :] == np.max(ballots, axis=0))[0][:left]
+                        mask[win_voters] = True
+                        removed[start//8:start//8 + (len(mask) + 7)//8] = np.packbits(mask)
+                        left -= len(win_voters)
+
+            j += 1
+
+        result.set_final(np.arange(len(candidates)), None, 0, won)
+
+    else:
+
+        # count up all the stars
+        stars = np.zeros(len(candidates), dtype=np.int64)
+        for start, chunk in chunks():
+            stars += np.sum(chunk, axis=1, dtype=np.int64)
+        n_stars = np.sum(stars)
+
+        # Pick the TWO highest candidates
+        ss = np.argsort(stars)
+        won[ss[-2:]] = True
+
+        rnd = result.add_round(1, stars, n_stars, won)
+        rnd.add_event('runoff', np.where(won)[0])
+
+        # give each finalist ONE vote for each ballot that scored them higher (ties give nobody a vote)
+        finalists = np.where(won)[0]
+        votes = np.zeros(2, dtype=np.int64)
+        for start, chunk in chunks():
+            stars0 = chunk[finalists[0], :]
+            stars1 = chunk[finalists[1], :]
+            votes += [np.sum(stars0 > stars1), np.sum(stars1 > stars0)]
+
+        # count the final round
+        won = np.zeros(len(finalists), dtype=bool)
+        n_votes = np.sum(votes)
+        win = np.argmax(votes)
+        won[win] = True
+        result.winners.append(finalists[win])
+
+        result.set_final(finalists, votes, n_votes, won)
+
+    return result
+
+
+def render_result(result):
+    # turn an ElectionResult into the text printout, one string for each round
+    candidates_padded = results.pad_names(result.candidates)
+    output = ['BEGINNING ELECTION']
+    for rnd in result.rounds:
+        parts = [f'### STAR TALLIES FOR ROUND {rnd.number} ###\n',
+                 print_star_tallies(candidates_padded, rnd.tallies, rnd.total, rnd.won),
+                 '####################################\n']
+        for kind, c, value in rnd.events:
+            if kind == 'won':
+                parts.append(f'RESULTS: {candidates_padded[c]} HAS WON THE ELECTION\n')
+            elif kind == 'reweighted':
+                parts.append('THE BALLOTS OF THEIR SUPPORTERS WILL BE REWEIGHTED FOR THE NEXT ROUND\n')
+            elif kind == 'removed':
+                parts.append(f'{value} OF THEIR VOTES WILL BE CONSIDERED "COUNTED" AND REMOVED FOR THE NEXT ROUND\n')
+            elif kind == 'runoff':
+                parts.append(f'RESULTS: {candidates_padded[c[0]]} AND {candidates_padded[c[1]]} HAVE PASSED ROUND ONE\n')
+                parts.append('THEY WILL NOW FACE OFF IN A HEAD-TO-HEAD MATCH\n')
+        output.append(''.join(parts))
+
+    # do a final print-out
+    final = result.final
+    if final is not None:
+        output.append(''.join(['### FINAL RESULTS            ###\n',
+                               print_final_results(candidates_padded[final.candidates], final.tallies, final.total, final.won),
+                               '################################\n',
+                               'I LOVE DEMOCRACY']))
     return output
 
 def print_star_tallies(candidates_padded, stars, n_stars, won):
-    output = ''
+    output = []
     for c in range(len(candidates_padded)):
         status = 'WON       ' if won[c] else 'RUNNING   '
-        msg = f'{status} | {candidates_padded[c]} | {str(int(stars[c])).zfill(4)} STARS ({stars[c]/n_stars*100:.1f}%)'
-        output += msg + '\n'
-    return output
+        output.append(f'{status} | {candidates_padded[c]} | {str(int(stars[c])).zfill(4)} STARS ({stars[c]/n_stars*100:.1f}%)\n')
+    return ''.join(output)
 
 
 def print_final_results(candidates_padded, votes, n_votes, won):
-    output = ''
+    output = []
     for c in range(len(candidates_padded)):
         status = 'WON       ' if won[c] else 'LOST      '
         if votes is not None:
-            msg = f'{status} | {candidates_padded[c]} | {str(int(votes[c])).zfill(4)} VOTES ({votes[c]/n_votes*100:.1f}%)'
+            output.append(f'{status} | {candidates_padded[c]} | {str(int(votes[c])).zfill(4)} VOTES ({votes[c]/n_votes*100:.1f}%)\n')
         else:
-            msg = f'{status} | {candidates_padded[c]}'
-        output += msg + '\n'
-    return output
+            output.append(f'{status} | {candidates_padded[c]}\n')
+    return ''.join(output)
 
 def simulate_election(n_winners=1):
 
     candidates = ['Joe', 'Mary', 'Humpty Dumpty', 'SpongeBob SquarePants', 'NGC 4609']
 
+    import simulate
     n_voters = 1000
-    ballots = np.random.randint(low=0, high=5, size=(len(candidates), n_voters))
+    ballots = simulate.make_ballots(np.random.default_rng(), 'impartial', 'STAR', n_voters, len(candidates))
 
-    output = run_election(candidates, ballots, n_winners)
+    result = run_election(candidates, ballots, n_winners)
 
-    print(''.join(output))
+    print(''.join(result.render()))
@@ -0,0 +1,167 @@
+# This file recounts closed polls from their ballot archives, without the bot
+# e.g. `python tally.py archives/ --json results.jsonl` tallies every {name}.ballot.npz under archives/ in parallel
+# (big {name}.ballots.npy ballot files are counted too, a chunk at a time without loading them)
+# (nothing here touches discord or info.txt, so it runs anywhere numpy does)
+import argparse
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import ballot_store
+import condorcet
+import rcv
+import star
+
+ARCHIVE_SUFFIX = '.ballot.npz'
+
+
+def find_archives(paths):
+    # every archive named directly, plus every archive anywhere under the directories given
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for suffix in (ARCHIVE_SUFFIX, ballot_store.BALLOT_FILE_SUFFIX):
+                found.extend(sorted(glob.glob(os.path.join(path, '**', '*' + suffix), recursive=True)))
+        else:
+            found.append(path)
+    return found
+
+
+def infer_type(ballots):
+    # archives from before the poll type was saved don't say what they are (they can't be Condorcet polls though),
+    # a ranked ballot never gives the same (nonzero) rank twice, while scores almost always repeat somewhere
+    if ballots.size == 0 or np.max(ballots) > star.MAX_STARS:
+        return 'STV'
+    ranked = np.sort(ballots, axis=0)
+    repeats = (ranked[1:] == ranked[:-1]) & (ranked[1:] > 0)
+    return 'STAR' if np.any(repeats) else 'STV'
+
+
+def tally_archive(path, poll_type=None, n_winners=None, reweight=None, render=True):
+    # runs in a worker process, so only plain data goes back
+    t0 = time.perf_counter()
+    chunked = path.endswith(ballot_store.BALLOT_FILE_SUFFIX)
+    if chunked:
+        info, ballot_file = ballot_store.open_ballot_file(path[:-len(ballot_store.BALLOT_FILE_SUFFIX)])
+        candidates = info['candidates']
+        poll_type = poll_type or info.get('type')
+        n_winners = n_winners or info.get('n_winners')
+        reweight = reweight or info.get('reweight')
+        # the type can be guessed well enough from the first chunk
+        ballots = np.asarray(ballot_file[:ballot_store.CHUNK_SIZE].T)
+    else:
+        with np.load(path) as archive:
+            candidates = [str(c) for c in archive['candidates']]
+            ballots = archive['ballots']
+            if poll_type is None and 'type' in archive:
+                poll_type = str(archive['type'])
+            if n_winners is None and 'n_winners' in archive:
+                n_winners = int(archive['n_winners'])
+            if reweight is None and 'reweight' in archive:
+                reweight = bool(archive['reweight'])
+    inferred = poll_type is None
+    if inferred:
+        poll_type = infer_type(ballots)
+    if n_winners is None:
+        n_winners = 1
+    # archives from before the STAR reweighting option was saved were all counted by removing supporters
+    reweight = bool(reweight)
+
+    if chunked:
+        if poll_type == 'STV':
+            result = rcv.run_election_chunked(candidates, ballot_file, n_winners)
+        elif poll_type == 'CONDORCET':
+            pairwise = condorcet.pairwise_matrix_chunked(ballot_file)
+            result = condorcet.run_election(candidates, ballot_file.T, n_winners, pairwise=pairwise)
+        else:
+            result = star.run_election_chunked(candidates, ballot_file, n_winners, reweight=reweight)
+    elif poll_type == 'STV':
+        result = rcv.run_election(candidates, ballots, n_winners)
+    elif poll_type == 'CONDORCET':
+        result = condorcet.run_election(candidates, ballots, n_winners)
+    else:
+        result = star.run_election(candidates, ballots, n_winners, reweight=reweight)
+    seconds = time.perf_counter() - t0
+
+    name = os.path.basename(path)
+    for suffix in (ARCHIVE_SUFFIX, ballot_store.BALLOT_FILE_SUFFIX):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return dict(path=path, name=name, type=poll_type, type_inferred=inferred, n_winners=n_winners, reweight=reweight,
+                n_votes=result.n_votes, winners=[str(w) for w in result.winner_names], rounds=len(result.rounds),
+                aborted=result.aborted, seconds=seconds, text=''.join(result.render()) if render else None)
+
+
+def tally_all(paths, poll_type=None, n_winners=None, reweight=None, jobs=None, render=True):
+    # yields results as they finish (not in the order given), errors come back as dicts with an 'error' key
+    if jobs == 1:
+        for path in paths:
+            try:
+                yield tally_archive(path, poll_type, n_winners, reweight, render)
+            except Exception as e:
+                yield dict(path=path, error=repr(e))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(tally_archive, path, poll_type, n_winners, reweight, render): path for path in paths}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield dict(path=futures[future], error=repr(e))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recount polls from their ballot archives')
+    parser.add_argument('paths', nargs='+', help='archive or ballot files, or directories to search for *.ballot.npz and *.ballots.npy')
+    parser.add_argument('--type', choices=['STV', 'STAR', 'CONDORCET'], help="count every archive as this poll type (by default it's read from the archive)")
+    parser.add_argument('--winners', type=int, help='number of winners (by default it is read from the archive)')
+    parser.add_argument('--reweight', action='store_true', default=None,
+                        help="count multi-winner STAR polls by reweighting ballots (by default it's read from the archive)")
+    parser.add_argument('--jobs', '-j', type=int, help='worker processes (defaults to one per CPU, 1 runs everything in this process)')
+    parser.add_argument('--json', nargs='?', const='-', metavar='FILE', help='write one JSON object per archive to FILE (or stdout)')
+    parser.add_argument('--quiet', '-q', action='store_true', help="only print the winners, not the round-by-round printout")
+    args = parser.parse_args()
+
+    paths = find_archives(args.paths)
+    if not paths:
+        print('No ballot archives found', file=sys.stderr)
+        sys.exit(1)
+
+    json_file = None
+    if args.json == '-':
+        json_file = sys.stdout
+    elif args.json is not None:
+        json_file = open(args.json, 'w')
+
+    n_failed = 0
+    try:
+        for res in tally_all(paths, args.type, args.winners, args.reweight, args.jobs,
+                             render=not args.quiet and json_file is not sys.stdout):
+            if 'error' in res:
+                n_failed += 1
+                print(f'{res["path"]}: could not be tallied: {res["error"]}', file=sys.stderr)
+            if json_file is not None:
+                json_file.write(json.dumps({k: v for k, v in res.items() if k != 'text'}) + '\n')
+                json_file.flush()
+            if json_file is sys.stdout or 'error' in res:
+                continue
+            guess = ' (type guessed from the ballots)' if res['type_inferred'] else ''
+            rule = ' (reweighted)' if res['reweight'] and res['type'] == 'STAR' and res['n_winners'] > 1 else ''
+            print(f'== {res["name"]}: {res["type"]}{guess}{rule}, {res["n_votes"]} votes, winners: {", ".join(res["winners"])}')
+            if res['text'] is not None:
+                print(res['text'])
+            sys.stdout.flush()
+    finally:
+        if json_file is not None and json_file is not sys.stdout:
+            json_file.close()
+    if n_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# The election counts the way they were done before the engines were vectorized, one voter at a time
+# (the same logic as the original rcv.py and star.py, minus the printing), to check the engines against
+from fractions import Fraction
+
+import numpy as np
+
+
+def rcv_winners(ballots, n_winners=1):
+    ballots = np.array(ballots, dtype=int)
+    n_cands = ballots.shape[0]
+    eliminated = np.zeros(n_cands, dtype=bool)
+    won = np.zeros(n_cands, dtype=bool)
+    n_votes = ballots.shape[1]
+    n_to_win = int((n_votes / (n_winners + 1)) + 1)
+    winners = []
+    for j in range(1, 102):
+        votes = np.sum(ballots == 1, axis=1)
+        n_left = n_cands - np.sum(eliminated) - np.sum(won)
+        if np.any(votes[~won] >= n_to_win):
+            votes[won | eliminated] = -999
+            wh = rcv_tiebreaker(ballots, np.where(votes >= n_to_win)[0])
+            winners.append(int(wh))
+            won[wh] = True
+            if len(winners) >= n_winners:
+                return winners
+            if n_winners > 1:
+                rcv_shift(np.where(ballots[wh, :] == 1)[0][n_to_win:], ballots, eliminated, won)
+                continue
+        if n_left <= n_winners - len(winners):
+            votes[won | eliminated] = -999
+            return winners + [int(c) for c in np.where(votes >= 0)[0]]
+        minvote = np.min(votes[~eliminated & ~won])
+        votes[won | eliminated] = -999
+        last = rcv_tiebreaker(ballots, np.where(votes == minvote)[0])
+        eliminated[last] = True
+        rcv_shift(np.where(ballots[last, :] == 1)[0], ballots, eliminated, won)
+    return winners
+
+
+def rcv_shift(wh, ballots, eliminated, won):
+    for whi in wh:
+        ballots[:, whi] -= 1
+        nextcand = np.where(ballots[:, whi] == 1)[0]
+        while len(nextcand) > 0 and (eliminated[nextcand] or won[nextcand]):
+            ballots[:, whi] -= 1
+            nextcand = np.where(ballots[:, whi] == 1)[0]
+
+
+def rcv_tiebreaker(ballots, wh):
+    place_check = 2
+    ballots_wh = ballots[wh, :]
+    while len(wh) > 1 and place_check <= ballots.shape[0]:
+        place_votes = np.sum(ballots_wh == place_check, axis=1)
+        wh_new = np.where(place_votes == np.min(place_votes))[0]
+        wh = wh[wh_new]
+        ballots_wh = ballots_wh[wh_new, :]
+        place_check += 1
+    return wh[0]
+
+
+def star_winners(ballots, n_winners=1):
+    ballots = np.array(ballots, dtype=int)
+    won = np.zeros(ballots.shape[0], dtype=bool)
+    if n_winners > 1:
+        winners = []
+        while np.sum(won) < n_winners:
+            stars = np.sum(ballots, axis=1)
+            stars[won] = -999
+            win = np.argmax(stars)
+            won[win] = True
+            winners.append(int(win))
+            if np.sum(won) < n_winners:
+                win_voters = []
+                for k in range(ballots.shape[1]):
+                    if ballots[win, k] == np.max(ballots[:, k]):
+                        win_voters.append(k)
+                ballots[:, win_voters[:int(len(win_voters)/n_winners)]] = 0
+        return winners
+    stars = np.sum(ballots, axis=1)
+    finalists = np.where(np.isin(np.arange(len(stars)), np.argsort(stars)[-2:]))[0]
+    votes = [0, 0]
+    for j in range(ballots.shape[1]):
+        a, b = ballots[finalists, j]
+        if a > b:
+            votes[0] += 1
+        elif b > a:
+            votes[1] += 1
+    return [int(finalists[np.argmax(votes)])]
+
+
+def star_reweighted_winners(ballots, n_winners):
+    # multi-winner STAR with every ballot weighted by 1/(1 + stars given to the winners so far / 5), in exact fractions
+    ballots = np.asarray(ballots).astype(int).tolist()
+    n_cands, n_voters = len(ballots), len(ballots[0])
+    winners = []
+    weights = [Fraction(1)] * n_voters
+    while len(winners) < n_winners:
+        stars = [sum(ballots[c][k] * weights[k] for k in range(n_voters)) for c in range(n_cands)]
+        win = max((c for c in range(n_cands) if c not in winners), key=lambda c: (stars[c], -c))
+        winners.append(win)
+        weights = [1 / (1 + Fraction(sum(ballots[w][k] for w in winners), 5)) for k in range(n_voters)]
+    return winners
+
+
+def schulze_winners(ballots, n_winners=1):
+    # the textbook Schulze method, with the same tiebreaks as condorcet.run_election
+    n_cands = ballots.shape[0]
+    d = [[0] * n_cands for _ in range(n_cands)]
+    for ballot in np.asarray(ballots).T.tolist():
+        for i in range(n_cands):
+            for j in range(n_cands):
+                if ballot[i] > 0 and (ballot[j] <= 0 or ballot[i] < ballot[j]):
+                    d[i][j] += 1
+    p = [[d[i][j] if d[i][j] > d[j][i] else 0 for j in range(n_cands)] for i in range(n_cands)]
+    for i in range(n_cands):
+        for j in range(n_cands):
+            if i != j:
+                for k in range(n_cands):
+                    if k != i and k != j:
+                        p[j][k] = max(p[j][k], min(p[j][i], p[i][k]))
+    def key(c):
+        ahead = sum(p[c][o] > p[o][c] for o in range(n_cands) if o != c)
+        head_to_head = sum(d[c][o] > d[o][c] for o in range(n_cands))
+        return (-ahead, -head_to_head, -sum(d[c]), c)
+    return sorted(range(n_cands), key=key)[:n_winners]
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+
+import ballot_store
+
+
+def fill(store, rng, n):
+    # some new voters, some amending, through every way ballots get in
+    for _ in range(n):
+        voter = int(rng.integers(0, 40))
+        ballot = rng.integers(0, 6, store.n_candidates)
+        if store.has_voted(voter):
+            store.amend(ballot, voter)
+        else:
+            store.append(ballot, voter)
+    voters = rng.choice(60, size=10, replace=False)
+    store.commit(rng.integers(0, 6, (10, store.n_candidates)), voters)
+
+
+def assert_same(store, other):
+    assert other.n_votes == store.n_votes
+    assert np.array_equal(other.ballots, store.ballots)
+    assert np.array_equal(other.voters, store.voters)
+    assert other.index == store.index
+
+
+def test_journal_round_trip(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(0)
+    store = ballot_store.BallotStore('poll', 4)
+    fill(store, rng, 50)
+    store.close_journal()
+    recovered = ballot_store.BallotStore.recover('poll', 4)
+    assert_same(store, recovered)
+    # the recovered store keeps adding to the same journal
+    fill(recovered, rng, 20)
+    recovered.close_journal()
+    assert_same(recovered, ballot_store.BallotStore.recover('poll', 4))
+
+
+def test_version_1_journal(tmp_path, monkeypatch):
+    # the old journals stored every record as int64s, they're read back and written out again in the new format
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(1)
+    voters = np.array([5, 9, 5, 12])
+    ballots = rng.integers(0, 6, (4, 3))
+    header = np.array([(ballot_store.JOURNAL_MAGIC, 1, 3)], dtype=ballot_store.JOURNAL_HEADER)
+    with open('poll.ballot.journal', 'wb') as file:
+        file.write(header.tobytes())
+        file.write(np.column_stack((voters, ballots)).astype('<i8').tobytes())
+    store = ballot_store.BallotStore.recover('poll', 3)
+    assert store.index == {5: 0, 9: 1, 12: 2}
+    assert np.array_equal(store.ballots, ballots[[2, 1, 3]].T)
+    assert store.ballots.dtype == ballot_store.BALLOT_DTYPE
+    fill(store, rng, 10)
+    store.close_journal()
+    assert np.fromfile('poll.ballot.journal', dtype=ballot_store.JOURNAL_HEADER, count=1)[0]['version'] == 2
+    assert_same(store, ballot_store.BallotStore.recover('poll', 3))
+
+
+def test_truncated_record(tmp_path, monkeypatch):
+    # a crash halfway through a write leaves part of a record at the end, that ballot is lost but nothing else
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(2)
+    store = ballot_store.BallotStore('poll', 5)
+    for voter in range(10):
+        store.append(rng.integers(0, 6, 5), voter)
+    store.close_journal()
+    with open('poll.ballot.journal', 'r+b') as file:
+        file.truncate(os.path.getsize('poll.ballot.journal') - 3)
+    recovered = ballot_store.BallotStore.recover('poll', 5)
+    assert recovered.n_votes == 9
+    assert np.array_equal(recovered.ballots, store.ballots[:, :9])
+    # and ballots added after the recovery come back too
+    recovered.append(np.array([1, 2, 3, 4, 5]), 99)
+    recovered.close_journal()
+    again = ballot_store.BallotStore.recover('poll', 5)
+    assert again.n_votes == 10
+    assert again.get_ballot(99).tolist() == [1, 2, 3, 4, 5]
+    assert np.array_equal(again.ballots[:, :9], store.ballots[:, :9])
+
+
+def test_existing_journal_kept(tmp_path, monkeypatch):
+    # a new poll never writes over a journal that's already there, it's moved aside with its ballots intact
+    monkeypatch.chdir(tmp_path)
+    rng = np.random.default_rng(3)
+    old = ballot_store.BallotStore('poll', 4)
+    fill(old, rng, 20)
+    old.close_journal()
+    new = ballot_store.BallotStore('poll', 4)
+    new.append(np.array([1, 2, 3, 4]), 7)
+    new.close_journal()
+    assert ballot_store.BallotStore.recover('poll', 4).index == {7: 0}
+    stale, = [path for path in os.listdir() if path.startswith('poll.ballot.journal.')]
+    os.replace(stale, 'old.ballot.journal')
+    assert_same(old, ballot_store.BallotStore.recover('old', 4))
@@ -0,0 +1,78 @@
+# the vectorized engines against the original per-voter counts (see reference.py), on seeded random ballots
+import numpy as np
+import pytest
+
+import ballot_store
+import condorcet
+import reference
+import simulate
+import star
+
+
+def random_poll(seed, poll_type):
+    rng = np.random.default_rng(seed)
+    n_cands = int(rng.integers(2, 7))
+    model = rng.choice(['impartial', 'spatial', 'truncated'])
+    ballots = simulate.make_ballots(rng, model, poll_type, int(rng.integers(1, 300)), n_cands,
+                                    depth=int(rng.integers(0, n_cands)))
+    return [f'c{i}' for i in range(n_cands)], ballots, int(rng.integers(1, n_cands + 1))
+
+
+def write_ballot_file(tmp_path, candidates, ballots):
+    name = str(tmp_path / 'poll')
+    ballot_store.write_ballot_file(name, candidates, [ballots], ballots.shape[1])
+    return ballot_store.open_ballot_file(name)[1]
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_star(seed):
+    candidates, ballots, n_winners = random_poll(seed, 'STAR')
+    result = star.run_election(candidates, ballots, n_winners)
+    assert [int(c) for c in result.winners] == reference.star_winners(ballots, n_winners)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_star_chunked(seed, tmp_path):
+    candidates, ballots, n_winners = random_poll(seed, 'STAR')
+    result = star.run_election_chunked(candidates, write_ballot_file(tmp_path, candidates, ballots), n_winners,
+                                       chunk_size=16)
+    assert [int(c) for c in result.winners] == reference.star_winners(ballots, n_winners)
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_star_reweighted(seed):
+    candidates, ballots, n_winners = random_poll(seed, 'STAR')
+    n_winners = max(n_winners, 2)
+    result = star.run_election(candidates, ballots, n_winners, reweight=True)
+    assert [int(c) for c in result.winners] == reference.star_reweighted_winners(ballots, n_winners)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_star_reweighted_chunked(seed, tmp_path):
+    candidates, ballots, n_winners = random_poll(seed, 'STAR')
+    n_winners = max(n_winners, 2)
+    result = star.run_election_chunked(candidates, write_ballot_file(tmp_path, candidates, ballots), n_winners,
+                                       reweight=True, chunk_size=16)
+    assert [int(c) for c in result.winners] == reference.star_reweighted_winners(ballots, n_winners)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_schulze(seed):
+    candidates, ballots, n_winners = random_poll(seed, 'CONDORCET')
+    result = condorcet.run_election(candidates, ballots, n_winners)
+    assert [int(c) for c in result.winners] == reference.schulze_winners(ballots, n_winners)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_running_pairwise_matrix(seed):
+    # the matrix a poll keeps up to date ballot by ballot matches a full count
+    candidates, ballots, _ = random_poll(seed, 'CONDORCET')
+    running = sum(condorcet.ballot_pairwise(ballot) for ballot in ballots.T)
+    assert np.array_equal(running, condorcet.pairwise_matrix(ballots))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_pairwise_matrix_chunked(seed, tmp_path):
+    candidates, ballots, _ = random_poll(seed, 'CONDORCET')
+    chunked = condorcet.pairwise_matrix_chunked(write_ballot_file(tmp_path, candidates, ballots), chunk_size=16)
+    assert np.array_equal(chunked, condorcet.pairwise_matrix(ballots))
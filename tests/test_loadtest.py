@@ -0,0 +1,17 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize('poll_type,n_cands', [('STV', 5), ('STAR', 6), ('CONDORCET', 4)])
+def test_stateless_ballots(poll_type, n_cands):
+    # every voter gets exactly one ballot in, and the ballots leave nothing behind in discord.py's view store
+    # (each run gets its own process, since the bot's client can only be started once)
+    run = subprocess.run([sys.executable, os.path.join(REPO, 'loadtest.py'), '--voters', '200', '--concurrency', '50',
+                          '--type', poll_type, '--candidates', str(n_cands), '--latency', '0'],
+                         capture_output=True, text=True, timeout=120)
+    assert run.returncode == 0, run.stdout + run.stderr
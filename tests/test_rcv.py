@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+import ballot_store
+import rcv
+import reference
+import simulate
+
+
+def random_ballots(rng, n_cands, n_voters):
+    # few candidates and some short ballots, so lots of voters cast the same ballot
+    model = rng.choice(['impartial', 'spatial', 'truncated'])
+    return simulate.make_ballots(rng, model, 'STV', n_voters, n_cands, depth=int(rng.integers(0, n_cands)))
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_matches_per_voter_count(seed):
+    rng = np.random.default_rng(seed)
+    n_cands = int(rng.integers(3, 7))
+    ballots = random_ballots(rng, n_cands, int(rng.integers(5, 300)))
+    n_winners = int(rng.integers(1, n_cands))
+    result = rcv.run_election([f'c{i}' for i in range(n_cands)], ballots, n_winners)
+    assert [int(c) for c in result.winners] == reference.rcv_winners(ballots, n_winners)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_chunked_matches(seed, tmp_path):
+    rng = np.random.default_rng(seed)
+    n_cands = int(rng.integers(3, 7))
+    ballots = random_ballots(rng, n_cands, 1000)
+    n_winners = int(rng.integers(2, n_cands))
+    name = str(tmp_path / 'poll')
+    ballot_store.write_ballot_file(name, [f'c{i}' for i in range(n_cands)], [ballots], ballots.shape[1])
+    info, ballot_file = ballot_store.open_ballot_file(name)
+    result = rcv.run_election_chunked(info['candidates'], ballot_file, n_winners, chunk_size=64)
+    assert [int(c) for c in result.winners] == reference.rcv_winners(ballots, n_winners)
+
+
+def test_split_surplus_keeps_voting_order():
+    # voters 0..5 cast ballots A B A B A A, the first 3 of them stay (A, B and A) and the rest are transferred
+    ballots = np.array([[1, 2, 1, 2, 1, 1], [2, 1, 2, 1, 2, 2]])
+    table, weights, columns = rcv.compress_ballots(ballots, return_columns=True)
+    _, weights, transfer = rcv.split_surplus(table, weights, columns, np.array([0, 1]), 3)
+    assert sorted(weights[transfer].tolist()) == [1, 2]
+    assert columns[:3].tolist() == [0, 1, 0]
+    assert set(columns[3:].tolist()) == set(transfer.tolist())
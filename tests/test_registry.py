@@ -0,0 +1,43 @@
+import json
+
+import registry
+
+
+class FakePoll:
+
+    def __init__(self, record):
+        self.name = record['name']
+        self.key = record['key']
+        self.guild_id = record.get('guild_id')
+
+    def to_record(self):
+        return dict(name=self.name, key=self.key, guild_id=self.guild_id)
+
+
+def restore(path):
+    # the same as main.restore_polls, minus the discord parts
+    polls = registry.PollRegistry(path)
+    for record in polls.load_records():
+        polls.add(FakePoll(record), save=False, legacy=record.get('legacy', False))
+    return polls
+
+
+def test_legacy_and_dm_polls(tmp_path):
+    path = str(tmp_path / 'polls.json')
+    # a poll saved before polls were kept per guild, one made in a DM and one made in a guild
+    with open(path, 'w') as file:
+        json.dump([dict(name='old', key='a'), dict(name='dm', key='b', guild_id=None), dict(name='new', key='c', guild_id=7)], file)
+    polls = restore(path)
+    assert polls.get((7, 'old')).key == 'a'
+    assert polls.get((8, 'old')).key == 'a'
+    assert polls.get((None, 'dm')).key == 'b'
+    assert (7, 'dm') not in polls
+    assert (8, 'new') not in polls
+
+    # the legacy poll is still flagged after being saved and loaded again
+    polls.save()
+    polls = restore(path)
+    assert polls.get((8, 'old')).key == 'a'
+    assert (7, 'dm') not in polls
+    polls.pop((None, 'old'))
+    assert 'old' not in polls.legacy
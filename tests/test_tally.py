@@ -0,0 +1,31 @@
+import numpy as np
+
+import ballot_store
+import tally
+
+# c wins the first round either way, then removing half of c's supporters leaves a and b tied (a goes first),
+# while reweighting leaves b well ahead
+BALLOTS = np.array([[0, 1, 2], [0, 3, 1], [0, 4, 5], [0, 1, 1], [5, 1, 5]]).T
+
+
+def make_archive(reweight):
+    store = ballot_store.BallotStore('poll', 3)
+    for voter, ballot in enumerate(BALLOTS.T):
+        store.append(ballot, voter)
+    store.compact(['a', 'b', 'c'], 'STAR', 2, reweight)
+    return 'poll' + tally.ARCHIVE_SUFFIX
+
+
+def test_reweight_from_archive(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    res = tally.tally_archive(make_archive(True), render=False)
+    assert res['reweight'] and res['winners'] == ['c', 'b']
+    res = tally.tally_archive(make_archive(False), render=False)
+    assert not res['reweight'] and res['winners'] == ['c', 'a']
+
+
+def test_reweight_override(tmp_path, monkeypatch):
+    # --reweight counts an archive that didn't ask for it (or is from before the option was saved) with reweighting
+    monkeypatch.chdir(tmp_path)
+    res = tally.tally_archive(make_archive(None), reweight=True, render=False)
+    assert res['reweight'] and res['winners'] == ['c', 'b']
@@ -1,6 +1,10 @@
 import discord
 import numpy as np
 import logging
+import collections
+import time
+
+import ballot_store
 
 def time_formatter(seconds):
     if seconds > 3600*2:
@@ -78,53 +82,52 @@ class SubmitButton(discord.ui.Button):
         super().__init__(style=discord.ButtonStyle.green, label=f'Submit', row=4, disabled=True)
     
     async def callback(self, interaction):
-        # first: create the ballot
-        ballot = self.view.get_ballot()
-        # second: append the ballot to the poll object
-        added_ballot = self.view.poll.add_new_ballot(ballot, interaction.user.id)
-        # third: disable the submit button and all other menus
-        self.disabled = True
-        if type(self.view) is STVView:
-            for i in range(len(self.view.select_menus)):
-                if self.view.select_menus[i] != 0:
-                    self.view.select_menus[i].disabled = True
-        elif type(self.view) is STARSubmitView:
-            for choice_view in self.view.choice_views:
-                for btn in choice_view.buttons:
-                    btn.disabled = True
-        else:
-            raise ValueError("wtf did you do")
-        # fourth: edit the message confirming that the ballot has been submitted
-        content = 'Thanks, your ballot has been submitted!' 
-        embed = None
-        if not added_ballot:
-            if self.view.poll.closed:
-                content = 'Sorry, the poll is now closed!'
+        with interaction.client.metrics.submit_seconds.time(ballot='view'):
+            # first: create the ballot
+            ballot = self.view.get_ballot()
+            # second: append the ballot to the poll object
+            added_ballot = self.view.poll.add_new_ballot(ballot, interaction.user.id, amend=self.view.amend)
+            # third: disable the submit button and all other menus
+            self.disabled = True
+            if type(self.view) is STVView:
+                for i in range(len(self.view.select_menus)):
+                    if self.view.select_menus[i] != 0:
+                        self.view.select_menus[i].disabled = True
+            elif type(self.view) is STARBallotView:
+                self.view.ballot.disable()
             else:
-                content = "You sneaky little wretch. You thought you could try to game the system by " + \
-                "requesting mutliple ballots at the same time?  Well guess what, I thought of that, and " + \
-                "now that you've been caught you're going to jail.  Yep, that's right, I'm calling the " + \
-                "police. Right now.  Voter fraud is a serious crime you know. How long do you think they'll " + \
-                "lock you up for?  Months?  Years?  Well, I guess we'll find out. That is, if Michael Stevens " + \
-                "from vsauce doesn't get to you first... "
-                embed = discord.Embed(url="https://www.youtube.com/watch?v=OB0wsQrMC3c&list=PL75wEN6hwvjhNcoPqBgDpwevaFw6LPhOJ&index=40",
-                                      title="He's coming for you", description="Better watch your back...")
-
-        await interaction.response.edit_message(content=content, view=self.view, embed=embed)
-
-        # need to also update the previous messages if its a star poll
-        if type(self.view) is STARSubmitView:
-            for i in range(len(self.view.choice_messages)):
-                msg = self.view.choice_messages[i]
-                view = self.view.choice_views[i]
-                # await msg.edit(view=view)
+                raise ValueError("wtf did you do")
+            # fourth: edit the message confirming that the ballot has been submitted
+            content, embed = submission_reply(self.view.poll, added_ballot, self.view.amend)
+            await interaction.response.edit_message(content=content, view=self.view, embed=embed)
+
+
+def submission_reply(poll, added_ballot, amend=False):
+    # the message content (and embed) to show a voter after they press submit
+    content = 'Thanks, your ballot has been amended!' if amend else 'Thanks, your ballot has been submitted!'
+    embed = None
+    if not added_ballot:
+        if poll is None or poll.closed:
+            content = 'Sorry, the poll is now closed!'
+        else:
+            content = "You sneaky little wretch. You thought you could try to game the system by " + \
+            "requesting mutliple ballots at the same time?  Well guess what, I thought of that, and " + \
+            "now that you've been caught you're going to jail.  Yep, that's right, I'm calling the " + \
+            "police. Right now.  Voter fraud is a serious crime you know. How long do you think they'll " + \
+            "lock you up for?  Months?  Years?  Well, I guess we'll find out. That is, if Michael Stevens " + \
+            "from vsauce doesn't get to you first... "
+            embed = discord.Embed(url="https://www.youtube.com/watch?v=OB0wsQrMC3c&list=PL75wEN6hwvjhNcoPqBgDpwevaFw6LPhOJ&index=40",
+                                  title="He's coming for you", description="Better watch your back...")
+    return content, embed
+
 
 class STVView(discord.ui.View):
 
-    def __init__(self, n, poll, choices=None, timeout=3600, *args, **kwargs):        
+    def __init__(self, n, poll, choices=None, timeout=3600, amend=False, *args, **kwargs):        
         super().__init__(timeout=timeout, *args, **kwargs)          # Default timeout is 1 hour
         self.n = n                                                  # number of items in the poll
         self.poll = poll                                            # the actual poll object
+        self.amend = amend                                          # whether this ballot replaces one the voter already cast
         self.select_menus = np.zeros(min(n, 4), dtype=object)       # holds the select menus for each place
         self.submit_btn = None                                      # holds the submit button
         if choices is None:
@@ -143,7 +146,7 @@ class STVView(discord.ui.View):
     
     def get_ballot(self):
         # convert the select menu selections into a ballot
-        ballot = np.zeros(self.n, dtype=int)
+        ballot = np.zeros(self.n, dtype=ballot_store.BALLOT_DTYPE)
         for j in range(min(self.n, 4)):
             if self.select_menus[j] != 0:
                 if len(self.select_menus[j].values) > 0:
@@ -152,94 +155,244 @@ class STVView(discord.ui.View):
         return ballot
 
 
-class PollButton(discord.ui.Button):
+class STARScoreSelect(discord.ui.Select):
+
+    # a drop-down menu giving one candidate 0-5 stars
+    def __init__(self, ci, choice, row=0):
+        options = [discord.SelectOption(label=f'{k} ⭐', value=str(k)) for k in range(5, -1, -1)]
+        super().__init__(row=row, min_values=1, max_values=1, placeholder=f'{choice}: 0 ⭐'[:150], options=options)
+        self.ci = ci                        # index of the candidate this menu rates
 
-    def __init__(self, nj):
-        super().__init__(row=0, label=f'{nj+1} ⭐', style=discord.ButtonStyle.grey)
-        self.nj = nj
-        self.pressed = False
-    
     async def callback(self, interaction):
-        # if another button in the current view is pressed, unpress it
-        for button in self.view.buttons:
-            if button.pressed and button is not self:
-                button.pressed = False
-                button.style = discord.ButtonStyle.grey
-        # press the current button
-        if not self.pressed:
-            self.style = discord.ButtonStyle.blurple
-            self.pressed = True
-        else:
-            self.style = discord.ButtonStyle.grey
-            self.pressed = False
-        await interaction.response.edit_message(view=self.view)
+        # remember the score, and make it the default so it stays shown if the message is edited later
+        score = int(self.values[0])
+        self.view.ballot.scores[self.ci] = score
+        for opt in self.options:
+            opt.default = opt.value == self.values[0]
+        # nothing on the message needs to change, so just acknowledge the interaction
+        await interaction.response.defer()
 
 
-class STARChoiceView(discord.ui.View):
+class STARBallotView(discord.ui.View):
 
-    def __init__(self, n, poll, choices=None, timeout=3600, *args, **kwargs):
+    # one message worth of score menus, the last one also gets the submit button
+    def __init__(self, ballot, candidates, with_submit=False, timeout=3600, *args, **kwargs):
         super().__init__(timeout=timeout, *args, **kwargs)
+        self.ballot = ballot                # the STARBallot this view is part of
+        self.poll = ballot.poll
+        self.amend = ballot.amend
+        self.submit_btn = None
+        for row, ci in enumerate(candidates):
+            self.add_item(STARScoreSelect(ci, ballot.choices[ci], row=row))
+        if with_submit:
+            self.submit_btn = SubmitButton()
+            # STAR voting is much more lenient in the accepted format - can submit right away (all 0s) or at any point later
+            self.submit_btn.disabled = False
+            self.add_item(self.submit_btn)
+
+    def get_ballot(self):
+        return self.ballot.get_ballot()
+
+
+class STARBallot:
+
+    # discord allows 5 rows per message, so up to 4 candidates fit in one message along with the submit button,
+    # and up to 9 fit in two (5 menus in the first message, the rest plus the submit button in the second)
+    def __init__(self, n, poll, choices=None, timeout=3600, amend=False):
+
+        # set base attributes
         self.n = n
         self.poll = poll
-        self.buttons = np.zeros(5, dtype=object)
+        self.amend = amend
         if choices is None:
             choices = []
         self.choices = choices
-        self.create_view()
+        self.scores = np.zeros(self.n, dtype=ballot_store.BALLOT_DTYPE)
 
-    def create_view(self):        
-        # I hate everything about this
-        for j in range(5):
-            btn = PollButton(nj=j)
-            self.buttons[j] = btn
-            self.add_item(btn)
+        groups = star_ballot_groups(self.n)
+        self.views = [STARBallotView(self, group, with_submit=(i == len(groups)-1), timeout=timeout)
+                      for i, group in enumerate(groups)]
 
-class STARSubmitView(discord.ui.View):
+    def get_ballot(self):
+        return self.scores.copy()
 
-    def __init__(self, n, poll, choice_views=None, timeout=3600, *args, **kwargs):
-        super().__init__(timeout=timeout, *args, **kwargs)
-        self.n = n
+    def disable(self):
+        for view in self.views:
+            for item in view.children:
+                item.disabled = True
+
+
+def star_ballot_groups(n):
+    # which candidates go in which message of a STAR ballot
+    if n <= 4:
+        return [range(n)]
+    return [range(5), range(5, n)]
+
+
+# Stateless ballots
+#
+# Instead of keeping View objects around for every voter, the components of these ballots carry
+# everything needed to handle them in their custom_id: ilvd:<kind>:<poll key>:...
+# A ranked ballot keeps the choices picked so far in the custom_id (as a string of candidate indices),
+# so it needs no state at all. A STAR ballot's scores are spread across several menus, so they are
+# kept in a small per-voter draft (one byte per candidate) until the ballot is submitted.
+# 'v' marks a normal vote and 'a' an amendment.
+
+class BallotDrafts:
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl                                      # drafts untouched for this long are dropped (same as the old view timeout)
+        self._drafts = collections.OrderedDict()            # (poll key, user ID) -> (last touched, scores), least recently touched first
+
+    def __len__(self):
+        return len(self._drafts)
+
+    def set_score(self, key, user_id, n, ci, score):
+        now = time.monotonic()
+        entry = self._drafts.pop((key, user_id), None)
+        scores = bytearray(n) if entry is None else entry[1]
+        scores[ci] = score
+        self._drafts[(key, user_id)] = (now, scores)
+        self._prune(now)
+
+    def get(self, key, user_id, n):
+        entry = self._drafts.get((key, user_id))
+        return np.zeros(n, dtype=ballot_store.BALLOT_DTYPE) if entry is None else np.frombuffer(entry[1], dtype=ballot_store.BALLOT_DTYPE).copy()
+
+    def pop(self, key, user_id, n):
+        scores = self.get(key, user_id, n)
+        self._drafts.pop((key, user_id), None)
+        return scores
+
+    def _prune(self, now):
+        while self._drafts:
+            _, (touched, _) = next(iter(self._drafts.items()))
+            if now - touched <= self.ttl:
+                break
+            self._drafts.popitem(last=False)
+
+
+class RankSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'ilvd:rk:(?P<key>\w+):(?P<mode>[va]):(?P<picks>\d*)'):
+
+    # the menu for the next place on a ranked ballot, picks are the candidates already ranked above it
+    def __init__(self, poll, mode, picks, default=None, row=0, disabled=False):
         self.poll = poll
-        self.choice_views = choice_views
-        # will be filled in later:
-        self.choice_messages = None
-        assert len(self.choice_views) == self.n
-        self.submit_btn = None
-        self.create_view()
-    
-    def create_view(self):
-        self.submit_btn = SubmitButton()
-        # STAR voting is much more lenient in the accepted format - can submit right away (all 0s) or at any point later
-        self.submit_btn.disabled = False
-        self.add_item(self.submit_btn)
-    
-    def get_ballot(self):
-        # check which button is pressed in each choice view
-        ballot = np.zeros(self.n, dtype=int)
-        for i, choice_view in enumerate(self.choice_views):
-            for btn in choice_view.buttons:
-                if btn.pressed:
-                    assert ballot[i] == 0
-                    ballot[i] = btn.nj + 1
-        return ballot
+        self.mode = mode
+        self.picks = picks
+        options = []
+        if poll is not None:
+            options = [discord.SelectOption(label=choice, value=str(i), default=(str(i) == default))
+                       for i, choice in enumerate(poll.choices) if str(i) not in picks]
+        key = poll.key if poll is not None else '0'
+        super().__init__(discord.ui.Select(custom_id=f'ilvd:rk:{key}:{mode}:{picks}', min_values=1, max_values=1,
+                                           placeholder=f'Choose your {get_place_str(len(picks)+1)} option',
+                                           options=options or [discord.SelectOption(label='-')], row=row, disabled=disabled))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(interaction.client.polls.by_key(match['key']), match['mode'], match['picks'])
 
+    async def callback(self, interaction):
+        if self.poll is None:
+            await interaction.response.edit_message(content='Sorry, the poll is now closed!', view=None)
+            return
+        picks = self.picks + self.item.values[0]
+        await interaction.response.edit_message(view=make_stv_ballot_view(self.poll, picks, amend=(self.mode == 'a')))
 
-class STAR:
 
-    def __init__(self, n, poll, choices=None, timeout=3600):
+class ScoreSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'ilvd:sc:(?P<key>\w+):(?P<ci>\d)'):
 
-        # set base attributes
-        self.n = n
+    # the 0-5 star menu for one candidate on a STAR ballot
+    def __init__(self, poll, ci, default=None, row=0, disabled=False):
         self.poll = poll
-        if choices is None:
-            choices = []
-        self.choices = choices
+        self.ci = ci
+        key = poll.key if poll is not None else '0'
+        choice = poll.choices[ci] if poll is not None else ''
+        options = [discord.SelectOption(label=f'{k} ⭐', value=str(k), default=(k == default)) for k in range(5, -1, -1)]
+        super().__init__(discord.ui.Select(custom_id=f'ilvd:sc:{key}:{ci}', min_values=1, max_values=1,
+                                           placeholder=f'{choice}: 0 ⭐'[:150], options=options, row=row, disabled=disabled))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(interaction.client.polls.by_key(match['key']), int(match['ci']))
+
+    async def callback(self, interaction):
+        if self.poll is None:
+            await interaction.response.edit_message(content='Sorry, the poll is now closed!', view=None)
+            return
+        interaction.client.drafts.set_score(self.poll.key, interaction.user.id, len(self.poll.choices),
+                                            self.ci, int(self.item.values[0]))
+        await interaction.response.defer()
+
+
+class DraftSubmit(discord.ui.DynamicItem[discord.ui.Button], template=r'ilvd:sb:(?P<key>\w+):(?P<mode>[va]):(?P<picks>\d*)'):
+
+    # the submit button of a stateless ballot
+    def __init__(self, poll, mode, picks='', disabled=False):
+        self.poll = poll
+        self.mode = mode
+        self.picks = picks
+        key = poll.key if poll is not None else '0'
+        super().__init__(discord.ui.Button(style=discord.ButtonStyle.green, label='Submit', row=4, disabled=disabled,
+                                           custom_id=f'ilvd:sb:{key}:{mode}:{picks}'))
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(interaction.client.polls.by_key(match['key']), match['mode'], match['picks'])
+
+    async def callback(self, interaction):
+        with interaction.client.metrics.submit_seconds.time(ballot='stateless'):
+            poll = self.poll
+            amend = self.mode == 'a'
+            if poll is None:
+                content, embed = submission_reply(None, False)
+                await interaction.response.edit_message(content=content, view=None, embed=embed)
+                return
+            n = len(poll.choices)
+            # first: create the ballot, either from the picks in the custom_id or from the voter's draft
+            if poll.type == 'STAR':
+                ballot = interaction.client.drafts.pop(poll.key, interaction.user.id, n)
+                view = make_star_ballot_views(poll, amend=amend, scores=ballot, disabled=True)[-1]
+            else:
+                ballot = np.zeros(n, dtype=ballot_store.BALLOT_DTYPE)
+                for place, ci in enumerate(self.picks):
+                    ballot[int(ci)] = place + 1
+                view = make_stv_ballot_view(poll, self.picks, amend=amend, disabled=True)
+            # second: append the ballot to the poll object
+            added_ballot = poll.add_new_ballot(ballot, interaction.user.id, amend=amend)
+            # third: show the ballot again with everything disabled, along with the confirmation
+            content, embed = submission_reply(poll, added_ballot, amend)
+            await interaction.response.edit_message(content=content, view=view, embed=embed)
+
+
+def make_stv_ballot_view(poll, picks='', amend=False, disabled=False):
+    # a ranked ballot with a menu for each place picked so far, plus one for the next place
+    mode = 'a' if amend else 'v'
+    view = discord.ui.View(timeout=None)
+    n_menus = min(len(picks) + 1, len(poll.choices), 4)
+    for place in range(n_menus):
+        default = picks[place] if place < len(picks) else None
+        view.add_item(RankSelect(poll, mode, picks[:place], default=default, row=place, disabled=disabled))
+    view.add_item(DraftSubmit(poll, mode, picks[:4], disabled=disabled or len(picks) == 0))
+    # the dynamic items are dispatched on their own, so the view is stopped straight away to keep discord.py
+    # from holding on to it (a finished view never goes in the view store or gets a timeout)
+    view.stop()
+    return view
+
 
-        # set a button view for each poll choice
-        self.choice_views = []
-        for choice in self.choices:
-            btn_view = STARChoiceView(self.n, self.poll, self.choices, timeout=timeout)
-            self.choice_views.append(btn_view)
-        
-        # set the final submit button view
-        self.submit_view = STARSubmitView(self.n, self.poll, self.choice_views, timeout=timeout)
+def make_star_ballot_views(poll, amend=False, scores=None, disabled=False):
+    # one view per message of a STAR ballot, the last one gets the submit button
+    mode = 'a' if amend else 'v'
+    groups = star_ballot_groups(len(poll.choices))
+    views = []
+    for i, group in enumerate(groups):
+        view = discord.ui.View(timeout=None)
+        for row, ci in enumerate(group):
+            default = None if scores is None else int(scores[ci])
+            view.add_item(ScoreSelect(poll, ci, default=default, row=row, disabled=disabled))
+        if i == len(groups) - 1:
+            view.add_item(DraftSubmit(poll, mode, disabled=disabled))
+        # stopped for the same reason as in make_stv_ballot_view
+        view.stop()
+        views.append(view)
+    return views